@@ -1,22 +1,44 @@
-import polars as pl
 import argparse
+import json
+import sys
 from pathlib import Path
 import logging
-import psutil
+from collections import Counter
+from datetime import timedelta
 
 from src import daily_processor as processor
-from src.misc import get_last_seven_files, store_format_operator_top_100, store_format_match_top_10
+from src.misc import store_format_operator_top_100, store_format_match_top_10, SPILL_FORMATS, DEFAULT_SPILL_FORMAT, OUTPUT_COMPRESSIONS
 from src.constants import TODAY
 from src.queries import merge_results_operator_top_100, merge_results_match_top_10
-from src.matches import generate_matches, store_matches, generate_millions_matchs
+from src.matches import generate_matches, store_matches, generate_millions_matchs, resolve_log_paths
 from src.daily_results import generate_dummy_daily_results
+from src.rolling import update_rolling_windows, parse_date, format_date, DEFAULT_WINDOW_DAYS
+from src.instrumentation import enable_spans, span, peak_rss_mb
+from src.backfill import discover_daily_logs, backfill_daily_results, days_between, DEFAULT_LOG_DIR
+from src.live import tail_log, DEFAULT_REFRESH_SECONDS, DEFAULT_CHECKPOINT_SECONDS
+from src.run_manifest import open_run, close_run, spill_dir, run_partials_dir
+from src.spill import open_spill, close_spill
+from src.daily_partials import commit_day_partials, has_source_partials, amend_day_partials, day_partials_dir
+from src.query_service import open_query_index, serve_queries, DEFAULT_QUERY_HOST, DEFAULT_QUERY_PORT, DEFAULT_RELOAD_SECONDS
+from src.job_spool import open_spool, run_spool, DEFAULT_SPOOL_DIR, DEFAULT_MAX_JOBS, DEFAULT_SPOOL_POLL_SECONDS
+from src.result_cache import cache_get, cache_put, daily_results_key, window_results_key, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_MB
+from src.benchmark import run_benchmark, store_benchmark, compare_benchmark, DEFAULT_SCALES, DEFAULT_CORRUPTION_RATIOS, DEFAULT_CHUNK_SIZES, DEFAULT_SEED, DEFAULT_TOLERANCE, DEFAULT_REPEATS
 
 DEFAULT_LOG_PATH = Path('data/logs/matches.log')
 DEFAULT_CHUNK_SIZE = 10**7
 RESULT_DIR = Path('data/rolling_seven_days/')
 DIR_DAILY_OPERATOR_TOP_100 = Path('data/daily/operator_top_100/')
 DIR_DAILY_MATCH_TOP_10 = Path('data/daily/match_top_10/')
+DIR_DAILY_PARTIALS = Path('data/daily/partials/')
+ROLLING_STATE_DIR = Path('data/rolling_state/')
+DEFAULT_BENCHMARK_PATH = Path('data/benchmark/results.json')
+DEFAULT_LIVE_CHECKPOINT_DIR = Path('data/live/')
+DEFAULT_RUN_DIR = Path('data/runs/')
 DEFAULT_LOGGING_PATH = Path('main.log')
+DEFAULT_SPANS_PATH = Path('spans.jsonl')
+JOB_ACTIONS = ('process', 'amend', 'generate-matches')
+# Jobs writing the daily and rolling results, run one at a time
+EXCLUSIVE_JOB_ACTIONS = ('process', 'amend')
 
 logging.basicConfig(
     filename=DEFAULT_LOGGING_PATH,
@@ -24,75 +46,229 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
 )
 
-def log_performance_metrics():
-    cpu_times = psutil.cpu_times()
-    cpu_usage = psutil.cpu_percent(interval=1)
-    total_cpu_time = sum(cpu_times)  # Total CPU time in seconds
+def rolling_result_dir(window_days: int) -> Path: 
+    if window_days == 7: 
+        return RESULT_DIR
+    return Path(f'data/rolling_{window_days}_days/')
 
-    # Get RAM usage
-    ram_info = psutil.virtual_memory()
-    ram_usage = ram_info.percent
-    total_ram_mb = ram_info.total / (1024 * 1024)  # Convert to MB
-    used_ram_mb = ram_info.used / (1024 * 1024)    # Convert to MB
+def process_daily_log(log_path: Path, chunk_size: int, spill_format: str = DEFAULT_SPILL_FORMAT, n_workers: int = None, partition_rows: int = processor.DEFAULT_PARTITION_ROWS, max_memory_mb: float = None, run_dir: Path = DEFAULT_RUN_DIR, resume: bool = False, run_spill_dir: Path = None, max_spill_mb: float = None, cache_dir: Path = None, cache_max_mb: float = DEFAULT_CACHE_MAX_MB, full_hash: bool = False):
+    logging.info("Starting to process daily log file")
+    with span('process_daily_log', log_path=log_path, resume=resume) as run_record: 
+        log_paths = resolve_log_paths(log_path)
+        # Daily results are cached by the fingerprint of the log files, unchanged logs are not processed again, 
+        # unless the partials of the day are not theirs
+        daily_key = daily_results_key(log_paths, list(processor.DAILY_METRICS), full_hash)
+        cached = None
+        if cache_dir is not None and has_source_partials(DIR_DAILY_PARTIALS, TODAY, daily_key): 
+            cached = cache_get(cache_dir, daily_key)
+        run_record['cache_hit'] = cached is not None
 
+        manifest = None
+        if cached is not None: 
+            daily_metrics, metadata = cached
+            rejections = Counter(metadata['rejections'])
+            logging.info("Daily results found in cache %s, validation: %s", daily_key, metadata['rejections'])
+        else: 
+            # The run manifest is kept until the daily results are stored, so that an interrupted run can be resumed
+            manifest = open_run(run_dir / TODAY, log_paths, resume, run_spill_dir)
+            spill = open_spill(spill_dir(manifest), max_spill_mb)
+            rejections = Counter()
+            shard_progress = {}
+            settings = {}
+            with span('partition') as record: 
+                partition_map = processor.partition_log_file(log_path, chunk_size, spill_format, rejections, n_workers, shard_progress, partition_rows, max_memory_mb, manifest, spill, settings)
+                record.update(rows_in=rejections['rows'], rows_out=rejections['rows'] - rejections['rejected'], rejections=dict(rejections))
+            logging.info("Validation: %s", dict(rejections))
+            if shard_progress: 
+                logging.info("Shards: %s", shard_progress)
+            
+            # Daily operator and match processing, in a single pass over the partitions
+            with span('aggregation', rows_in=len(partition_map)) as record: 
+                daily_metrics = processor.compute_daily_metrics(partition_map, n_workers=n_workers, manifest=manifest, spill=spill, partials_dir=run_partials_dir(manifest))
+                record['rows_out'] = sum(df.height for df in daily_metrics.values())
 
-    logging.info("CPU Usage: %s%%, CPU Time: User: %s s, System: %s s, Idle: %s s, Total CPU Time: %s s, RAM Usage: %s%%, Used RAM: %s MB, Total RAM: %s MB", 
-                 cpu_usage, cpu_times.user, cpu_times.system, cpu_times.idle, total_cpu_time, ram_usage, used_ram_mb, total_ram_mb)
+            # A day with failed shards is not cached, so that it is processed again
+            if cache_dir is not None and not any(progress['status'] == 'failed' for progress in shard_progress.values()): 
+                cache_put(cache_dir, daily_key, daily_metrics, { 'log_path': log_path, 'rejections': dict(rejections) }, cache_max_mb)
 
-def log(function): 
-    def sub(*args, **kwargs):
-        log_performance_metrics()
-        res = function(*args, **kwargs)
-        log_performance_metrics()
-        return res
-    return sub
+        with span('store_daily'): 
+            processor.store_daily_operator_top_100(daily_metrics['operator_top_100'], TODAY)
+            processor.store_daily_match_top_10(daily_metrics['match_top_10'], TODAY)
 
-@log
-def process_daily_log(log_path: Path, chunk_size: int):
-    logging.info("Starting to process daily log file")
-    partition_map = processor.partition_log_file(log_path, chunk_size)
-    
-    # Daily operator and match processing
-    operator_top_100 = processor.compute_daily_operator_top_100(partition_map)
-    processor.store_daily_operator_top_100(operator_top_100, TODAY)
-    
-    match_top_10 = processor.compute_daily_match_top_10(partition_map)
-    processor.store_daily_match_top_10(match_top_10, TODAY)
+        if manifest is not None: 
+            # Partials of the day, kept to amend it with late arriving rows
+            commit_day_partials(run_partials_dir(manifest), DIR_DAILY_PARTIALS, TODAY, settings['n_partitions'], daily_key)
+            # Bytes spilled per stage, to size the spill volume
+            run_record['spill'] = close_spill(spill)
+            logging.info("Spill: %s", run_record['spill'])
+            close_run(manifest)
     logging.info("Daily log processing completed.")
+    return dict(rejections)
 
-@log
-def update_rolling_seven_days():
-    logging.info("Updating rolling seven days statistics")
-    last_seven_files_operator_top_100 = get_last_seven_files(DIR_DAILY_OPERATOR_TOP_100)
-    last_seven_files_match_top_10 = get_last_seven_files(DIR_DAILY_MATCH_TOP_10)
-    
-    rolling_seven_days_operator_top_100 = merge_results_operator_top_100(
-        [pl.scan_csv(file) for file in last_seven_files_operator_top_100]
-    ).collect()
-    
-    rolling_seven_days_match_top_10 = merge_results_match_top_10(
-        [pl.scan_csv(file) for file in last_seven_files_match_top_10]
-    ).collect()
-    
-    store_format_operator_top_100(
-        RESULT_DIR / f'operator_top100_{TODAY}.txt', rolling_seven_days_operator_top_100
-    )
-    store_format_match_top_10(
-        RESULT_DIR / f'match_top10_{TODAY}.txt', rolling_seven_days_match_top_10
-    )
-    logging.info("Rolling seven days statistics updated.")
+def update_rolling_window(window_days: int = DEFAULT_WINDOW_DAYS, end_date: str = TODAY, compression: str = None, cache_dir: Path = None, cache_max_mb: float = DEFAULT_CACHE_MAX_MB):
+    logging.info("Updating rolling %s days statistics ending %s", window_days, end_date)
+    daily_dirs = {
+        'operator_top_100': DIR_DAILY_OPERATOR_TOP_100,
+        'match_top_10': DIR_DAILY_MATCH_TOP_10
+    }
+    with span('rolling', window_days=window_days, end_date=end_date) as record: 
+        # Window results are cached by the content of the daily results within the window
+        window_key, cached = None, None
+        if cache_dir is not None: 
+            window_dates = days_between(format_date(parse_date(end_date) - timedelta(days=window_days - 1)), end_date)
+            window_key = window_results_key(
+                { 
+                    name: [ daily_dir / f'{str_date}.csv' for str_date in window_dates if (daily_dir / f'{str_date}.csv').exists() ] 
+                    for name, daily_dir in daily_dirs.items() 
+                },
+                window_days,
+                end_date
+            )
+            cached = cache_get(cache_dir, window_key)
+        record['cache_hit'] = cached is not None
+
+        if cached is not None: 
+            rolling_results, _ = cached
+        else: 
+            rolling_results = update_rolling_windows(
+                ROLLING_STATE_DIR,
+                daily_dirs,
+                end_date,
+                {
+                    'operator_top_100': merge_results_operator_top_100,
+                    'match_top_10': merge_results_match_top_10
+                },
+                window_days
+            )
+            if window_key is not None: 
+                cache_put(cache_dir, window_key, rolling_results, { 'end_date': end_date, 'window_days': window_days }, cache_max_mb)
+        record['rows_out'] = sum(df.height for df in rolling_results.values())
+
+    result_dir = rolling_result_dir(window_days)
+    with span('output', rows_in=record['rows_out']): 
+        store_format_operator_top_100(
+            result_dir / f'operator_top100_{end_date}.txt', rolling_results['operator_top_100'], compression
+        )
+        store_format_match_top_10(
+            result_dir / f'match_top10_{end_date}.txt', rolling_results['match_top_10'], compression
+        )
+    logging.info("Rolling %s days statistics updated.", window_days)
+
+def amend_daily_log(str_date: str, delta_log_path: Path, chunk_size: int, window_days: int = DEFAULT_WINDOW_DAYS, compression: str = None, cache_dir: Path = None, cache_max_mb: float = DEFAULT_CACHE_MAX_MB):
+    logging.info("Amending %s with %s", str_date, delta_log_path)
+    with span('amend', date=str_date, delta_log=delta_log_path) as record: 
+        rejections = Counter()
+        daily_metrics = amend_day_partials(day_partials_dir(DIR_DAILY_PARTIALS, str_date), delta_log_path, chunk_size, rejections)
+        record.update(rows_in=rejections['rows'], rows_out=rejections['rows'] - rejections['rejected'], rejections=dict(rejections))
+        processor.store_daily_operator_top_100(daily_metrics['operator_top_100'], str_date)
+        processor.store_daily_match_top_10(daily_metrics['match_top_10'], str_date)
+    logging.info("Delta validation: %s", dict(rejections))
+
+    # Only the windows including the amended day, up to the last day with daily results
+    last_date = max(path.stem for path in DIR_DAILY_OPERATOR_TOP_100.glob('*.csv'))
+    window_end = format_date(parse_date(str_date) + timedelta(days=window_days - 1))
+    for end_date in days_between(str_date, min(window_end, last_date)): 
+        update_rolling_window(window_days, end_date, compression, cache_dir, cache_max_mb)
+    logging.info("Daily results of %s amended.", str_date)
+    return dict(rejections)
+
+def job_args(parser: argparse.ArgumentParser, job: dict, defaults: argparse.Namespace) -> argparse.Namespace:
+    """
+    Parse a spool job, a JSON object of command line arguments without their dashes
+    e.g. { "action": "process", "log_path": "...", "resume": true }. Arguments missing
+    from the job take the value given to the daemon.
+    """
+    argv = []
+    for name, value in job.items():
+        if value is True:
+            argv.append(f'--{name}')
+        elif isinstance(value, list):
+            argv += [f'--{name}', *map(str, value)]
+        elif value is not None and value is not False:
+            argv += [f'--{name}', str(value)]
+    try:
+        return parser.parse_args(argv, namespace=argparse.Namespace(**vars(defaults)))
+    except SystemExit:
+        raise ValueError(f"Invalid job arguments {argv}")
+
+def run_job(args: argparse.Namespace) -> dict:
+    """ Run a 'process', 'amend' or 'generate-matches' job of the daemon, and return its metrics. """
+    cache_dir = None if args.no_cache else args.cache_dir
+    match args.action:
+        case 'process':
+            if not args.log_path:
+                raise ValueError("A 'process' job requires log_path.")
+            rejections = process_daily_log(args.log_path, args.chunk_size, args.spill_format, args.n_workers, args.partition_rows, args.max_memory_mb, args.run_dir, args.resume, args.spill_dir, args.max_spill_mb, cache_dir, args.cache_max_mb, args.full_hash)
+            update_rolling_window(args.window_days, compression=args.output_compression, cache_dir=cache_dir, cache_max_mb=args.cache_max_mb)
+            return { 'rejections': rejections }
+        case 'amend':
+            if not ( args.date and args.delta_log ):
+                raise ValueError("An 'amend' job requires date and delta_log.")
+            rejections = amend_daily_log(args.date, args.delta_log, args.chunk_size, args.window_days, args.output_compression, cache_dir, args.cache_max_mb)
+            return { 'rejections': rejections }
+        case 'generate-matches':
+            if not ( args.output_path and ( args.n_matches or args.n_million ) ):
+                raise ValueError("A 'generate-matches' job requires output_path and n_matches or n_million.")
+            if args.n_million is not None and args.n_million > 0:
+                generate_millions_matchs(args.n_million, args.output_path, args.corruption_ratio, args.n_workers, args.seed)
+            else:
+                store_matches(args.output_path, generate_matches(args.n_matches, args.corruption_ratio, args.seed))
+            return { 'output_path': str(args.output_path) }
+        case _:
+            raise ValueError(f"Unsupported job action '{args.action}', expected one of {list(JOB_ACTIONS)}.")
 
 def main(): 
     parser = argparse.ArgumentParser(description="Process daily log and update rolling seven-day stats or generate large match datasets.")
-    parser.add_argument('--action', choices=['process', 'generate-matches', 'dummy'], required=True, help="Choose to process logs, generate matches, or create dummy daily results.")
-    parser.add_argument('--log_path', type=Path, help="Path to the log file (requiered for 'process' action).")
+    parser.add_argument('--action', choices=['process', 'backfill', 'amend', 'tail', 'serve', 'daemon', 'generate-matches', 'dummy', 'benchmark'], required=True, help="Choose to process logs, backfill several days of logs, amend a processed day with late arriving logs, follow a growing log, serve queries over the results, run process, amend and generate jobs from a spool in a resident daemon, generate matches, create dummy daily results, or benchmark the processing pipeline.")
+    parser.add_argument('--log_path', type=Path, help="Path to the log file (CSV, optionally compressed, Parquet or Arrow IPC), or to a directory or glob pattern of log shards processed as a single day (requiered for 'process' and 'tail' actions, 'tail' only follows a single file).")
     parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help="Chunk size for log file processing. Optionnal for 'process' action")
+    parser.add_argument('--partition_rows', type=int, default=processor.DEFAULT_PARTITION_ROWS, help="Target number of rows per partition, the number of partitions is chosen from the log size. Optionnal for 'process' and 'backfill' actions, Default 500000")
+    parser.add_argument('--spill_format', choices=list(SPILL_FORMATS), default=DEFAULT_SPILL_FORMAT, help="Format of the partition temporary files. Optionnal for 'process' action, Default 'ipc'")
+    parser.add_argument('--n_workers', type=int, help="Number of workers partitioning the log shards and computing the partitions statistics, or generating matches. Optionnal for 'process' and 'generate' actions, Default number of CPUs")
+    parser.add_argument('--window_days', type=int, default=DEFAULT_WINDOW_DAYS, help="Length in days of the rolling window, up to 30. Optionnal for 'process' action, Default 7")
+    parser.add_argument('--output_compression', choices=list(OUTPUT_COMPRESSIONS), help="Compression of the rolling result files, 'zstd' requires the zstandard package. Optionnal for 'process', 'backfill' and 'tail' actions, Default uncompressed")
+    parser.add_argument('--from', dest='from_date', help="First day to backfill, as YYYYMMDD (required for 'backfill' action).")
+    parser.add_argument('--to', dest='to_date', help="Last day to backfill, as YYYYMMDD (required for 'backfill' action).")
+    parser.add_argument('--date', help="Day to amend, as YYYYMMDD (required for 'amend' action).")
+    parser.add_argument('--delta_log', type=Path, help="Path to the late arriving rows of the day, in any log format, or to a directory or glob pattern of delta shards (required for 'amend' action).")
+    parser.add_argument('--log_dir', type=Path, default=DEFAULT_LOG_DIR, help="Directory of the daily logs, named after their day e.g. matchesYYYYMMDD.log. Optionnal for 'backfill' action, Default data/logs/")
+    parser.add_argument('--max_memory_mb', type=float, help="Memory budget in MB: chunks and partitions are sized to fit in it, over all the days processed concurrently for 'backfill'. Optionnal for 'process' and 'backfill' actions, Default no budget, available memory to plan the 'backfill' days")
+    parser.add_argument('--resume', action='store_true', help="Resume an interrupted run of the day, skipping the chunks, partitions and aggregates it finished and reusing its spill files. Optionnal for 'process' action, Default start over")
+    parser.add_argument('--run_dir', type=Path, default=DEFAULT_RUN_DIR, help="Directory of the run manifests and spill files, one sub directory per day. Optionnal for 'process' action, Default data/runs/")
+    parser.add_argument('--spill_dir', type=Path, help="Directory of the spill files, e.g. on a fast local disk or a tmpfs, with one sub directory per day for 'process'. Optionnal for 'process' and 'backfill' actions, Default the run directory for 'process', the system temporary directory for 'backfill'")
+    parser.add_argument('--max_spill_mb', type=float, help="Cap in MB of the spill files on disk at once, the run fails if it is exceeded. Optionnal for 'process' and 'backfill' actions, over all the days processed concurrently for 'backfill', Default no cap")
+    parser.add_argument('--cache_dir', type=Path, default=DEFAULT_CACHE_DIR, help="Directory of the result cache, keyed by the fingerprint of the logs and of the daily results. Optionnal for 'process' and 'backfill' actions, Default data/cache/")
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_CACHE_MAX_MB, help="Size of the result cache in MB, least recently used results are evicted beyond it. Optionnal for 'process' and 'backfill' actions, Default 1024")
+    parser.add_argument('--no_cache', action='store_true', help="Process the logs and merge the windows again even if their results are cached. Optionnal for 'process' and 'backfill' actions, Default use the cache")
+    parser.add_argument('--full_hash', action='store_true', help="Fingerprint the logs with a hash of their full content rather than of a sample of it. Optionnal for 'process' and 'backfill' actions, Default sampled hash")
+    parser.add_argument('--refresh_seconds', type=float, default=DEFAULT_REFRESH_SECONDS, help="Interval between two refreshes of the daily and rolling results. Optionnal for 'tail' action, Default 60")
+    parser.add_argument('--checkpoint_seconds', type=float, default=DEFAULT_CHECKPOINT_SECONDS, help="Interval between two checkpoints of the live state. Optionnal for 'tail' action, Default 300")
+    parser.add_argument('--checkpoint_dir', type=Path, default=DEFAULT_LIVE_CHECKPOINT_DIR, help="Directory of the live state checkpoint. Optionnal for 'tail' action, Default data/live/")
+    parser.add_argument('--host', default=DEFAULT_QUERY_HOST, help="Address the query service listens on. Optionnal for 'serve' action, Default 127.0.0.1")
+    parser.add_argument('--port', type=int, default=DEFAULT_QUERY_PORT, help="Port the query service listens on. Optionnal for 'serve' action, Default 8765")
+    parser.add_argument('--socket_path', type=Path, help="Unix socket the query service listens on, instead of --host and --port. Optionnal for 'serve' action")
+    parser.add_argument('--reload_seconds', type=float, default=DEFAULT_RELOAD_SECONDS, help="Interval between two checks for new results to load. Optionnal for 'serve' action, Default 1")
+    parser.add_argument('--spool_dir', type=Path, default=DEFAULT_SPOOL_DIR, help="Directory of the job spool, jobs are JSON files submitted to its incoming/ sub directory. Optionnal for 'daemon' action, Default data/spool/")
+    parser.add_argument('--max_jobs', type=int, default=DEFAULT_MAX_JOBS, help="Number of jobs run at once, 'process' and 'amend' jobs still run one at a time. Optionnal for 'daemon' action, Default 1")
+    parser.add_argument('--poll_seconds', type=float, default=DEFAULT_SPOOL_POLL_SECONDS, help="Interval between two checks of the spool for new jobs. Optionnal for 'daemon' action, Default 0.2")
     parser.add_argument('--n_matches', type=int, help="Number of matches to generate (required for 'generate' action).")
     parser.add_argument('--n_million', type=int, help="Number of millions of matches to generate optionnl for 'generate' action. If n-million is provided with n-matches, n-matches is ignored")
     parser.add_argument('--output_path', type=Path, help="Path to output generated matches file (required for 'generate' action).")
-    parser.add_argument('--corruption_ratio', type=float, default=0, help="Corruption ratio for generated matches. WARNING This feature does not scale well, Default 0, no corruption")
+    parser.add_argument('--corruption_ratio', type=float, default=0, help="Corruption ratio for generated matches. Default 0, no corruption")
+    parser.add_argument('--seed', type=int, help="Random seed for generated matches, for reproducible datasets. Optionnal for 'generate' action")
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES, help="Numbers of matches of the benchmark fixtures. Optionnal for 'benchmark' action, Default 1000 100000 1000000")
+    parser.add_argument('--corruption_ratios', type=float, nargs='+', default=DEFAULT_CORRUPTION_RATIOS, help="Corruption ratios of the benchmark fixtures. Optionnal for 'benchmark' action, Default 0 0.001")
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=DEFAULT_CHUNK_SIZES, help="Chunk sizes swept by the benchmark. Optionnal for 'benchmark' action, Default 1000000 10000000")
+    parser.add_argument('--partition_rows_sweep', type=int, nargs='+', help="Target partition sizes swept by the benchmark. Optionnal for 'benchmark' action, Default 500000")
+    parser.add_argument('--n_workers_sweep', type=int, nargs='+', help="Numbers of workers swept by the benchmark. Optionnal for 'benchmark' action, Default number of CPUs")
+    parser.add_argument('--baseline_path', type=Path, help="Benchmark results to compare against. Optionnal for 'benchmark' action")
+    parser.add_argument('--spans_path', type=Path, default=DEFAULT_SPANS_PATH, help="Path of the JSON lines file where the performance of each stage is recorded. Default spans.jsonl")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="Relative slow down or memory increase reported as a regression, on top of the run to run noise. Optionnal for 'benchmark' action, Default 0.1")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help="Number of runs of each benchmark configuration, each in a fresh process. Optionnal for 'benchmark' action, Default 3")
     
     args = parser.parse_args()
+    enable_spans(args.spans_path)
+    cache_dir = None if args.no_cache else args.cache_dir
 
     match args.action: 
         case 'process':
@@ -100,13 +276,100 @@ def main():
                 parser.error("The 'process' action requires --log_path.")
             try: 
                 print("This action can take up to several minutes for very large log files")
-                process_daily_log(args.log_path, args.chunk_size)
-                update_rolling_seven_days()
+                process_daily_log(args.log_path, args.chunk_size, args.spill_format, args.n_workers, args.partition_rows, args.max_memory_mb, args.run_dir, args.resume, args.spill_dir, args.max_spill_mb, cache_dir, args.cache_max_mb, args.full_hash)
+                update_rolling_window(args.window_days, compression=args.output_compression, cache_dir=cache_dir, cache_max_mb=args.cache_max_mb)
+
+                logging.info("Peak RSS: %.0f MB, memory budget: %s MB", peak_rss_mb(), args.max_memory_mb)
+                if args.max_memory_mb: 
+                    print(
+                        f"Peak RSS {peak_rss_mb():.0f} MB for a memory budget of {args.max_memory_mb:.0f} MB"
+                        f"{' (exceeded)' if peak_rss_mb() > args.max_memory_mb else ''}."
+                    )
 
-                print(f"Log processing and update completed. Find your results at {RESULT_DIR.resolve()}")
+                print(f"Log processing and update completed. Find your results at {rolling_result_dir(args.window_days).resolve()}")
             except Exception as e:
                 logging.error("Error processing daily log file: %s", e)
+                print(f"Log processing failed, see {DEFAULT_LOGGING_PATH}. Run again with --resume to skip the work already done.")
         
+        case 'backfill':
+            if not ( args.from_date and args.to_date ):
+                parser.error("The 'backfill' action requires --from and --to.")
+
+            daily_logs = discover_daily_logs(args.log_dir, args.from_date, args.to_date)
+            if not daily_logs:
+                parser.error(f"No daily log in {args.log_dir} from {args.from_date} to {args.to_date}.")
+            print(f"Backfilling {len(daily_logs)} days from {args.from_date} to {args.to_date}...")
+
+            with span('backfill', rows_in=len(daily_logs)) as record:
+                rejections = backfill_daily_results(
+                    daily_logs, args.chunk_size, args.spill_format, args.n_workers, args.max_memory_mb, args.partition_rows,
+                    args.spill_dir, args.max_spill_mb, cache_dir, args.cache_max_mb, args.full_hash, DIR_DAILY_PARTIALS
+                )
+                record['rows_out'] = len(rejections)
+            failed_days = sorted(set(daily_logs) - set(rejections))
+            if failed_days:
+                print(f"Failed to process {failed_days}, see {DEFAULT_LOGGING_PATH}")
+
+            # Rolling windows in date order, so that each update is incremental on the previous one
+            for str_date in days_between(args.from_date, args.to_date):
+                try:
+                    update_rolling_window(args.window_days, str_date, args.output_compression, cache_dir, args.cache_max_mb)
+                except FileNotFoundError as e:
+                    logging.warning("Skipping rolling window ending %s: %s", str_date, e)
+            print(f"Backfill completed. Find your results at {rolling_result_dir(args.window_days).resolve()}")
+
+        case 'amend':
+            if not ( args.date and args.delta_log ):
+                parser.error("The 'amend' action requires --date and --delta_log.")
+            try: 
+                amend_daily_log(args.date, args.delta_log, args.chunk_size, args.window_days, args.output_compression, cache_dir, args.cache_max_mb)
+                print(f"Amended {args.date}. Find your results at {rolling_result_dir(args.window_days).resolve()}")
+            except Exception as e:
+                logging.error("Error amending %s: %s", args.date, e)
+                print(f"Amending {args.date} failed, see {DEFAULT_LOGGING_PATH}.")
+
+        case 'tail':
+            if not args.log_path:
+                parser.error("The 'tail' action requires --log_path.")
+
+            def _on_refresh(daily_metrics): 
+                processor.store_daily_operator_top_100(daily_metrics['operator_top_100'], TODAY)
+                processor.store_daily_match_top_10(daily_metrics['match_top_10'], TODAY)
+                update_rolling_window(args.window_days, compression=args.output_compression)
+                logging.info("Live results refreshed.")
+
+            print(f"Following {args.log_path}, results are refreshed every {args.refresh_seconds}s. Press Ctrl+C to stop.")
+            state = tail_log(
+                args.log_path, args.checkpoint_dir, _on_refresh, args.refresh_seconds, args.checkpoint_seconds
+            )
+            logging.info("Live validation: %s", dict(state['rejections']))
+            print(f"Stopped at byte {state['offset']}. Find your results at {rolling_result_dir(args.window_days).resolve()}")
+        
+        case 'serve':
+            service = open_query_index(
+                rolling_result_dir(args.window_days),
+                {
+                    'operator_top_100': DIR_DAILY_OPERATOR_TOP_100,
+                    'match_top_10': DIR_DAILY_MATCH_TOP_10
+                }
+            )
+            address = args.socket_path or f'http://{args.host}:{args.port}'
+            print(f"Serving queries over {len(service['files'])} result files on {address}. Press Ctrl+C to stop.")
+            try: 
+                serve_queries(service, args.host, args.port, args.socket_path, args.reload_seconds)
+            except KeyboardInterrupt: 
+                print("Query service stopped.")
+
+        case 'daemon':
+            spool = open_spool(args.spool_dir)
+            print(f"Running jobs submitted to {(args.spool_dir / 'incoming').resolve()}, {args.max_jobs} at once. Press Ctrl+C to stop.")
+            try: 
+                run_spool(
+                    spool, lambda job: run_job(job_args(parser, job, args)), args.max_jobs, args.poll_seconds, EXCLUSIVE_JOB_ACTIONS
+                )
+            except KeyboardInterrupt: 
+                print(f"Daemon stopped after {sum(spool['jobs'].values())} jobs.")
+
         case 'generate-matches':
             if ( not args.output_path ) : 
                 parser.error("The 'generate' action requires --output_path.")
@@ -116,9 +379,9 @@ def main():
             print("Starting match generation...")
             if args.n_million is not None and args.n_million > 0: 
                 print("Generating Millions of matchs takes time and can take several minutes to complete.\n In the mean time, you can grab a coffee ...")
-                generate_millions_matchs(args.n_million, args.output_path, args.corruption_ratio)
+                generate_millions_matchs(args.n_million, args.output_path, args.corruption_ratio, args.n_workers, args.seed)
             else : 
-                store_matches(args.output_path, generate_matches(args.n_matches, args.corruption_ratio))
+                store_matches(args.output_path, generate_matches(args.n_matches, args.corruption_ratio, args.seed))
             print("Match generation completed.")
             
         case 'dummy': 
@@ -126,5 +389,37 @@ def main():
             generate_dummy_daily_results()
             print("Dummy daily results generated.")
 
+        case 'benchmark': 
+            output_path = args.output_path or DEFAULT_BENCHMARK_PATH
+            print("Benchmarking the processing pipeline, fixtures are generated on the first run...")
+            benchmark = run_benchmark(
+                args.scales, 
+                args.corruption_ratios, 
+                args.chunk_sizes, 
+                args.n_workers_sweep, 
+                [args.spill_format], 
+                args.partition_rows_sweep, 
+                seed=args.seed if args.seed is not None else DEFAULT_SEED,
+                repeats=args.repeats
+            )
+            store_benchmark(output_path, benchmark)
+            print(f"Benchmark completed. Find your results at {output_path.resolve()}")
+
+            if args.baseline_path: 
+                comparisons = compare_benchmark(benchmark, json.loads(args.baseline_path.read_text()), args.tolerance)
+                if not comparisons: 
+                    print(f"No benchmark record matches a record of {args.baseline_path}, nothing was compared.")
+                    sys.exit(1)
+                for comparison in comparisons: 
+                    print(
+                        f"{'REGRESSION' if comparison['regression'] else 'ok':<10} "
+                        f"{comparison['n_matches']:>8} matches, corruption {comparison['corruption_ratio']}, "
+                        f"chunk {comparison['chunk_size']}, {comparison['partition_rows']} rows/partition, {comparison['n_workers']} workers, {comparison['stage']:<12} "
+                        f"time x{comparison['time_ratio']:.2f} (max x{comparison['time_threshold']:.2f}), "
+                        f"peak RSS x{comparison['rss_ratio']:.2f} (max x{comparison['rss_threshold']:.2f})"
+                    )
+                if any(comparison['regression'] for comparison in comparisons): 
+                    sys.exit(1)
+
 if __name__ == '__main__': 
     main()
\ No newline at end of file
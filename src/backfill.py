@@ -0,0 +1,190 @@
+import logging
+import os
+import re
+import psutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List
+
+from src import daily_processor as processor
+from src.misc import DEFAULT_SPILL_FORMAT
+from src.rolling import parse_date, format_date
+from src.spill import open_spill, close_spill
+from src.result_cache import cache_get, cache_put, daily_results_key, DEFAULT_CACHE_MAX_MB
+from src.daily_partials import staging_partials_dir, commit_day_partials, has_source_partials
+
+DEFAULT_LOG_DIR = Path('data/logs/')
+# Daily logs are named after their day, e.g. `matches20241027.log`, `matches20241027.log.gz` or `matches20241027.parquet`
+_LOG_DATE_PATTERN = re.compile(r'(\d{8})(\.log(\.gz|\.zst)?|\.parquet|\.arrow|\.ipc|\.feather)$')
+
+def days_between(from_date: str, to_date: str) -> List[str]:
+    """ Days from `from_date` to `to_date` included, as `YYYYMMDD`. """
+    from_day, to_day = parse_date(from_date), parse_date(to_date)
+    if from_day > to_day:
+        raise ValueError(f"{from_date} is after {to_date}.")
+    return [ format_date(from_day + timedelta(days=offset)) for offset in range((to_day - from_day).days + 1) ]
+
+def discover_daily_logs(log_dir: Path, from_date: str, to_date: str) -> Dict[str, Path]:
+    """ Find the daily logs of `log_dir` dated from `from_date` to `to_date` included. """
+    days = set(days_between(from_date, to_date))
+    daily_logs = {}
+    for log_path in log_dir.iterdir():
+        match = _LOG_DATE_PATTERN.search(log_path.name)
+        if match and match.group(1) in days:
+            if match.group(1) in daily_logs:
+                raise ValueError(f"Several logs in {log_dir} for {match.group(1)}: {daily_logs[match.group(1)]} and {log_path}")
+            daily_logs[match.group(1)] = log_path
+    return dict(sorted(daily_logs.items()))
+
+def plan_parallel_days(n_days: int, n_workers: int, chunk_size: int, max_memory_mb: float = None) -> int:
+    """
+    Number of days processed concurrently: as many as the workers allow, bounded
+    by the memory budget divided by the estimated peak memory of a day.
+    Default memory budget is the memory available on the machine.
+    """
+    max_memory = max_memory_mb * 1024 * 1024 if max_memory_mb else psutil.virtual_memory().available
+    day_memory = chunk_size * processor.BYTES_PER_CHUNK_ROW
+    if day_memory > max_memory:
+        logging.warning(
+            "Estimated memory of a day (%.0f MB) exceeds the budget (%.0f MB), lower the chunk size",
+            day_memory / (1024 * 1024), max_memory / (1024 * 1024)
+        )
+    return max(1, min(n_days, n_workers, int(max_memory // day_memory)))
+
+def _process_day(
+    log_path: Path,
+    str_date: str,
+    chunk_size: int,
+    spill_format: str,
+    n_workers: int,
+    partition_rows: int,
+    max_memory_mb: float,
+    spill_dir: Path,
+    max_spill_mb: float,
+    cache_dir: Path,
+    cache_max_mb: float,
+    full_hash: bool,
+    partials_dir: Path
+) -> Counter:
+    """ Process the log of one day and store its daily results and partials, in a worker process, unless they are cached. """
+    daily_key = daily_results_key([ log_path ], list(processor.DAILY_METRICS), full_hash)
+    cached = None
+    if cache_dir is not None and (partials_dir is None or has_source_partials(partials_dir, str_date, daily_key)):
+        cached = cache_get(cache_dir, daily_key)
+
+    if cached is not None:
+        daily_metrics, metadata = cached
+        rejections = Counter(metadata['rejections'])
+        logging.info("Daily results of %s found in cache %s", str_date, daily_key)
+    else:
+        rejections = Counter()
+        settings = {}
+        staging_dir = staging_partials_dir(partials_dir, str_date) if partials_dir is not None else None
+        spill = open_spill(spill_dir, max_spill_mb)
+        try:
+            partition_map = processor.partition_log_file(
+                log_path, chunk_size, spill_format, rejections, n_workers, 
+                partition_rows=partition_rows, max_memory_mb=max_memory_mb, spill=spill, settings=settings
+            )
+            daily_metrics = processor.compute_daily_metrics(partition_map, n_workers=n_workers, spill=spill, partials_dir=staging_dir)
+        finally:
+            logging.info("Spill of %s: %s", str_date, close_spill(spill))
+        if cache_dir is not None:
+            cache_put(cache_dir, daily_key, daily_metrics, { 'log_path': log_path, 'rejections': dict(rejections) }, cache_max_mb)
+
+    processor.store_daily_operator_top_100(daily_metrics['operator_top_100'], str_date)
+    processor.store_daily_match_top_10(daily_metrics['match_top_10'], str_date)
+    if cached is None and staging_dir is not None:
+        commit_day_partials(staging_dir, partials_dir, str_date, settings['n_partitions'], daily_key)
+    return rejections
+
+def backfill_daily_results(
+    daily_logs: Dict[str, Path],
+    chunk_size: int = 10**7,
+    spill_format: str = DEFAULT_SPILL_FORMAT,
+    n_workers: int = None,
+    max_memory_mb: float = None,
+    partition_rows: int = processor.DEFAULT_PARTITION_ROWS,
+    spill_dir: Path = None,
+    max_spill_mb: float = None,
+    cache_dir: Path = None,
+    cache_max_mb: float = DEFAULT_CACHE_MAX_MB,
+    full_hash: bool = False,
+    partials_dir: Path = None
+) -> Dict[str, Counter]:
+    """
+    Process several daily logs concurrently and store their daily results.
+
+    Days run in separate processes, as many at once as `plan_parallel_days` allows,
+    and share the workers: each day aggregates its partitions with its share of
+    `n_workers` threads. With a memory budget, each day gets its share of it, see
+    `partition_log_file`, and likewise of the spill cap. Largest logs are started first, so the whole backfill
+    takes close to the time of the slowest day. A day that fails is logged and
+    left out, the other days still complete. With a `cache_dir`, days whose log is 
+    unchanged since their results were cached are not processed again, see 
+    `result_cache.daily_results_key`. With a `partials_dir`, the partials of each 
+    day are kept in it, so that days can be amended, see `daily_partials`.
+
+    Parameters:
+    -----------
+    daily_logs : Dict[str, Path]
+        Log path of each day, as `YYYYMMDD`, see `discover_daily_logs`.
+    chunk_size : int, optional
+        Number of rows per chunk when reading a log. Default is 10 million rows.
+    spill_format : str, optional
+        Format of the partition temporary files. Default is 'ipc'.
+    n_workers : int, optional
+        Total number of workers over all days. Default is the number of CPUs.
+    max_memory_mb : float, optional
+        Total memory budget over all days, in MB. Default is the available memory.
+    partition_rows : int, optional
+        Target number of rows per partition. Default is 500k rows.
+    spill_dir : Path, optional
+        Directory of the spill files. Default is the system temporary directory.
+    max_spill_mb : float, optional
+        Total cap of the spill files over all days, in MB. Default is no cap.
+    cache_dir : Path, optional
+        Directory of the result cache. Default is no cache.
+    cache_max_mb : float, optional
+        Size of the result cache, in MB. Default is 1024 MB.
+    full_hash : bool, optional
+        Fingerprint the logs with a hash of their full content. Default is a sampled hash.
+    partials_dir : Path, optional
+        Directory of the partials of each day. Default is not to keep them.
+
+    Returns:
+    --------
+    Dict[str, Counter]
+        Validation rejection counts of each processed day, see `scan_matches`.
+    """
+    n_workers = n_workers or os.cpu_count()
+    n_parallel_days = plan_parallel_days(len(daily_logs), n_workers, chunk_size, max_memory_mb)
+    n_day_workers = max(1, n_workers // n_parallel_days)
+    day_max_memory_mb = max_memory_mb / n_parallel_days if max_memory_mb else None
+    day_max_spill_mb = max_spill_mb / n_parallel_days if max_spill_mb else None
+    logging.info("Backfilling %s days, %s at a time with %s workers each", len(daily_logs), n_parallel_days, n_day_workers)
+
+    largest_first = sorted(daily_logs.items(), key=lambda item: item[1].stat().st_size, reverse=True)
+    rejections = {}
+
+    # Polars is not fork-safe, workers are started with spawn
+    with ProcessPoolExecutor(max_workers=n_parallel_days, mp_context=get_context('spawn')) as executor:
+        futures = {
+            executor.submit(
+                _process_day, log_path, str_date, chunk_size, spill_format, n_day_workers, partition_rows, 
+                day_max_memory_mb, spill_dir, day_max_spill_mb, cache_dir, cache_max_mb, full_hash, partials_dir
+            ): str_date
+            for str_date, log_path in largest_first
+        }
+        for future in as_completed(futures):
+            str_date = futures[future]
+            try:
+                rejections[str_date] = future.result()
+                logging.info("Backfilled %s, validation: %s", str_date, dict(rejections[str_date]))
+            except Exception as e:
+                logging.error("Error backfilling %s: %s", str_date, e)
+
+    return dict(sorted(rejections.items()))
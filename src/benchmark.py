@@ -0,0 +1,369 @@
+import json
+import logging
+import os
+import platform
+import threading
+import time
+import psutil
+import polars as pl
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from itertools import product
+from multiprocessing import get_context
+from pathlib import Path
+from statistics import median
+from tempfile import gettempdir, TemporaryDirectory
+from typing import Dict, List
+
+from src import daily_processor as processor
+from src.daily_results import store_daily_result
+from src.matches import generate_matches, generate_millions_matchs, store_matches
+from src.misc import store_format_operator_top_100, store_format_match_top_10, DEFAULT_SPILL_FORMAT
+from src.queries import merge_results_operator_top_100, merge_results_match_top_10
+from src.rolling import update_rolling_windows, format_date, DEFAULT_WINDOW_DAYS
+from src.spill import open_spill, close_spill
+
+DEFAULT_SCALES = [10**3, 10**5, 10**6]
+DEFAULT_CORRUPTION_RATIOS = [0, 0.001]
+DEFAULT_CHUNK_SIZES = [10**6, 10**7]
+DEFAULT_FIXTURE_DIR = Path('data/benchmark/fixtures/')
+DEFAULT_SEED = 42
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_REPEATS = 3
+
+# Interval between two RSS samples, in seconds
+_RSS_SAMPLING_INTERVAL = 0.01
+# Stages faster than this, in seconds, are too noisy to report a time regression
+_MIN_COMPARED_SECONDS = 0.05
+# Measures of a stage summarized over the repeated runs of a configuration
+_SUMMARIZED_MEASURES = ['seconds', 'cpu_seconds', 'rows_per_s', 'peak_rss_mb', 'temp_bytes']
+# Settings identifying a benchmark record, used to match records against a baseline
+_RECORD_KEYS = ['n_matches', 'corruption_ratio', 'chunk_size', 'partition_rows', 'n_workers', 'spill_format', 'stage']
+# Settings of the records of benchmarks run before the setting was introduced
+_RECORD_DEFAULTS = { 'partition_rows': processor.DEFAULT_PARTITION_ROWS, 'spill_format': DEFAULT_SPILL_FORMAT }
+# Fewest runs of a record from which its noise is estimated
+_MIN_NOISE_RUNS = 3
+# Largest share of the noise of both benchmarks added to the regression threshold
+_MAX_NOISE_ALLOWANCE = 0.2
+
+def _dir_size(dir_path: Path) -> int:
+    """ Total size in bytes of the files directly in a directory. """
+    total_size = 0
+    for entry in os.scandir(dir_path):
+        try:
+            if entry.is_file(follow_symlinks=False):
+                total_size += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+    return total_size
+
+@contextmanager
+def _measure(records: List[dict], settings: dict, stage: str, rows_in: int = 0):
+    """
+    Measure a stage: wall time, process CPU time, peak RSS (sampled in a background
+    thread) and bytes added to the system temporary directory. Yields a dictionary
+    where the stage sets its 'rows_out' (and 'rows_in' if only known once it ran), 
+    the record is appended to `records` on exit.
+    """
+    process = psutil.Process()
+    peak_rss = process.memory_info().rss
+    stop = threading.Event()
+
+    def _sample_rss():
+        nonlocal peak_rss
+        while not stop.wait(_RSS_SAMPLING_INTERVAL):
+            peak_rss = max(peak_rss, process.memory_info().rss)
+
+    sampler = threading.Thread(target=_sample_rss, daemon=True)
+    stage_result = { 'rows_in': rows_in, 'rows_out': 0 }
+    temp_size = _dir_size(Path(gettempdir()))
+    cpu_times = process.cpu_times()
+    start = time.perf_counter()
+    sampler.start()
+
+    try:
+        yield stage_result
+    finally:
+        seconds = time.perf_counter() - start
+        end_cpu_times = process.cpu_times()
+        stop.set()
+        sampler.join()
+        peak_rss = max(peak_rss, process.memory_info().rss)
+
+        records.append({
+            **settings,
+            'stage': stage,
+            'seconds': seconds,
+            'cpu_seconds': (end_cpu_times.user - cpu_times.user) + (end_cpu_times.system - cpu_times.system),
+            'rows_in': stage_result['rows_in'],
+            'rows_out': stage_result['rows_out'],
+            'rows_per_s': stage_result['rows_in'] / seconds if seconds > 0 else None,
+            'peak_rss_mb': peak_rss / (1024 * 1024),
+            'temp_bytes': _dir_size(Path(gettempdir())) - temp_size,
+        })
+
+def generate_fixture(
+    fixture_dir: Path,
+    n_matches: int,
+    corruption_ratio: float,
+    seed: int = DEFAULT_SEED
+) -> Path:
+    """ Generate a seeded log file, or reuse it if it was already generated with the same settings. """
+    path = fixture_dir / f'matches_{n_matches}_{corruption_ratio}_{seed}.log'
+    if path.exists():
+        return path
+
+    if n_matches >= 10**6 and n_matches % 10**6 == 0:
+        generate_millions_matchs(n_matches // 10**6, path, corruption_ratio, seed=seed)
+    else:
+        store_matches(path, generate_matches(n_matches, corruption_ratio, seed))
+
+    return path
+
+def _benchmark_pipeline(
+    records: List[dict],
+    settings: dict,
+    log_path: Path,
+    work_dir: Path
+) -> None:
+    """ Run and measure each stage of the daily pipeline on a log file. """
+    rejections = Counter()
+    spill = open_spill()
+    with _measure(records, settings, 'partition') as stage:
+        partition_map = processor.partition_log_file(
+            log_path, settings['chunk_size'], settings['spill_format'], rejections, 
+            partition_rows=settings['partition_rows'], spill=spill
+        )
+        stage['rows_in'] = rejections['rows']
+        stage['rows_out'] = rejections['rows'] - rejections['rejected']
+
+    with _measure(records, settings, 'aggregation', rejections['rows'] - rejections['rejected']) as stage:
+        daily_metrics = processor.compute_daily_metrics(partition_map, n_workers=settings['n_workers'], spill=spill)
+        stage['rows_out'] = sum(df.height for df in daily_metrics.values())
+    close_spill(spill)
+
+    # Store the day as every day of a rolling window, to benchmark a full window merge
+    daily_dirs = {
+        'operator_top_100': work_dir / 'daily' / 'operator_top_100',
+        'match_top_10': work_dir / 'daily' / 'match_top_10',
+    }
+    end_date = date.today()
+    with _measure(records, settings, 'store_daily', stage['rows_out']) as stage:
+        for offset in range(DEFAULT_WINDOW_DAYS):
+            str_date = format_date(end_date - timedelta(days=offset))
+            for name, daily_dir in daily_dirs.items():
+                store_daily_result(daily_dir / f'{str_date}.csv', daily_metrics[name])
+        stage['rows_out'] = DEFAULT_WINDOW_DAYS * sum(df.height for df in daily_metrics.values())
+
+    with _measure(records, settings, 'rolling', stage['rows_out']) as stage:
+        rolling_results = update_rolling_windows(
+            work_dir / 'rolling_state',
+            daily_dirs,
+            format_date(end_date),
+            {
+                'operator_top_100': merge_results_operator_top_100,
+                'match_top_10': merge_results_match_top_10
+            }
+        )
+        stage['rows_out'] = sum(df.height for df in rolling_results.values())
+
+    with _measure(records, settings, 'output', stage['rows_out']) as stage:
+        store_format_operator_top_100(work_dir / 'operator_top100.txt', rolling_results['operator_top_100'])
+        store_format_match_top_10(work_dir / 'match_top10.txt', rolling_results['match_top_10'])
+        stage['rows_out'] = stage['rows_in']
+
+def _run_pipeline(settings: dict, log_path: Path) -> List[dict]:
+    """ Run and measure each stage of the daily pipeline once, in a worker process. """
+    records = []
+    with TemporaryDirectory() as work_dir:
+        _benchmark_pipeline(records, settings, log_path, Path(work_dir))
+    return records
+
+def _run_isolated(settings: dict, log_path: Path) -> List[dict]:
+    """
+    Run the pipeline in a fresh process, so that its peak RSS does not depend on the 
+    memory kept by the runs before it, nor its time on their warm caches.
+    """
+    # Polars is not fork-safe, the process is started with spawn
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(_run_pipeline, settings, log_path).result()
+
+def _summarize_runs(runs: List[List[dict]]) -> List[dict]:
+    """
+    Summarize the records of repeated runs stage by stage: the median of each measure, 
+    and its value in every run in '<measure>_runs', from which its noise is estimated.
+    """
+    records = []
+    for stage_records in zip(*runs):
+        record = dict(stage_records[0])
+        for measure in _SUMMARIZED_MEASURES:
+            values = [ stage_record[measure] for stage_record in stage_records ]
+            record[measure] = median(values) if None not in values else None
+            record[f'{measure}_runs'] = values
+        records.append(record)
+    return records
+
+def run_benchmark(
+    scales: List[int] = None,
+    corruption_ratios: List[float] = None,
+    chunk_sizes: List[int] = None,
+    n_workers_list: List[int] = None,
+    spill_formats: List[str] = None,
+    partition_rows_list: List[int] = None,
+    fixture_dir: Path = DEFAULT_FIXTURE_DIR,
+    seed: int = DEFAULT_SEED,
+    repeats: int = DEFAULT_REPEATS
+) -> Dict:
+    """
+    Benchmark the daily pipeline over a grid of fixtures and settings.
+
+    For each fixture scale and corruption ratio, a seeded log file is generated (and
+    cached in `fixture_dir`), then the pipeline runs `repeats` times per combination of 
+    chunk size, target partition size, number of workers and spill format, each run in 
+    a fresh process. Each stage (partition, aggregation, store_daily, rolling, output) 
+    is measured separately, and its measures are the median over the runs.
+
+    Parameters:
+    -----------
+    scales : List[int], optional
+        Numbers of matches of the fixtures. Default is 1k, 100k and 1M matches.
+    corruption_ratios : List[float], optional
+        Corruption ratios of the fixtures. Default is 0 and 0.001.
+    chunk_sizes : List[int], optional
+        Chunk sizes of the partition stage. Default is 1M and 10M rows.
+    n_workers_list : List[int], optional
+        Numbers of workers of the aggregation stage. Default is the number of CPUs.
+    spill_formats : List[str], optional
+        Formats of the partition temporary files. Default is 'ipc'.
+    partition_rows_list : List[int], optional
+        Target numbers of rows per partition of the partition stage. Default is 500k rows.
+    fixture_dir : Path, optional
+        Directory where fixtures are generated and cached.
+    seed : int, optional
+        Seed of the fixtures.
+    repeats : int, optional
+        Number of runs of each combination. Default is 3.
+
+    Returns:
+    --------
+    Dict
+        Machine description and one record per combination and stage, with 'seconds',
+        'cpu_seconds', 'rows_in', 'rows_out', 'rows_per_s', 'peak_rss_mb' and 'temp_bytes',
+        and the value of each measure in every run in 'seconds_runs', 'peak_rss_mb_runs'...
+    """
+    records = []
+
+    for n_matches, corruption_ratio in product(scales or DEFAULT_SCALES, corruption_ratios or DEFAULT_CORRUPTION_RATIOS):
+        log_path = generate_fixture(fixture_dir, n_matches, corruption_ratio, seed)
+
+        for chunk_size, partition_rows, n_workers, spill_format in product(
+            chunk_sizes or DEFAULT_CHUNK_SIZES,
+            partition_rows_list or [processor.DEFAULT_PARTITION_ROWS],
+            n_workers_list or [os.cpu_count()],
+            spill_formats or [DEFAULT_SPILL_FORMAT]
+        ):
+            settings = {
+                'n_matches': n_matches,
+                'corruption_ratio': corruption_ratio,
+                'chunk_size': chunk_size,
+                'partition_rows': partition_rows,
+                'n_workers': n_workers,
+                'spill_format': spill_format,
+            }
+            runs = [ _run_isolated(settings, log_path) for _ in range(repeats) ]
+            records.extend(_summarize_runs(runs))
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'polars': pl.__version__,
+            'cpu_count': os.cpu_count(),
+            'total_ram_mb': psutil.virtual_memory().total / (1024 * 1024),
+        },
+        'seed': seed,
+        'repeats': repeats,
+        'records': records,
+    }
+
+def store_benchmark(path: Path, benchmark: Dict) -> None:
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(benchmark, indent=2))
+
+def _noise(record: dict, measure: str) -> float:
+    """
+    Relative median absolute deviation of a measure over the runs of a record, which an 
+    outlier run does not inflate. 0 for a record of fewer than `_MIN_NOISE_RUNS` runs.
+    """
+    values = record.get(f'{measure}_runs') or [ record[measure] ]
+    if len(values) < _MIN_NOISE_RUNS or record[measure] <= 0:
+        return 0
+    center = median(values)
+    return median(abs(value - center) for value in values) / record[measure]
+
+def _threshold(record: dict, baseline_record: dict, measure: str, tolerance: float) -> float:
+    noise_allowance = min(_noise(record, measure) + _noise(baseline_record, measure), _MAX_NOISE_ALLOWANCE)
+    return 1 + tolerance + noise_allowance
+
+def compare_benchmark(
+    benchmark: Dict,
+    baseline: Dict,
+    tolerance: float = DEFAULT_TOLERANCE
+) -> List[dict]:
+    """
+    Compare a benchmark against a baseline benchmark, record by record, on the median 
+    of their runs.
+
+    Returns:
+    --------
+    List[dict]
+        One comparison per record found in both benchmarks, with the baseline and
+        current 'seconds' and 'peak_rss_mb', their ratios, and 'regression' set when
+        a ratio exceeds its threshold: 1 + `tolerance`, plus the relative median absolute 
+        deviation of the measure over the runs of both benchmarks, up to 0.2, so that 
+        noise is not reported as a regression. Time regressions are not reported for 
+        stages that took less than 50ms in both benchmarks. Records without a baseline 
+        record are logged.
+    """
+    def _key(record: dict) -> tuple:
+        # Records of benchmarks run before a setting was introduced do not have it
+        return tuple(record.get(key, _RECORD_DEFAULTS.get(key)) for key in _RECORD_KEYS)
+
+    baseline_records = { _key(record): record for record in baseline['records'] }
+    comparisons = []
+    unmatched = []
+
+    for record in benchmark['records']:
+        baseline_record = baseline_records.get(_key(record))
+        if baseline_record is None:
+            unmatched.append(_key(record))
+            continue
+
+        time_ratio = record['seconds'] / baseline_record['seconds'] if baseline_record['seconds'] > 0 else 1
+        rss_ratio = record['peak_rss_mb'] / baseline_record['peak_rss_mb'] if baseline_record['peak_rss_mb'] > 0 else 1
+        time_threshold = _threshold(record, baseline_record, 'seconds', tolerance)
+        rss_threshold = _threshold(record, baseline_record, 'peak_rss_mb', tolerance)
+
+        comparisons.append({
+            **dict(zip(_RECORD_KEYS, _key(record))),
+            'baseline_seconds': baseline_record['seconds'],
+            'seconds': record['seconds'],
+            'time_ratio': time_ratio,
+            'time_threshold': time_threshold,
+            'baseline_peak_rss_mb': baseline_record['peak_rss_mb'],
+            'peak_rss_mb': record['peak_rss_mb'],
+            'rss_ratio': rss_ratio,
+            'rss_threshold': rss_threshold,
+            'regression': (
+                (time_ratio > time_threshold and max(record['seconds'], baseline_record['seconds']) >= _MIN_COMPARED_SECONDS) or 
+                rss_ratio > rss_threshold
+            ),
+        })
+
+    if unmatched:
+        logging.warning("%s of %s benchmark records have no baseline record, e.g. %s", len(unmatched), len(benchmark['records']), unmatched[0])
+    return comparisons
@@ -0,0 +1,251 @@
+import json
+import logging
+import shutil
+import polars as pl
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from src.queries import (
+    encode_ids,
+    partition_by_match_hash,
+    PARTITION_SCHEME,
+    operator_kills_partials,
+    merge_operator_kills_partials,
+    operator_top_100_from_partials,
+    merge_results_operator_top_100,
+    player_kills_partials,
+    merge_player_kills_partials,
+    match_top_10_from_partials,
+    merge_results_match_top_10,
+)
+from src.matches import iter_matches_chunks, resolve_log_paths
+from src.misc import store_atomic
+from src.result_cache import fingerprint_file
+from src.rolling import parse_date, MAX_WINDOW_DAYS
+
+PARTIALS_FILE = 'partials.json'
+
+# Mergeable partial aggregates kept for each partition: name -> (partition query, merge query)
+DAILY_PARTIALS = {
+    'operator_partials': (operator_kills_partials, merge_operator_kills_partials),
+    'player_partials': (player_kills_partials, merge_player_kills_partials),
+}
+# Daily metrics computed again from the partial aggregates: name -> (partials name, query, merge query)
+METRICS_FROM_PARTIALS = {
+    'operator_top_100': ('operator_partials', operator_top_100_from_partials, merge_results_operator_top_100),
+    'match_top_10': ('player_partials', match_top_10_from_partials, merge_results_match_top_10),
+}
+
+def _partials_file(key: int, name: str, version: int = 0) -> str:
+    return f'{key}_{name}_{version}.parquet'
+
+def day_partials_dir(partials_dir: Path, str_date: str) -> Path:
+    return partials_dir / str_date
+
+def staging_partials_dir(partials_dir: Path, str_date: str) -> Path:
+    """ Empty directory where a run writes the partials of a day, until they are committed. """
+    staging_dir = partials_dir / f'.{str_date}.tmp'
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    staging_dir.mkdir(parents=True)
+    return staging_dir
+
+def store_partition_partials(staging_dir: Path, key: int, frames: Dict[str, pl.DataFrame]) -> None:
+    """ Store the partial aggregates and the metric results of a partition, see `commit_day_partials`. """
+    for name, frame in frames.items():
+        frame.write_parquet(staging_dir / _partials_file(key, name))
+
+def _load_partials(day_dir: Path) -> Dict:
+    partials_path = day_dir / PARTIALS_FILE
+    if not partials_path.exists():
+        raise FileNotFoundError(
+            f"No partial aggregates in {day_dir}, process the log of the day again to be able to amend it."
+        )
+    return json.loads(partials_path.read_text())
+
+def _store_partials(day_dir: Path, partials: Dict) -> None:
+    store_atomic(day_dir / PARTIALS_FILE, json.dumps(partials).encode())
+
+def commit_day_partials(staging_dir: Path, partials_dir: Path, str_date: str, n_partitions: int, source: str = None) -> None:
+    """
+    Replace the partials of a day by the ones a run wrote in `staging_dir`, see
+    `compute_daily_metrics`. Partition `key` of the run belongs to the hash partition
+    `key % n_partitions` of the match IDs, see `partition_by_match_hash`, whose scheme
+    is recorded with the partials. `source` identifies the logs of the run, see
+    `has_source_partials`.
+
+    Partials are kept for `MAX_WINDOW_DAYS` days, the partials of older days are removed.
+    """
+    if not staging_dir.exists():
+        # Already committed, by a run interrupted right after
+        return
+
+    keys = {}
+    for path in staging_dir.glob('*.parquet'):
+        key, file_name = path.name.split('_', 1)
+        keys.setdefault(key, {})[file_name.rsplit('_', 1)[0]] = path.name
+
+    _store_partials(staging_dir, {
+        'n_partitions': n_partitions,
+        'partition_scheme': PARTITION_SCHEME,
+        'source': source,
+        'keys': keys,
+        'amendments': []
+    })
+
+    day_dir = day_partials_dir(partials_dir, str_date)
+    if day_dir.exists():
+        shutil.rmtree(day_dir)
+    shutil.move(staging_dir, day_dir)
+
+    oldest_day = parse_date(str_date) - timedelta(days=MAX_WINDOW_DAYS - 1)
+    for old_day_dir in partials_dir.glob('[0-9]' * 8):
+        if parse_date(old_day_dir.name) < oldest_day:
+            shutil.rmtree(old_day_dir)
+
+def has_source_partials(partials_dir: Path, str_date: str, source: str) -> bool:
+    """
+    Whether the partials of a day were computed from the logs `source`, with the current
+    partitioning of the match IDs, and not amended since.
+    """
+    partials_path = day_partials_dir(partials_dir, str_date) / PARTIALS_FILE
+    if source is None or not partials_path.exists():
+        return False
+    partials = json.loads(partials_path.read_text())
+    return (
+        partials['source'] == source and
+        partials.get('partition_scheme') == PARTITION_SCHEME and
+        not partials['amendments']
+    )
+
+def _delta_partials(log_paths: List[Path], n_partitions: int, chunksize: int, rejections: Counter) -> Dict[str, Dict[int, pl.DataFrame]]:
+    """ Partial aggregates of delta logs, a chunk at a time, by hash partition of the match IDs. """
+    delta_partials = { name: None for name in DAILY_PARTIALS }
+    for log_path in log_paths:
+        for _, lazy_chunk in iter_matches_chunks(log_path, chunksize, rejections):
+            chunk = lazy_chunk.pipe(encode_ids).collect()
+            chunk_partials = pl.collect_all([ function(chunk.lazy()) for function, _ in DAILY_PARTIALS.values() ])
+            for (name, (_, merge_function)), chunk_partial in zip(DAILY_PARTIALS.items(), chunk_partials):
+                if delta_partials[name] is not None:
+                    chunk_partial = merge_function([ delta_partials[name].lazy(), chunk_partial.lazy() ]).collect()
+                delta_partials[name] = chunk_partial
+
+    return {
+        name: {
+            partition: partial
+            for (partition, ), partial in partition_by_match_hash(delta_partial.lazy(), n_partitions).collect()
+            .partition_by('partition', as_dict=True, include_key=False).items()
+        } if delta_partial is not None else {}
+        for name, delta_partial in delta_partials.items()
+    }
+
+def day_results(day_dir: Path) -> Dict[str, pl.DataFrame]:
+    """ Daily metrics of a day, merged from the metric results of its partitions. """
+    partials = _load_partials(day_dir)
+    return {
+        name: merge_function([
+            pl.scan_parquet(day_dir / files[name]) for files in partials['keys'].values()
+        ]).collect()
+        for name, (_, _, merge_function) in METRICS_FROM_PARTIALS.items()
+    }
+
+def amend_day_partials(
+    day_dir: Path,
+    delta_log_path: Path,
+    chunksize: int = 10**7,
+    rejections: Counter = None
+) -> Dict[str, pl.DataFrame]:
+    """
+    Merge the rows of a delta log, e.g. late arriving rows, into the partials of a
+    day and return its amended daily metrics.
+
+    The delta is aggregated into sum and count partials, hashed to the partitions
+    of the day, and merged into the partials of the partitions it touches only,
+    so that means stay exact. The metric results of these partitions are computed
+    again from their partials, and the daily metrics are merged from the results
+    of every partition, which are top-k results. Amending therefore costs in
+    proportion to the delta, and to the partitions it touches. Partials stored
+    with another partitioning scheme can not be amended.
+
+    New files are written next to the old ones, then the partials file is replaced
+    atomically, so that an interrupted amendment leaves the day unchanged. Delta
+    files already merged into the day, by their content hash, are not merged again.
+
+    Parameters:
+    -----------
+    day_dir : Path
+        Directory of the partials of the day, see `day_partials_dir`.
+    delta_log_path : Path
+        Path to the delta log, or to a directory or glob pattern of delta shards.
+    chunksize : int, optional
+        Number of rows per chunk when reading the delta log. Default is 10 million rows.
+    rejections : Counter, optional
+        Updated with the validation rejection counts of the delta, see `scan_matches`.
+
+    Returns:
+    --------
+    Dict[str, pl.DataFrame]
+        Dictionary mapping each metric name to its amended daily result.
+    """
+    rejections = rejections if rejections is not None else Counter()
+    partials = _load_partials(day_dir)
+    n_partitions = partials['n_partitions']
+    if partials.get('partition_scheme') != PARTITION_SCHEME:
+        # The delta would be merged into the partials of other matches
+        raise ValueError(
+            f"Partials in {day_dir} are partitioned by {partials.get('partition_scheme', 'polars hash')}, "
+            f"not {PARTITION_SCHEME}, process the log of the day again to be able to amend it."
+        )
+
+    delta_hashes = {
+        fingerprint_file(log_path, full_hash=True)['hash']: log_path for log_path in resolve_log_paths(delta_log_path)
+    }
+    delta_hashes = { delta_hash: log_path for delta_hash, log_path in delta_hashes.items() if delta_hash not in partials['amendments'] }
+    if not delta_hashes:
+        logging.warning("Delta %s already merged into %s", delta_log_path, day_dir)
+        return day_results(day_dir)
+
+    delta_partials = _delta_partials(list(delta_hashes.values()), n_partitions, chunksize, rejections)
+    touched_partitions = sorted(set().union(*( delta_partial.keys() for delta_partial in delta_partials.values() )))
+    version = len(partials['amendments']) + 1
+
+    amended_keys = {}
+    for partition in touched_partitions:
+        keys = [ key for key in partials['keys'] if int(key) % n_partitions == partition ]
+        frames = {}
+        for name, (_, merge_function) in DAILY_PARTIALS.items():
+            stored_partials = [ pl.scan_parquet(day_dir / partials['keys'][key][name]) for key in keys ]
+            delta_partial = delta_partials[name][partition].lazy()
+            if stored_partials:
+                # Columns of the delta in the order and types of the stored partials
+                delta_partial = delta_partial.select(
+                    pl.col(col_name).cast(dtype) for col_name, dtype in stored_partials[0].collect_schema().items()
+                )
+            frames[name] = merge_function(stored_partials + [ delta_partial ]).collect()
+        for name, (partials_name, function, _) in METRICS_FROM_PARTIALS.items():
+            frames[name] = function(frames[partials_name].lazy()).collect()
+
+        # Splits of a partition are merged into a single one
+        amended_keys[partition] = keys
+        for name, frame in frames.items():
+            frame.write_parquet(day_dir / _partials_file(partition, name, version))
+
+    replaced_files = [
+        file_name for keys in amended_keys.values() for key in keys for file_name in partials['keys'][key].values()
+    ]
+    for partition, keys in amended_keys.items():
+        for key in keys:
+            del partials['keys'][key]
+        partials['keys'][str(partition)] = {
+            name: _partials_file(partition, name, version) for name in [ *DAILY_PARTIALS, *METRICS_FROM_PARTIALS ]
+        }
+    partials['amendments'].extend(delta_hashes.keys())
+    _store_partials(day_dir, partials)
+
+    for file_name in replaced_files:
+        (day_dir / file_name).unlink(missing_ok=True)
+    logging.info("Amended %s partitions of %s with %s", len(touched_partitions), day_dir, delta_log_path)
+
+    return day_results(day_dir)
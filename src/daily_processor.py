@@ -1,91 +1,623 @@
+import logging
+import os
+import psutil
+import threading
 import polars as pl
 from pathlib import Path
-from typing import Callable, Dict
+from typing import Callable, Dict, List, Tuple
+from collections import Counter
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-from src.queries import partition_by_match_prefix, operator_top_100, match_top_10, merge_results_operator_top_100, merge_results_match_top_10
-from src.misc import store_tempfile
-from src.matches import scan_matches
+from src.queries import partition_by_match_hash, operator_top_100, match_top_10, merge_results_operator_top_100, merge_results_match_top_10, prune_operator_top_100, prune_match_top_10
+from src.misc import scan_tempfile, DEFAULT_SPILL_FORMAT
+from src.matches import iter_matches_chunks, resolve_log_paths, estimate_log_rows, MATCHES_ENCODED_SCHEMA
+from src.run_manifest import (
+    store_manifest,
+    spill_dir,
+    finished_chunks,
+    record_chunk,
+    forget_chunks,
+    chunk_partition_paths,
+    finished_partitions,
+    record_partition,
+    finished_aggregates,
+    record_aggregate,
+)
+from src.spill import open_spill, spill_frame, adopt_file, release
 from src.daily_results import store_daily_result
+from src.daily_partials import store_partition_partials, DAILY_PARTIALS
+from src.instrumentation import span, peak_rss_mb
 
-def partition_log_file(log_path: Path, chunksize:int =10**7) -> Dict[str, str] : 
+# Number of partial results accumulated before they are merged together
+_REDUCE_BATCH_SIZE = 64
+# Target number of rows of a partition, about 10k matches
+DEFAULT_PARTITION_ROWS = 500_000
+# Upper bound of the number of partitions, and so of open partition files
+MAX_PARTITIONS = 4096
+# Peak memory per row of a chunk being read, validated and partitioned, in bytes, including 
+# the raw block, the parsed frame and the memory the allocator keeps from the previous chunk
+BYTES_PER_CHUNK_ROW = 550
+# Peak memory per row of a partition being merged or aggregated with its partials, in bytes
+_BYTES_PER_PARTITION_ROW = 400
+# Share of the available memory given to the chunks, the rest to the partitions: the allocator 
+# keeps most of the memory of the chunks when the partitions are aggregated
+_CHUNK_MEMORY_SHARE = 0.5
+# Share of the budget targeted when chunks or partitions are shrunk after going over it
+_BUDGET_MARGIN = 0.9
+# Smallest chunk or partition size they are shrunk to, in rows, as the cost of smaller ones outweighs their memory
+_MIN_BUDGETED_ROWS = 10_000
+# Bytes of the match ID splitting the partitions that exceed the memory budget, 
+# independent of the leading ones that chose the partition
+_SPLIT_BYTES_OFFSET = 12
+
+# Metrics computed on each partition: name -> (partition query, merge query, prune query)
+DAILY_METRICS = {
+    'operator_top_100': (operator_top_100, merge_results_operator_top_100, prune_operator_top_100),
+    'match_top_10': (match_top_10, merge_results_match_top_10, prune_match_top_10),
+}
+
+def plan_partitions(log_paths: List[Path], partition_rows: int = DEFAULT_PARTITION_ROWS) -> int: 
+    """ Number of partitions of a log, from its estimated number of rows and the target partition size. """
+    estimated_rows = sum(estimate_log_rows(log_path) for log_path in log_paths)
+    return max(1, min(MAX_PARTITIONS, -(-estimated_rows // partition_rows)))
+
+def plan_memory_budget(
+    max_memory_mb: float,
+    chunksize: int,
+    partition_rows: int,
+    n_readers: int = 1,
+    n_workers: int = None
+) -> Tuple[int, int, int]: 
+    """
+    Fit the chunk size and the partition size to a memory budget of the whole process.
+
+    The budget left once the memory already used by the process is subtracted is 
+    split between the `n_readers` chunks read and partitioned at once and the 
+    `n_workers` partitions merged or aggregated at once, see `_CHUNK_MEMORY_SHARE`.
+
+    Returns:
+    --------
+    Tuple[int, int, int]
+        Chunk size and target partition size, both in rows, and the maximum number 
+        of rows of a partition: larger partitions are split when they are merged.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    rss = psutil.Process().memory_info().rss
+    available = max_memory_mb * 1024 * 1024 - rss
+    if available <= 0: 
+        raise ValueError(
+            f"Memory budget of {max_memory_mb:.0f} MB is below the memory already used by the process ({rss / (1024 * 1024):.0f} MB)."
+        )
+
+    budget_chunksize = max(1, min(chunksize, int(available * _CHUNK_MEMORY_SHARE // (n_readers * BYTES_PER_CHUNK_ROW))))
+    max_partition_rows = max(1, int(available * (1 - _CHUNK_MEMORY_SHARE) // (n_workers * _BYTES_PER_PARTITION_ROW)))
+    logging.info(
+        "Memory budget of %.0f MB: chunks of %s rows, partitions of %s rows at most",
+        max_memory_mb, budget_chunksize, max_partition_rows
+    )
+    return budget_chunksize, min(partition_rows, max_partition_rows), max_partition_rows
+
+def _budgeted_size(max_memory_mb: float, size: int, size_name: str) -> Callable[[], int]: 
+    """
+    Size of the next chunk or partition, in rows, for a memory budget of the process. 
+
+    Sizes planned up front are estimates: every call checks whether the previous chunk 
+    or partition raised the peak RSS of the process over the budget, and if so shrinks 
+    the size in proportion to the overshoot, over the RSS at the first call. Sizes are
+    left as they are if this RSS is already over the budget, as smaller ones would not help.
+    """
+    state = { 'size': size, 'base_rss_mb': None, 'peak_rss_mb': None }
+    lock = threading.Lock()
+
+    def _size() -> int: 
+        with lock: 
+            peak = peak_rss_mb()
+            if state['peak_rss_mb'] is None: 
+                state['base_rss_mb'] = psutil.Process().memory_info().rss / (1024 * 1024)
+            elif peak > state['peak_rss_mb'] and peak > max_memory_mb > state['base_rss_mb']: 
+                ratio = (max_memory_mb - state['base_rss_mb']) / (peak - state['base_rss_mb'])
+                shrunk_size = max(_MIN_BUDGETED_ROWS, int(state['size'] * ratio * _BUDGET_MARGIN))
+                logging.warning(
+                    "Peak RSS of %.0f MB over the memory budget of %.0f MB, %s shrunk from %s to %s rows",
+                    peak, max_memory_mb, size_name, state['size'], shrunk_size
+                )
+                state['size'] = min(state['size'], shrunk_size)
+            state['peak_rss_mb'] = max(state['peak_rss_mb'] or peak, peak)
+            return state['size']
+
+    return _size
+
+def _spill_log_file(
+    log_path: Path, 
+    chunksize: int | Callable[[], int], 
+    spill_format: str,
+    rejections: Counter,
+    n_partitions: int,
+    spill: Dict,
+    manifest: Dict = None
+) -> Dict[int, List[str]]: 
+    """ 
+    Partition a log file by match hash into spill files, one per partition and chunk.
+    If the log can not be read, the spill files already written are released, 
+    unless they are recorded in a run manifest to be resumed.
+    """
+    chunked_partition_map = {}
+
+    if manifest is not None: 
+        _spill_chunks(log_path, chunksize, spill_format, rejections, n_partitions, chunked_partition_map, spill, manifest)
+        return chunked_partition_map
+
+    try: 
+        _spill_chunks(log_path, chunksize, spill_format, rejections, n_partitions, chunked_partition_map, spill)
+    except BaseException: 
+        release(spill, [ path for paths in chunked_partition_map.values() for path in paths ])
+        raise
+
+    return chunked_partition_map
+
+def _spill_chunks(
+    log_path: Path, 
+    chunksize: int | Callable[[], int], 
+    spill_format: str,
+    rejections: Counter,
+    n_partitions: int,
+    chunked_partition_map: Dict[int, List[str]],
+    spill: Dict,
+    manifest: Dict = None
+) -> None: 
+    """ Spill the chunks of a log, skipping and reusing the chunks already recorded in the run manifest. """
+    done_chunks = finished_chunks(manifest, log_path) if manifest is not None else {}
+    for chunk in done_chunks.values(): 
+        rejections.update(chunk['rejections'])
+        for partition, path in chunk_partition_paths(manifest, chunk).items(): 
+            adopt_file(spill, path)
+            chunked_partition_map.setdefault(partition, []).append(path)
+
+    # Counts of the current chunk only, recorded with its spill files
+    chunk_rejections = Counter()
+
+    for byte_range, lazy_chunk in iter_matches_chunks( log_path, chunksize, chunk_rejections, skip=done_chunks ):
+        
+        with span('partition_spill') as record: 
+            partitionned_chunk = partition_by_match_hash(lazy_chunk, n_partitions).collect()
+            partitions = partitionned_chunk.partition_by('partition', as_dict=True, include_key=False)
+            record['rows_in'] = partitionned_chunk.height
+            record['rows_out'] = len(partitions)
+
+            partition_paths = {
+                partition: spill_frame(spill, partition_df, 'partition_spill', spill_format)
+                for (partition, ), partition_df in partitions.items()
+            }
+            if manifest is not None: 
+                record_chunk(manifest, log_path, byte_range, partition_paths, chunk_rejections)
+
+            for partition, path in partition_paths.items(): 
+                chunked_partition_map.setdefault(partition, []).append(path)
+            rejections.update(chunk_rejections)
+            chunk_rejections.clear()
+
+        # Released before the next chunk is read, rather than when they are replaced
+        del lazy_chunk, partitionned_chunk, partitions
+
+def _spill_log_files(
+    log_paths: List[Path], 
+    chunksize: int | Callable[[], int], 
+    spill_format: str,
+    rejections: Counter,
+    n_workers: int = None,
+    shard_progress: Dict[str, dict] = None,
+    n_partitions: int = 1,
+    spill: Dict = None,
+    manifest: Dict = None
+) -> Dict[int, List[str]]: 
+    """
+    Partition several log shards concurrently, largest first, into the same partitions. 
+    A shard that fails is logged, recorded in `shard_progress` and left out, its 
+    spill files are released, and the other shards still complete. The chunks of
+    a failed shard are also dropped from the run manifest, as the day is merged without it.
     """
-    Partition a large log file into temporary files based on the match ID prefix. Each partition corresponds to
-    a unique match prefix to facilitate efficient, prefix-based processing of the data.
+    shard_progress = shard_progress if shard_progress is not None else {}
+    chunked_partition_map = {}
+
+    def _spill_shard(log_path: Path) -> Tuple[Dict[int, List[str]], Counter]: 
+        shard_rejections = Counter()
+        shard_progress[str(log_path)]['status'] = 'running'
+        with span('partition_shard', shard=log_path) as record: 
+            shard_partition_map = _spill_log_file(log_path, chunksize, spill_format, shard_rejections, n_partitions, spill, manifest)
+            record.update(rows_in=shard_rejections['rows'], rows_out=shard_rejections['rows'] - shard_rejections['rejected'])
+        return shard_partition_map, shard_rejections
+
+    for log_path in log_paths: 
+        shard_progress[str(log_path)] = { 'status': 'pending' }
+
+    largest_first = sorted(log_paths, key=lambda log_path: log_path.stat().st_size, reverse=True)
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count() or 1) as executor: 
+        futures = { executor.submit(_spill_shard, log_path): log_path for log_path in largest_first }
+        for future in as_completed(futures): 
+            progress = shard_progress[str(futures[future])]
+            try: 
+                shard_partition_map, shard_rejections = future.result()
+            except Exception as e: 
+                logging.error("Error partitioning shard %s: %s", futures[future], e)
+                progress.update(status='failed', error=repr(e))
+                if manifest is not None: 
+                    release(spill, forget_chunks(manifest, futures[future]))
+                continue
+
+            for partition, paths in shard_partition_map.items(): 
+                chunked_partition_map.setdefault(partition, []).extend(paths)
+            rejections.update(shard_rejections)
+            progress.update(status='done', rows=shard_rejections['rows'], rejected=shard_rejections['rejected'])
+
+    return chunked_partition_map
+
+def partition_log_file(
+    log_path: Path, 
+    chunksize:int =10**7, 
+    spill_format: str = DEFAULT_SPILL_FORMAT,
+    rejections: Counter = None,
+    n_workers: int = None,
+    shard_progress: Dict[str, dict] = None,
+    partition_rows: int = DEFAULT_PARTITION_ROWS,
+    max_memory_mb: float = None,
+    manifest: Dict = None,
+    spill: Dict = None,
+    settings: Dict = None
+) -> Dict[int, str] : 
+    """
+    Partition a large log file into temporary files based on a hash of the match ID. Each partition holds
+    every row of its matches, so that metrics can be computed partition by partition.
+
+    The number of partitions is chosen from the estimated number of rows of the log, 
+    so that partitions hold about `partition_rows` rows (up to `MAX_PARTITIONS` partitions).
+    Each chunk is split with a single vectorized `partition_by`.
+
+    With a memory budget, chunks and partitions are sized to fit in it, see 
+    `plan_memory_budget`, and a partition that still exceeds it, e.g. because the 
+    log size was underestimated, is split into smaller partitions. The peak RSS is 
+    checked after every chunk and partition, and the next ones are shrunk if it went 
+    over the budget.
+
+    The log may be split into shards: a directory or a glob pattern of log files is 
+    processed as a single log, its shards being partitioned concurrently by worker 
+    threads into the same partitions, see `resolve_log_paths`.
+
+    Spill files are released as soon as the next stage read them: chunk files once 
+    their partition is merged, split files once merged. The merged partition files 
+    are left to the caller, see `compute_daily_metrics`.
+
+    With a run manifest, see `run_manifest.open_run`, spill files are written to the 
+    run spill directory and every ingested chunk and merged partition is recorded as it 
+    completes. A resumed run reuses the settings of the manifest, so that chunks and 
+    partitions are the same, and skips the recorded chunks and partitions.
 
     Parameters:
     -----------
     log_path : Path
-        Path to the main log file that will be partitioned.
+        Path to the main log file that will be partitioned, or a directory or glob pattern of log shards.
     chunksize : int, optional
         Number of rows per chunk when reading the log file in batches. Default is 10 million rows.
+    spill_format : str, optional
+        Format of the temporary files, one of 'ipc', 'parquet' or 'csv'. Default is 'ipc'.
+    rejections : Counter, optional
+        Updated with the validation rejection counts, see `scan_matches`.
+    n_workers : int, optional
+        Number of shards partitioned concurrently. Default is the number of CPUs.
+    shard_progress : Dict[str, dict], optional
+        Updated with the progress of each shard, as it is partitioned: its 'status' 
+        ('pending', 'running', 'done' or 'failed'), and its 'rows' and 'rejected' 
+        rows once done, or its 'error' if it failed.
+    partition_rows : int, optional
+        Target number of rows per partition. Default is 500k rows.
+    max_memory_mb : float, optional
+        Memory budget of the process, in MB. Default is no budget.
+    manifest : Dict, optional
+        Run manifest recording the progress of the run. Default is no manifest.
+    spill : Dict, optional
+        Spill of the run, see `spill.open_spill`. Default is a spill in the system temporary 
+        directory, or in the run spill directory with a run manifest.
+    settings : Dict, optional
+        Updated with the settings of the run, as recorded in the manifest: its 'chunksize', 
+        'spill_format', 'n_partitions' and 'max_partition_rows'.
 
     Returns:
     --------
-    Dict[str, str]
-        Dictionary mapping each unique match prefix to the path of its corresponding temporary file.
+    Dict[int, str]
+        Dictionary mapping each partition to the path of its corresponding temporary file.
     """
-    chunked_partition_map = {}
-    partition_map = {}
+    rejections = rejections if rejections is not None else Counter()
+    log_paths = resolve_log_paths(log_path)
+    if spill is None: 
+        spill = open_spill(spill_dir(manifest) if manifest is not None else None)
 
-    for lazy_chunk in scan_matches( log_path, chunksize ):
-        
-        partitionned_chunk = partition_by_match_prefix(lazy_chunk).collect()
-
-        for match_prefix, player_id, match_ids, operator_id, nb_kills in partitionned_chunk.iter_rows(): 
-            if not (match_prefix in chunked_partition_map) : 
-                chunked_partition_map[match_prefix] = []
-            
-            tempfile_path = store_tempfile(
-                pl.DataFrame({
-                    'player_id': player_id,
-                    'match_id': match_ids,
-                    'operator_id': operator_id,
-                    'nb_kills': nb_kills
-                })
+    if manifest is not None and manifest['settings'] is not None: 
+        run_settings = manifest['settings']
+        chunksize, spill_format = run_settings['chunksize'], run_settings['spill_format']
+        n_partitions, max_partition_rows = run_settings['n_partitions'], run_settings['max_partition_rows']
+    else: 
+        max_partition_rows = None
+        if max_memory_mb is not None: 
+            # Shards are read concurrently, each with a chunk in memory
+            n_readers = min(len(log_paths), n_workers or os.cpu_count() or 1)
+            chunksize, partition_rows, max_partition_rows = plan_memory_budget(
+                max_memory_mb, chunksize, partition_rows, n_readers, n_workers
             )
-            chunked_partition_map[match_prefix].append(tempfile_path)
+        n_partitions = plan_partitions(log_paths, partition_rows)
+        run_settings = {
+            'chunksize': chunksize,
+            'spill_format': spill_format,
+            'n_partitions': n_partitions,
+            'max_partition_rows': max_partition_rows,
+        }
+
+        if manifest is not None: 
+            manifest['settings'] = run_settings
+            store_manifest(manifest)
+    if settings is not None: 
+        settings.update(run_settings)
 
-    for match_prefix, paths in chunked_partition_map.items(): 
-        lazy_concat = pl.concat(
-            [ pl.scan_csv(path) for path in paths ],
-            how='vertical'
+    if max_memory_mb is not None: 
+        # Shrunk as the log is read if the planned sizes go over the budget
+        chunksize = _budgeted_size(max_memory_mb, chunksize, 'chunks')
+        if max_partition_rows is not None: 
+            max_partition_rows = _budgeted_size(max_memory_mb, max_partition_rows, 'partitions')
+
+    if len(log_paths) == 1: 
+        chunked_partition_map = _spill_log_file(log_paths[0], chunksize, spill_format, rejections, n_partitions, spill, manifest)
+    else: 
+        chunked_partition_map = _spill_log_files(
+            log_paths, chunksize, spill_format, rejections, n_workers, shard_progress, n_partitions, spill, manifest
         )
-        tempfile_path = store_tempfile(lazy_concat.collect())
-        partition_map[match_prefix] = tempfile_path
+
+    with span('partition_merge', rows_in=len(chunked_partition_map), n_partitions=n_partitions) as record: 
+        partition_map = _merge_partitions(chunked_partition_map, spill_format, n_partitions, spill, max_partition_rows, manifest)
+        record['rows_out'] = len(partition_map)
 
     return partition_map
 
-def _partition_apply(partition_map: Dict[str, str], function: Callable) -> Dict[str, pl.LazyFrame]: 
-    """ Apply a function to each partition in the partition map. """
-    lazy_map = { key: '' for key in partition_map.keys() }
+def _split_partition(paths: List[str], n_splits: int, spill_format: str, spill: Dict) -> List[List[str]]: 
+    """ Split the chunk files of a partition into `n_splits` partitions by other bytes of the match ID, a chunk file at a time. """
+    split_paths = [ [] for _ in range(n_splits) ]
+    for path in paths: 
+        chunk = partition_by_match_hash(
+            scan_tempfile(path, MATCHES_ENCODED_SCHEMA), n_splits, _SPLIT_BYTES_OFFSET
+        ).collect()
+        for (split, ), split_df in chunk.partition_by('partition', as_dict=True, include_key=False).items(): 
+            split_paths[split].append(spill_frame(spill, split_df, 'partition_split', spill_format))
+    return split_paths
+
+def _merge_partitions(
+    chunked_partition_map: Dict[int, List[str]], 
+    spill_format: str,
+    n_partitions: int,
+    spill: Dict,
+    max_partition_rows: int | Callable[[], int] = None,
+    manifest: Dict = None
+) -> Dict[int, str]: 
+    """
+    Merge the chunk files of each partition into a single file, and release the chunk 
+    files. Partitions of more than `max_partition_rows` rows, or `max_partition_rows()` 
+    rows for the next partition, are first split, split `i` of partition `p` is 
+    numbered `p + i * n_partitions`. With a run manifest, merged 
+    partitions are recorded before their chunk files are released, and skipped when resumed.
+    """
+    partition_map = {}
+    done_partitions = finished_partitions(manifest) if manifest is not None else {}
+    for partition, merged_paths in done_partitions.items(): 
+        for path in merged_paths.values(): 
+            adopt_file(spill, path)
+        partition_map.update(merged_paths)
+        release(spill, chunked_partition_map.get(partition, []))
+
+    for partition, chunk_paths in chunked_partition_map.items(): 
+        if partition in done_partitions: 
+            continue
 
-    for idx, partition_path in partition_map.items(): 
-        partition = pl.scan_csv(partition_path)
-        partition_result = function(partition)
+        split_paths = [ chunk_paths ]
+        if max_partition_rows is not None: 
+            max_rows = max_partition_rows() if callable(max_partition_rows) else max_partition_rows
+            nb_rows = pl.concat(
+                [ scan_tempfile(path, MATCHES_ENCODED_SCHEMA) for path in chunk_paths ], how='vertical'
+            ).select(pl.len()).collect().item()
+            if nb_rows > max_rows: 
+                split_paths = _split_partition(chunk_paths, -(-nb_rows // max_rows), spill_format, spill)
+                logging.info("Partition %s of %s rows split in %s partitions", partition, nb_rows, len(split_paths))
 
-        lazy_map[idx] = partition_result
+        merged_paths = {}
+        for split, paths in enumerate(split_paths): 
+            if not paths: 
+                continue
+            lazy_concat = pl.concat(
+                [ scan_tempfile(path, MATCHES_ENCODED_SCHEMA) for path in paths ],
+                how='vertical'
+            )
+            merged_paths[partition + split * n_partitions] = spill_frame(
+                spill, lazy_concat.collect(), 'partition_merge', spill_format
+            )
+            if paths is not chunk_paths: 
+                release(spill, paths)
 
-    return lazy_map
+        partition_map.update(merged_paths)
+        if manifest is not None: 
+            record_partition(manifest, partition, merged_paths)
+        release(spill, chunk_paths)
 
+    return partition_map
 
-def compute_daily_operator_top_100(partition_map: Dict[str, str]) -> pl.DataFrame:
-    lazy_map = _partition_apply(partition_map, operator_top_100)
+def _own_buffers(frame: pl.DataFrame) -> pl.DataFrame: 
+    """ 
+    Copy a frame into buffers of its own. The binary columns of a query result are views 
+    into the buffers of the whole partition it was computed from, which would otherwise 
+    be kept in memory for as long as the result. 
+    """
+    return pl.read_ipc(frame.write_ipc(None))
 
-    lazy_result = merge_results_operator_top_100(
-        [ partition_operator_top_100 for partition_operator_top_100 in lazy_map.values() ]
-    )
+def _reduce(partial_results: List[pl.DataFrame], merge_function: Callable) -> pl.DataFrame: 
+    """ Merge partial results into a single, bounded, partial result. """
+    with span('merge', rows_in=sum(partial_result.height for partial_result in partial_results)) as record: 
+        result = merge_function(
+            [ partial_result.lazy() for partial_result in partial_results ]
+        ).collect()
+        record['rows_out'] = result.height
+        return result
 
-    return lazy_result.collect()
 
+def _partition_apply(
+    partition_map: Dict[int, str], 
+    metrics: Dict[str, Tuple[Callable, Callable, Callable]],
+    n_workers: int = None,
+    max_in_flight: int = None,
+    manifest: Dict = None,
+    spill: Dict = None,
+    partials_dir: Path = None
+) -> Dict[str, pl.DataFrame]: 
+    """
+    Compute every metric on each partition in the partition map and merge the results.
 
-def compute_daily_match_top_10(partition_map: Dict[str, str]) -> pl.DataFrame:
-    lazy_map = _partition_apply(partition_map, match_top_10)
+    Each partition file is read once, and all the metric queries run on that 
+    single in-memory copy. Partitions are processed by a pool of worker threads 
+    (polars releases the GIL while collecting). At most `max_in_flight` partitions 
+    are submitted at once, and the small per-partition results are folded into a 
+    running partial result with each metric merge query as they complete, so 
+    memory stays bounded whatever the number of partitions. Once a running result 
+    exists, the prune query drops the rows of new partial results that rank below 
+    its k-th best row, before they are merged.
+
+    With a run manifest, the results of each partition are recorded, and the 
+    partitions already aggregated by an interrupted run are not read again. 
+    Otherwise, with the spill of the run, each partition file is released once 
+    aggregated.
+
+    With a `partials_dir`, the mergeable partial aggregates of each partition 
+    (`DAILY_PARTIALS`) are computed in the same pass and stored in it with the 
+    metric results of the partition, so that the day can be amended later, see 
+    `daily_partials.amend_day_partials`.
+
+    Parameters:
+    -----------
+    partition_map : Dict[int, str]
+        Dictionary mapping each partition to the path of its partition file.
+    metrics : Dict[str, Tuple[Callable, Callable, Callable]]
+        Dictionary mapping each metric name to its partition query, merge query and prune query, 
+        e.g. `(operator_top_100, merge_results_operator_top_100, prune_operator_top_100)`.
+    n_workers : int, optional
+        Number of worker threads. Default is the number of CPUs.
+    max_in_flight : int, optional
+        Maximum number of partitions submitted and not yet reduced. Default is twice `n_workers`.
+    manifest : Dict, optional
+        Run manifest recording the progress of the run. Default is no manifest.
+    spill : Dict, optional
+        Spill of the run holding the partition files. Default is to keep the partition files.
+    partials_dir : Path, optional
+        Directory where the partials of each partition are stored. Default is not to compute them.
+
+    Returns:
+    --------
+    Dict[str, pl.DataFrame]
+        Dictionary mapping each metric name to its merged result over every partition.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * n_workers
+
+    def _apply(key: int, partition_path: str) -> List[pl.DataFrame]: 
+        with span('partition_aggregation') as record: 
+            partition = scan_tempfile(partition_path, MATCHES_ENCODED_SCHEMA).collect()
+            functions = [ function for function, _, _ in metrics.values() ]
+            if partials_dir is not None: 
+                functions += [ function for function, _ in DAILY_PARTIALS.values() ]
+            results = pl.collect_all([ function(partition.lazy()) for function in functions ])
+            record['rows_in'] = partition.height
+            record['rows_out'] = sum(result.height for result in results)
+        if partials_dir is not None: 
+            store_partition_partials(partials_dir, key, dict(zip([ *metrics.keys(), *DAILY_PARTIALS.keys() ], results)))
+            results = results[:len(metrics)]
+        # Results are kept until reduced, unlike the partition they were computed from
+        results = [ _own_buffers(result) for result in results ]
+        if manifest is not None: 
+            # Partition files are kept until the run is closed, to resume from them
+            record_aggregate(manifest, key, dict(zip(metrics.keys(), results)))
+        elif spill is not None: 
+            release(spill, [ partition_path ])
+        return results
+
+    def _reduce_all(partial_results: Dict[str, List[pl.DataFrame]]) -> Dict[str, List[pl.DataFrame]]: 
+        return {
+            name: [ _reduce(partial_results[name], merge_function) ]
+            for name, (_, merge_function, _) in metrics.items()
+        }
+
+    done_aggregates = finished_aggregates(manifest, list(metrics.keys())) if manifest is not None else {}
+    partition_items = iter([ (key, path) for key, path in partition_map.items() if key not in done_aggregates ])
+    partial_results = { name: [] for name in metrics.keys() }
+    for results in done_aggregates.values(): 
+        for name, partition_result in zip(metrics.keys(), results): 
+            partial_results[name].append(partition_result)
+    running_results = {}
+    nb_partial_results = len(done_aggregates)
+    in_flight = set()
+
+    if nb_partial_results >= _REDUCE_BATCH_SIZE: 
+        partial_results = _reduce_all(partial_results)
+        running_results = { name: results[0] for name, results in partial_results.items() }
+        nb_partial_results = 1
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor: 
+        while True: 
+            for key, partition_path in islice(partition_items, max_in_flight - len(in_flight)): 
+                in_flight.add(executor.submit(_apply, key, partition_path))
+
+            if not in_flight: 
+                break
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done: 
+                for name, partition_result in zip(metrics.keys(), future.result()): 
+                    prune_function = metrics[name][2]
+                    if name in running_results and prune_function is not None: 
+                        partition_result = prune_function(
+                            partition_result.lazy(), running_results[name].lazy()
+                        ).collect()
+                    partial_results[name].append(partition_result)
+                nb_partial_results += 1
+
+            if nb_partial_results >= _REDUCE_BATCH_SIZE: 
+                partial_results = _reduce_all(partial_results)
+                running_results = { name: results[0] for name, results in partial_results.items() }
+                nb_partial_results = 1
+
+    return { name: results[0] for name, results in _reduce_all(partial_results).items() }
+
+
+def compute_daily_metrics(
+    partition_map: Dict[int, str], 
+    metrics: Dict[str, Tuple[Callable, Callable, Callable]] = None, 
+    n_workers: int = None,
+    manifest: Dict = None,
+    spill: Dict = None,
+    partials_dir: Path = None
+) -> Dict[str, pl.DataFrame]: 
+    """
+    Compute several daily metrics in a single pass over the partitions. 
+    Default metrics are `DAILY_METRICS`, register more metrics there to have 
+    them computed in the same scan. The prune query of a metric may be None.
+    With a run manifest, partitions aggregated by an interrupted run are skipped.
+    With the spill of the run, partition files are released once aggregated.
+    With a `partials_dir`, the partials of each partition are stored in it.
+    """
+    return _partition_apply(partition_map, metrics or DAILY_METRICS, n_workers, manifest=manifest, spill=spill, partials_dir=partials_dir)
+
+
+def compute_daily_operator_top_100(partition_map: Dict[int, str], n_workers: int = None) -> pl.DataFrame:
+    return compute_daily_metrics(
+        partition_map, { 'operator_top_100': DAILY_METRICS['operator_top_100'] }, n_workers
+    )['operator_top_100']
 
-    lazy_result = merge_results_match_top_10(
-        [ partition_match_top_10 for partition_match_top_10 in lazy_map.values() ]
-    )
 
-    return lazy_result.collect()
+def compute_daily_match_top_10(partition_map: Dict[int, str], n_workers: int = None) -> pl.DataFrame:
+    return compute_daily_metrics(
+        partition_map, { 'match_top_10': DAILY_METRICS['match_top_10'] }, n_workers
+    )['match_top_10']
 
 
 def store_daily_operator_top_100(df: pl.DataFrame, str_date: str):
@@ -4,7 +4,7 @@ import polars as pl
 
 from src.matches import scan_matches
 from src.constants import R6_MATCHES_LOG_LOCATION, PREVIOUS_DAYS
-from src.queries import operator_top_100, match_top_10
+from src.queries import operator_top_100, match_top_10, decode_ids
 
 def store_daily_result(
     path: Path, 
@@ -12,7 +12,7 @@ def store_daily_result(
 ) -> None : 
     if not path.parent.exists():
         path.parent.mkdir(parents=True, exist_ok=True)
-    df.write_csv(file=path, include_header=True)
+    decode_ids(df.lazy()).collect().write_csv(file=path, include_header=True)
 
 
 def generate_dummy_daily_results() -> None:
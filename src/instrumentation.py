@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+import psutil
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SPAN_LOGGER_NAME = 'spans'
+
+# Interval between two RSS samples where the peak RSS of the process can not be reset, in seconds
+_RSS_SAMPLING_INTERVAL = 0.01
+_STATUS_PATH = Path('/proc/self/status')
+_CLEAR_REFS_PATH = Path('/proc/self/clear_refs')
+
+_span_logger = logging.getLogger(SPAN_LOGGER_NAME)
+_span_logger.propagate = False
+_current_span = ContextVar('current_span', default=None)
+_process = psutil.Process()
+
+# Peak RSS in MB of the process before the last reset of its high-water mark, and so
+# far of every block tracked by `track_peak_rss`
+_peak_lock = threading.Lock()
+_process_peak_mb = 0
+_tracked_peaks = {}
+_sampler = None
+
+def enable_spans(path: Path) -> None:
+    """ Write every span as a JSON line to `path`, spans are ignored until this is called. """
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _span_logger.addHandler(handler)
+    _span_logger.setLevel(logging.INFO)
+
+def _io_counters() -> tuple[int, int]:
+    """ Bytes read and written by the process so far, or None where not supported. """
+    try:
+        io_counters = _process.io_counters()
+        return io_counters.read_bytes, io_counters.write_bytes
+    except (AttributeError, psutil.Error):
+        return None, None
+
+def _rss_mb() -> float:
+    return _process.memory_info().rss / (1024 * 1024)
+
+def _high_water_mark_mb() -> float:
+    """ Peak RSS of the process since its high-water mark was last reset, in MB, or None where not supported. """
+    try:
+        with open(_STATUS_PATH, 'rb') as status:
+            for line in status:
+                if line.startswith(b'VmHWM:'):
+                    # In kilobytes
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_high_water_mark() -> bool:
+    """ Reset the high-water mark of the process to its current RSS, see proc(5). """
+    try:
+        with open(_CLEAR_REFS_PATH, 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+_RESETTABLE = _high_water_mark_mb() is not None and _reset_high_water_mark()
+
+def _current_peak_mb() -> float:
+    if _RESETTABLE:
+        return _high_water_mark_mb()
+    if resource is None:
+        return _rss_mb()
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of the process so far, in MB, see `track_peak_rss` for the peak of a stage. """
+    with _peak_lock:
+        return max(_process_peak_mb, _current_peak_mb())
+
+def _sample_peaks() -> None:
+    """ Update the peaks of the tracked blocks with the RSS of the process, until none is left. """
+    global _sampler
+    while True:
+        time.sleep(_RSS_SAMPLING_INTERVAL)
+        rss_mb = _rss_mb()
+        with _peak_lock:
+            if not _tracked_peaks:
+                _sampler = None
+                return
+            for key, peak in _tracked_peaks.items():
+                _tracked_peaks[key] = max(peak, rss_mb)
+
+@contextmanager
+def track_peak_rss():
+    """
+    Track the peak RSS of the process while a block runs, set in MB as 'peak_rss_mb' in 
+    the yielded dictionary on exit.
+
+    On Linux, the high-water mark of the process is reset when a block starts, after 
+    being folded into the peaks of the blocks still running and of the process, see 
+    `peak_rss_mb`. Elsewhere the RSS is sampled every 10ms, which may miss short peaks. 
+    The peak is process wide: blocks running concurrently in several threads include 
+    each other's memory.
+    """
+    global _process_peak_mb, _sampler
+    result = { 'peak_rss_mb': None }
+    key = object()
+    with _peak_lock:
+        if _RESETTABLE:
+            high_water_mark = _high_water_mark_mb()
+            _process_peak_mb = max(_process_peak_mb, high_water_mark)
+            for tracked_key, peak in _tracked_peaks.items():
+                _tracked_peaks[tracked_key] = max(peak, high_water_mark)
+            _reset_high_water_mark()
+        _tracked_peaks[key] = _rss_mb()
+        if not _RESETTABLE and _sampler is None:
+            _sampler = threading.Thread(target=_sample_peaks, name='rss_sampler', daemon=True)
+            _sampler.start()
+
+    try:
+        yield result
+    finally:
+        with _peak_lock:
+            peak = _tracked_peaks.pop(key)
+            result['peak_rss_mb'] = max(peak, _high_water_mark_mb() if _RESETTABLE else _rss_mb())
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Measure a pipeline stage and emit it as a JSON line, see `enable_spans`.
+
+    The record holds the wall time, the process CPU time, the peak RSS of the
+    process during the stage, see `track_peak_rss`, the bytes read and written by
+    the process, the enclosing span and the given attributes. The stage can fill
+    the yielded dictionary, e.g. with its 'rows_in' and 'rows_out'.
+
+    Every measure comes from a few system calls at each end of the span, so
+    spans are cheap enough to be left on. CPU time, bytes and peak RSS are process
+    wide: spans running concurrently in several threads include each other's work.
+    """
+    record = { 'rows_in': None, 'rows_out': None, **attributes }
+
+    if not _span_logger.isEnabledFor(logging.INFO):
+        yield record
+        return
+
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    read_bytes, write_bytes = _io_counters()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+
+    try:
+        with track_peak_rss() as memory:
+            yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        wall_s = time.perf_counter() - start
+        cpu_s = time.process_time() - cpu_start
+        end_read_bytes, end_write_bytes = _io_counters()
+        _current_span.reset(token)
+
+        _span_logger.info(json.dumps({
+            'ts': time.time(),
+            'span': name,
+            'parent': parent,
+            'thread': threading.current_thread().name,
+            'wall_s': wall_s,
+            'cpu_s': cpu_s,
+            'peak_rss_mb': memory['peak_rss_mb'],
+            'read_bytes': end_read_bytes - read_bytes if read_bytes is not None else None,
+            'write_bytes': end_write_bytes - write_bytes if write_bytes is not None else None,
+            **record,
+        }, default=str))
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from src.instrumentation import span, peak_rss_mb, track_peak_rss
+from src.misc import store_atomic
+
+DEFAULT_SPOOL_DIR = Path('data/spool/')
+DEFAULT_MAX_JOBS = 1
+DEFAULT_SPOOL_POLL_SECONDS = 0.2
+
+INCOMING_DIR = 'incoming'
+RUNNING_DIR = 'running'
+STATUS_DIR = 'status'
+DAEMON_STATUS_FILE = 'daemon.json'
+
+def open_spool(spool_dir: Path) -> Dict:
+    """
+    Open a job spool: job files are submitted to `incoming/`, moved to `running/` when
+    they start, and their status is written to `status/`, see `run_spool`. Jobs left in
+    `running/` by a daemon that was stopped are submitted again.
+    """
+    for sub_dir in (INCOMING_DIR, RUNNING_DIR, STATUS_DIR):
+        (spool_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+
+    for job_path in (spool_dir / RUNNING_DIR).glob('*.json'):
+        logging.warning("Job %s was interrupted, submitting it again", job_path.stem)
+        os.replace(job_path, spool_dir / INCOMING_DIR / job_path.name)
+
+    return {
+        'spool_dir': spool_dir,
+        'started': time.time(),
+        'jobs': Counter(),
+        'rejections': Counter(),
+        'lock': threading.Lock(),
+        'exclusive_lock': threading.Lock(),
+    }
+
+def _claim_jobs(spool: Dict, n_jobs: int) -> List[str]:
+    """
+    Move up to `n_jobs` submitted jobs to `running/`, oldest file name first. Hidden files
+    are ignored, so that a job can be written to a hidden file and renamed once complete.
+    A job claimed by another daemon on the same spool in the meantime is skipped.
+    """
+    incoming_dir = spool['spool_dir'] / INCOMING_DIR
+    job_ids = []
+    for job_path in sorted(incoming_dir.glob('[!.]*.json')):
+        if len(job_ids) == n_jobs:
+            break
+        try:
+            os.replace(job_path, spool['spool_dir'] / RUNNING_DIR / job_path.name)
+        except FileNotFoundError:
+            continue
+        job_ids.append(job_path.stem)
+    return job_ids
+
+def _store_status(spool: Dict, job_id: str, status: Dict) -> None:
+    store_atomic(spool['spool_dir'] / STATUS_DIR / f'{job_id}.json', json.dumps(status, default=str).encode())
+
+def _store_daemon_status(spool: Dict) -> None:
+    """ Jobs run by status and validation counters summed over the jobs since the daemon started. """
+    with spool['lock']:
+        status = {
+            'pid': os.getpid(),
+            'started': spool['started'],
+            'updated': time.time(),
+            'jobs': dict(spool['jobs']),
+            'rejections': dict(spool['rejections']),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    store_atomic(spool['spool_dir'] / DAEMON_STATUS_FILE, json.dumps(status).encode())
+
+def _run_job(spool: Dict, job_id: str, run_job: Callable[[Dict], Dict], exclusive_actions: tuple) -> None:
+    """
+    Run a claimed job and write its status: 'running', then 'done' with the metrics
+    returned by `run_job` or 'failed' with the error. A job of an `exclusive_actions`
+    waits for the other jobs of these actions to finish. The peak RSS of the job is
+    the peak of the daemon while it ran, including the jobs running at the same time.
+    """
+    job_path = spool['spool_dir'] / RUNNING_DIR / f'{job_id}.json'
+    status = { 'job_id': job_id, 'status': 'running', 'started': time.time() }
+    start = time.perf_counter()
+    memory = { 'peak_rss_mb': None }
+    try:
+        job = json.loads(job_path.read_text())
+        status['job'] = job
+        _store_status(spool, job_id, status)
+
+        exclusive = job.get('action') in exclusive_actions
+        with span('job', job_id=job_id, action=job.get('action')) as record:
+            if exclusive:
+                spool['exclusive_lock'].acquire()
+            try:
+                status['queued_s'] = time.perf_counter() - start
+                with track_peak_rss() as memory:
+                    metrics = run_job(job)
+            finally:
+                if exclusive:
+                    spool['exclusive_lock'].release()
+            record.update(metrics)
+        status.update(status='done', metrics=metrics)
+        logging.info("Job %s done: %s", job_id, metrics)
+    except Exception as e:
+        status.update(status='failed', error=repr(e))
+        logging.error("Job %s failed: %s", job_id, e)
+
+    status.update(finished=time.time(), seconds=time.perf_counter() - start, peak_rss_mb=memory['peak_rss_mb'])
+    _store_status(spool, job_id, status)
+    job_path.unlink()
+
+    with spool['lock']:
+        spool['jobs'][status['status']] += 1
+        spool['rejections'].update(status.get('metrics', {}).get('rejections', {}))
+    _store_daemon_status(spool)
+
+def run_spool(
+    spool: Dict,
+    run_job: Callable[[Dict], Dict],
+    max_jobs: int = DEFAULT_MAX_JOBS,
+    poll_seconds: float = DEFAULT_SPOOL_POLL_SECONDS,
+    exclusive_actions: tuple = (),
+    stop: threading.Event = None
+) -> None:
+    """
+    Run the jobs submitted to a spool until `stop` is set or interrupted, up to `max_jobs`
+    at once, in the order of their file names. A job is a JSON object with an 'action',
+    run by `run_job`, which returns its metrics. The spool is checked for new jobs every
+    `poll_seconds` while a slot is free. Running jobs are finished before returning.
+    """
+    stop = stop or threading.Event()
+    _store_daemon_status(spool)
+    running = set()
+    with ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job') as executor:
+        while not stop.is_set():
+            running = { future for future in running if not future.done() }
+            for job_id in _claim_jobs(spool, max_jobs - len(running)):
+                running.add(executor.submit(_run_job, spool, job_id, run_job, exclusive_actions))
+
+            if len(running) == max_jobs:
+                wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            else:
+                stop.wait(poll_seconds)
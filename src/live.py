@@ -0,0 +1,382 @@
+import json
+import logging
+import os
+import time
+import polars as pl
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict
+
+from src.instrumentation import span
+from src.matches import read_matches_from
+from src.queries import (
+    encode_ids,
+    operator_kills_partials,
+    merge_operator_kills_partials,
+    player_kills_partials,
+    merge_player_kills_partials,
+    match_top_10_from_partials,
+    merge_results_operator_top_100,
+    merge_results_match_top_10,
+    OPERATOR_TOP_K,
+)
+
+DEFAULT_REFRESH_SECONDS = 60
+DEFAULT_CHECKPOINT_SECONDS = 300
+DEFAULT_POLL_SECONDS = 1.0
+# Maximum number of bytes read from the log at once
+DEFAULT_MAX_READ_BYTES = 1 << 28
+# Partials updated since the last compaction are kept apart from the sorted partials, up to this number of rows
+DEFAULT_MAX_OVERLAY_ROWS = 1 << 18
+# Pairs kept in the ranking of each operator, deeper than the top 100 so that pairs whose mean kills drop are replaced
+_OPERATOR_RANKING_K = 4 * OPERATOR_TOP_K
+
+_CHECKPOINT_FILE = 'checkpoint.json'
+
+def empty_live_state(log_path: Path) -> Dict:
+    """
+    Live state of a log file: the byte offset read so far and the partial aggregates
+    of the rows before it, kills sum and count per (match_id, operator_id) and kills
+    sum per (match_id, player_id). Partials can be updated exactly with new rows.
+
+    Partials are sorted by match_id, so that the partials of the matches touched by new
+    rows are found by binary search. The merged partials of these matches are kept in
+    an overlay, superseding the sorted partials, until it is compacted into them.
+    The rankings of the daily metrics are kept with the state and updated from the
+    touched matches only, see `ingest_new_rows`.
+    """
+    return {
+        'log_path': str(log_path),
+        'offset': 0,
+        'operator_partials': None,
+        'player_partials': None,
+        'overlays': { 'operator_partials': None, 'player_partials': None },
+        'rankings': None,
+        'rejections': Counter(),
+    }
+
+def load_checkpoint(checkpoint_dir: Path, log_path: Path) -> Dict:
+    """
+    Load the live state of a log file from its last checkpoint. Starts from an empty
+    state if there is no checkpoint for this log, or if the log is now shorter than
+    the checkpoint offset, i.e. it was truncated or replaced.
+    """
+    checkpoint_path = checkpoint_dir / _CHECKPOINT_FILE
+    if not checkpoint_path.exists():
+        return empty_live_state(log_path)
+
+    checkpoint = json.loads(checkpoint_path.read_text())
+    if checkpoint['log_path'] != str(log_path) or log_path.stat().st_size < checkpoint['offset']:
+        logging.warning("Checkpoint in %s does not match %s, starting from the beginning", checkpoint_dir, log_path)
+        return empty_live_state(log_path)
+
+    operator_partials = pl.read_parquet(checkpoint_dir / checkpoint['operator_partials']).sort('match_id')
+    player_partials = pl.read_parquet(checkpoint_dir / checkpoint['player_partials']).sort('match_id')
+    return {
+        'log_path': checkpoint['log_path'],
+        'offset': checkpoint['offset'],
+        'operator_partials': operator_partials,
+        'player_partials': player_partials,
+        'overlays': { 'operator_partials': operator_partials.clear(), 'player_partials': player_partials.clear() },
+        'rankings': None,
+        'rejections': Counter(checkpoint['rejections']),
+    }
+
+def store_checkpoint(checkpoint_dir: Path, state: Dict) -> None:
+    """
+    Store the live state. Partials are written to new files named after the offset,
+    then the checkpoint file pointing to them is atomically replaced, so a crash
+    never leaves an offset that does not match its partials.
+    """
+    if state['operator_partials'] is None:
+        return
+
+    for name in state['overlays']:
+        _compact(state, name)
+
+    if not checkpoint_dir.exists():
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+    offset = state['offset']
+    operator_file = f'operator_partials_{offset}.parquet'
+    player_file = f'player_partials_{offset}.parquet'
+    state['operator_partials'].write_parquet(checkpoint_dir / operator_file)
+    state['player_partials'].write_parquet(checkpoint_dir / player_file)
+
+    temp_checkpoint_path = checkpoint_dir / f'{_CHECKPOINT_FILE}.tmp'
+    temp_checkpoint_path.write_text(json.dumps({
+        'log_path': state['log_path'],
+        'offset': offset,
+        'operator_partials': operator_file,
+        'player_partials': player_file,
+        'rejections': dict(state['rejections']),
+    }))
+    os.replace(temp_checkpoint_path, checkpoint_dir / _CHECKPOINT_FILE)
+
+    for partials_path in checkpoint_dir.glob('*_partials_*.parquet'):
+        if partials_path.name not in (operator_file, player_file):
+            partials_path.unlink()
+
+def _compact(state: Dict, name: str) -> None:
+    """ Fold the overlay of the partials `name` into the sorted partials. """
+    overlay = state['overlays'][name]
+    if overlay is None or overlay.is_empty():
+        return
+    state[name] = pl.concat([
+        state[name].filter(~pl.col('match_id').is_in(overlay['match_id'])),
+        overlay
+    ]).sort('match_id')
+    state['overlays'][name] = overlay.clear()
+
+def _lookup(state: Dict, name: str, match_ids: pl.Series) -> pl.DataFrame:
+    """ Current partials `name` of the given matches, without scanning the sorted partials. """
+    overlay_rows = state['overlays'][name].filter(pl.col('match_id').is_in(match_ids))
+    match_ids = match_ids.filter(~match_ids.is_in(overlay_rows['match_id']))
+
+    sorted_ids = state[name]['match_id']
+    indices = pl.int_ranges(
+        sorted_ids.search_sorted(match_ids, side='left'),
+        sorted_ids.search_sorted(match_ids, side='right'),
+        eager=True
+    ).explode().drop_nulls()
+    return pl.concat([ overlay_rows, state[name][indices] ])
+
+def _upsert(state: Dict, name: str, new_partials: pl.DataFrame, merge_function: Callable, max_overlay_rows: int) -> pl.DataFrame:
+    """
+    Merge new partials into the partials `name` of the state, only the partials of the
+    matches they touch are merged. Returns the merged partials of these matches.
+    """
+    if state[name] is None:
+        state[name] = new_partials.sort('match_id')
+        state['overlays'][name] = new_partials.clear()
+        return new_partials
+
+    match_ids = new_partials['match_id'].unique()
+    touched = merge_function([ _lookup(state, name, match_ids).lazy(), new_partials.lazy() ]).collect()
+    state['overlays'][name] = pl.concat([
+        state['overlays'][name].filter(~pl.col('match_id').is_in(match_ids)),
+        touched
+    ])
+    if state['overlays'][name].height > max_overlay_rows:
+        _compact(state, name)
+    return touched
+
+def _all_partials(state: Dict, name: str) -> pl.LazyFrame:
+    overlay = state['overlays'][name]
+    return pl.concat([
+        state[name].lazy().filter(~pl.col('match_id').is_in(overlay['match_id'])),
+        overlay.lazy()
+    ])
+
+def _update_match_top_10(match_top_10: pl.DataFrame, touched_player_partials: pl.DataFrame) -> pl.DataFrame:
+    """ Top 10 matches after an update of the partials of some matches. """
+    # The kills of a player only grow, so an untouched match out of the top 10 can not enter it,
+    # only the touched matches are ranked against the current top 10
+    touched = touched_player_partials.lazy().group_by('match_id').agg(pl.col('nb_kills').max())
+    return merge_results_match_top_10([
+        match_top_10.lazy().filter(~pl.col('match_id').is_in(touched_player_partials['match_id'])),
+        touched
+    ]).collect()
+
+def _ranked_above(threshold_kills: pl.Expr, threshold_match_id: pl.Expr) -> pl.Expr:
+    """ Pairs ranked at least as high as the threshold pair, see `_RANKING_BY` in queries. """
+    return (
+        (pl.col('nb_kills') > threshold_kills) | 
+        ((pl.col('nb_kills') == threshold_kills) & (pl.col('match_id') <= threshold_match_id))
+    )
+
+def _operator_ranking(pairs: pl.DataFrame, thresholds: pl.DataFrame = None) -> Dict[str, pl.DataFrame]:
+    """ 
+    Keep the best `_OPERATOR_RANKING_K` pairs of each operator. An operator cut at this 
+    depth gets its last kept pair as threshold: every pair left out ranks below it.
+    """
+    ranking = merge_results_operator_top_100([ pairs.lazy() ], _OPERATOR_RANKING_K).collect()
+    cut_thresholds = (
+        ranking.group_by('operator_id')
+        .agg(
+            pl.col('nb_kills').last().alias('threshold_kills'),
+            pl.col('match_id').last().alias('threshold_match_id'),
+            pl.len().alias('nb_rows')
+        )
+        .filter(pl.col('nb_rows') >= _OPERATOR_RANKING_K)
+        .drop('nb_rows')
+    )
+    if thresholds is not None:
+        cut_thresholds = pl.concat([ thresholds.join(cut_thresholds, on='operator_id', how='anti'), cut_thresholds ])
+    return {
+        'ranking': ranking,
+        'thresholds': cut_thresholds,
+    }
+
+def _rank_operators_from_partials(state: Dict, operator_ids: pl.Series = None) -> Dict[str, pl.DataFrame]:
+    """ Operator ranking from all the partials, of the given operators only if any. """
+    partials = _all_partials(state, 'operator_partials')
+    if operator_ids is not None:
+        partials = partials.filter(pl.col('operator_id').is_in(operator_ids))
+    pairs = partials.select(
+        'operator_id',
+        'match_id',
+        (pl.col('nb_kills_sum') / pl.col('nb_rows')).alias('nb_kills')
+    ).collect()
+    return _operator_ranking(pairs)
+
+def _update_operator_ranking(state: Dict, operator_ranking: Dict[str, pl.DataFrame], touched_operator_partials: pl.DataFrame) -> Dict[str, pl.DataFrame]:
+    """
+    Operator ranking after an update of the partials of some matches.
+
+    The ranking keeps more pairs per operator than the top 100, and every pair of an
+    operator left out of it ranks below the operator threshold. Touched pairs are
+    ranked against the kept pairs, and pairs falling below the threshold are dropped,
+    as pairs left out might now rank higher. The mean kills of a pair can drop, so an
+    operator left with less than 100 pairs above its threshold is ranked again from
+    all its partials, which deep rankings make rare.
+    """
+    touched = touched_operator_partials.select(
+        'operator_id',
+        'match_id',
+        (pl.col('nb_kills_sum') / pl.col('nb_rows')).alias('nb_kills')
+    )
+    thresholds = operator_ranking['thresholds']
+    candidates = (
+        operator_ranking['ranking'].join(touched, on=['operator_id', 'match_id'], how='anti')
+        .vstack(touched)
+        .join(thresholds, on='operator_id', how='left')
+        .filter(
+            pl.col('threshold_kills').is_null() | 
+            _ranked_above(pl.col('threshold_kills'), pl.col('threshold_match_id'))
+        )
+        .drop('threshold_kills', 'threshold_match_id')
+    )
+    stale_operators = (
+        candidates.filter(pl.col('operator_id').is_in(thresholds['operator_id']))
+        .group_by('operator_id')
+        .len()
+        .filter(pl.col('len') < OPERATOR_TOP_K)
+        ['operator_id']
+    )
+    stale_operators = pl.concat([
+        stale_operators,
+        thresholds['operator_id'].filter(~thresholds['operator_id'].is_in(candidates['operator_id']))
+    ])
+    updated = _operator_ranking(candidates.filter(~pl.col('operator_id').is_in(stale_operators)), thresholds.filter(~pl.col('operator_id').is_in(stale_operators)))
+    if stale_operators.is_empty():
+        return updated
+
+    logging.debug("Ranking operators %s again from all partials", stale_operators.to_list())
+    ranked_again = _rank_operators_from_partials(state, stale_operators)
+    return {
+        name: pl.concat([ updated[name], ranked_again[name] ]).sort('operator_id', maintain_order=True)
+        for name in updated
+    }
+
+def ingest_new_rows(state: Dict, max_bytes: int = DEFAULT_MAX_READ_BYTES, max_overlay_rows: int = DEFAULT_MAX_OVERLAY_ROWS) -> int:
+    """
+    Read the rows appended to the log since the state offset, validate them and
+    fold them into the state partials. Only the new rows are parsed and validated,
+    and only the partials and rankings of the matches they touch are updated, so
+    the cost of a poll follows the new rows rather than the size of the day.
+
+    Returns:
+    --------
+    int
+        Number of bytes read.
+    """
+    log_path = Path(state['log_path'])
+    with span('live_ingest') as record:
+        new_rows, offset = read_matches_from(log_path, state['offset'], max_bytes, state['rejections'])
+        record['bytes_in'] = offset - state['offset']
+        if new_rows is None:
+            return 0
+
+        new_rows = new_rows.pipe(encode_ids)
+        new_operator_partials, new_player_partials = pl.collect_all([
+            operator_kills_partials(new_rows),
+            player_kills_partials(new_rows)
+        ])
+
+        touched_operator_partials = _upsert(state, 'operator_partials', new_operator_partials, merge_operator_kills_partials, max_overlay_rows)
+        touched_player_partials = _upsert(state, 'player_partials', new_player_partials, merge_player_kills_partials, max_overlay_rows)
+        record['rows_out'] = touched_operator_partials.height + touched_player_partials.height
+
+        if state['rankings'] is not None:
+            state['rankings'] = {
+                'operators': _update_operator_ranking(state, state['rankings']['operators'], touched_operator_partials),
+                'match_top_10': _update_match_top_10(state['rankings']['match_top_10'], touched_player_partials),
+            }
+
+        bytes_read = offset - state['offset']
+        state['offset'] = offset
+        return bytes_read
+
+def compute_live_metrics(state: Dict) -> Dict[str, pl.DataFrame]:
+    """ 
+    Current daily metrics of the live state, same as `compute_daily_metrics` on the log read so far.
+    Rankings are computed from all the partials once, then kept up to date by `ingest_new_rows`.
+    """
+    if state['rankings'] is None:
+        state['rankings'] = {
+            'operators': _rank_operators_from_partials(state),
+            'match_top_10': match_top_10_from_partials(_all_partials(state, 'player_partials')).collect(),
+        }
+    return {
+        'operator_top_100': merge_results_operator_top_100([ state['rankings']['operators']['ranking'].lazy() ]).collect(),
+        'match_top_10': state['rankings']['match_top_10'],
+    }
+
+def tail_log(
+    log_path: Path,
+    checkpoint_dir: Path,
+    on_refresh: Callable[[Dict[str, pl.DataFrame]], None],
+    refresh_seconds: float = DEFAULT_REFRESH_SECONDS,
+    checkpoint_seconds: float = DEFAULT_CHECKPOINT_SECONDS,
+    poll_seconds: float = DEFAULT_POLL_SECONDS,
+    stop: Callable[[], bool] = None
+) -> Dict:
+    """
+    Follow an append-only log file and keep its daily metrics current.
+
+    Resumes from the last checkpoint in `checkpoint_dir`, then polls the log for new
+    complete lines, which are validated and folded into the live state. Every
+    `refresh_seconds`, if new rows were read, `on_refresh` is called with the current
+    metrics, and every `checkpoint_seconds` the state is checkpointed. Runs until
+    `stop` returns True or the process is interrupted, then refreshes and
+    checkpoints a last time.
+
+    Returns:
+    --------
+    Dict
+        Final live state.
+    """
+    state = load_checkpoint(checkpoint_dir, log_path)
+    last_refresh = last_checkpoint = time.monotonic()
+    has_new_rows = state['operator_partials'] is not None
+
+    def _refresh():
+        nonlocal has_new_rows, last_refresh
+        if has_new_rows:
+            with span('live_refresh', offset=state['offset']):
+                on_refresh(compute_live_metrics(state))
+            has_new_rows = False
+        last_refresh = time.monotonic()
+
+    try:
+        while not (stop and stop()):
+            bytes_read = ingest_new_rows(state)
+            has_new_rows = has_new_rows or bytes_read > 0
+
+            now = time.monotonic()
+            if now - last_refresh >= refresh_seconds:
+                _refresh()
+            if now - last_checkpoint >= checkpoint_seconds:
+                store_checkpoint(checkpoint_dir, state)
+                last_checkpoint = now
+
+            # Keep reading without waiting while the log has a backlog
+            if bytes_read == 0:
+                time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        pass
+
+    _refresh()
+    store_checkpoint(checkpoint_dir, state)
+    return state
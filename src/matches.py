@@ -1,10 +1,53 @@
+import glob
+import gzip
+import os
 import numpy as np
 import polars as pl
-from uuid import uuid4
-from typing import Generator, IO
+from typing import Callable, Collection, Dict, Generator, IO, Iterator, List
+from collections import Counter, deque
+from itertools import islice
+from shutil import copyfileobj
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, SEEK_END
 from pathlib import Path
+from queue import Queue, Full
+from threading import Thread, Event
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd compressed logs
+    zstandard = None
 
 from src.constants import OPERATORS, R6_MATCHES_STATS
+from src.instrumentation import span
+
+UUID_V4_PATTERN = r'^[a-f0-9]{8}-[a-f0-9]{4}-4[a-f0-9]{3}-[89ab][a-f0-9]{3}-[a-f0-9]{12}$'
+
+def _is_uuid_v4(col_name: str) -> pl.Expr: 
+    """ 
+    Check a column holds lowercase UUID v4 strings. 
+    `contains` stops at the anchored match where `count_matches` would keep scanning.
+    """
+    return pl.col(col_name).str.contains(UUID_V4_PATTERN)
+
+def _validation_rules() -> Dict[str, pl.Expr]: 
+    """
+    Validation rules for match data, as a dictionary mapping each rule name to 
+    an expression that is True for rows that pass it. 
+    Value rules are only meant to reject non-null values, nulls are rejected by 
+    the `*_null` rules.
+    """
+    return {
+        'player_id_null': pl.col('player_id').is_not_null(),
+        'match_id_null': pl.col('match_id').is_not_null(),
+        'operator_id_null': pl.col('operator_id').is_not_null(),
+        'nb_kills_null': pl.col('nb_kills').is_not_null(),
+        'player_id_format': _is_uuid_v4('player_id'),
+        'match_id_format': _is_uuid_v4('match_id'),
+        'operator_id_range': pl.col('operator_id').is_in(OPERATORS),
+        'nb_kills_range': pl.col('nb_kills').is_between(R6_MATCHES_STATS['MIN_NB_KILLS'], R6_MATCHES_STATS['MAX_NB_KILLS']),
+    }
 
 def _lazy_validation(df: pl.LazyFrame) -> pl.LazyFrame:
     """
@@ -14,18 +57,137 @@ def _lazy_validation(df: pl.LazyFrame) -> pl.LazyFrame:
     specified range.
     """
 
-    uuid_v4_pattern = r'^[a-f0-9]{8}-[a-f0-9]{4}-4[a-f0-9]{3}-[89ab][a-f0-9]{3}-[a-f0-9]{12}$'
     return df.filter(
-        (pl.col('player_id').is_not_null()) &
-        (pl.col('match_id').is_not_null()) &
-        (pl.col('operator_id').is_not_null()) &
-        (pl.col('nb_kills').is_not_null()) &
-        (pl.col('player_id').str.count_matches(uuid_v4_pattern) == 1) &
-        (pl.col('match_id').str.count_matches(uuid_v4_pattern) == 1) &
-        (pl.col('operator_id').is_in(OPERATORS)) &
-        (pl.col('nb_kills').is_between(R6_MATCHES_STATS['MIN_NB_KILLS'], R6_MATCHES_STATS['MAX_NB_KILLS']))
+        pl.all_horizontal(_validation_rules().values())
     )
 
+def _counted_validation(df: pl.DataFrame, rejections: Counter) -> pl.DataFrame: 
+    """
+    Apply the same validation as `_lazy_validation` on an in-memory DataFrame, and 
+    add the number of rows rejected by each rule to `rejections`. 
+    Each rule is evaluated once, for both the counts and the filter. A row failing 
+    several rules is counted for each of them, and once in 'rejected'.
+    """
+    flags = df.select(
+        expr.fill_null(True).alias(name) 
+        for name, expr in _validation_rules().items()
+    )
+    is_valid = flags.select(pl.all_horizontal(pl.all())).to_series()
+
+    rejections.update(flags.select((~pl.all()).sum()).row(0, named=True))
+    rejections['rows'] += df.height
+    rejections['rejected'] += df.height - is_valid.sum()
+
+    return df.filter(is_valid)
+
+MATCHES_SCHEMA = {
+    'player_id': pl.String,
+    'match_id': pl.String,
+    'operator_id': pl.UInt8,
+    'nb_kills': pl.UInt8,
+}
+
+# Schema once the IDs are encoded as 16 bytes binaries, see `queries.encode_ids`
+MATCHES_ENCODED_SCHEMA = {
+    **MATCHES_SCHEMA,
+    'player_id': pl.Binary,
+    'match_id': pl.Binary,
+}
+
+_CSV_OPTIONS = {
+    'has_header': False,
+    # A full schema, rather than names inferred from the first line, so that a block
+    # starting with a ragged line still has the expected columns
+    'schema': MATCHES_SCHEMA,
+    'truncate_ragged_lines': True,
+    'ignore_errors': True,
+}
+
+# Size of the head sample used to estimate the average row length in bytes
+_ROW_SIZE_SAMPLE_BYTES = 1 << 20
+# Number of decompressed blocks read ahead of the parsing of compressed logs
+_PREFETCHED_BLOCKS = 2
+# Typical ratio of the decompressed to the compressed size of a log
+_COMPRESSION_RATIO_ESTIMATE = 3
+
+def _open_zstd(path: Path) -> IO[bytes]: 
+    if zstandard is None: 
+        raise ImportError("Reading zstd compressed logs requires the 'zstandard' package.")
+    return zstandard.ZstdDecompressor().stream_reader(path.open('rb'), closefd=True)
+
+# Compressed log suffix -> function opening the decompressed stream of a file
+COMPRESSED_LOG_SUFFIXES = {
+    '.gz': gzip.open,
+    '.zst': _open_zstd,
+}
+
+def is_compressed_log(path: Path) -> bool: 
+    return path.suffix in COMPRESSED_LOG_SUFFIXES
+
+# Columnar log format -> lazy scan of a file, and magic bytes its files start with
+COLUMNAR_LOG_FORMATS = {
+    'parquet': (pl.scan_parquet, b'PAR1'),
+    'ipc': (pl.scan_ipc, b'ARROW1'),
+}
+# Columnar log suffix -> format
+COLUMNAR_LOG_SUFFIXES = {
+    '.parquet': 'parquet',
+    '.arrow': 'ipc',
+    '.ipc': 'ipc',
+    '.feather': 'ipc',
+}
+
+def columnar_log_format(path: Path) -> str | None: 
+    """ Format of a Parquet or Arrow IPC log, from its suffix or its magic bytes, or None for a CSV log. """
+    if path.suffix in COLUMNAR_LOG_SUFFIXES: 
+        return COLUMNAR_LOG_SUFFIXES[path.suffix]
+    if is_compressed_log(path): 
+        return None
+
+    with path.open('rb') as file: 
+        head = file.read(max(len(magic) for _, magic in COLUMNAR_LOG_FORMATS.values()))
+    for log_format, (_, magic) in COLUMNAR_LOG_FORMATS.items(): 
+        if head.startswith(magic): 
+            return log_format
+    return None
+
+def _scan_columnar(path: Path, log_format: str) -> pl.LazyFrame: 
+    """
+    Scan a columnar log with the matches schema. Only the columns of another type 
+    are cast, values out of their type range becoming nulls as in a CSV log, so 
+    that filters on the other columns are pushed down to the reader, which skips 
+    the row groups their statistics rule out.
+    """
+    scan, _ = COLUMNAR_LOG_FORMATS[log_format]
+    lazy_log = scan(path)
+    schema = lazy_log.collect_schema()
+
+    missing_columns = [ name for name in MATCHES_SCHEMA if name not in schema ]
+    if missing_columns: 
+        raise ValueError(f"Columnar log {path} has no {missing_columns} columns.")
+
+    return lazy_log.select(
+        pl.col(name) if schema[name] == dtype else pl.col(name).cast(dtype, strict=False)
+        for name, dtype in MATCHES_SCHEMA.items()
+    )
+
+def estimate_log_rows(path: Path) -> int: 
+    """ 
+    Estimate the number of rows of a log file from its size and the average row size of its head. 
+    The number of rows of a columnar log is read from its metadata.
+    """
+    log_format = columnar_log_format(path)
+    if log_format is not None: 
+        return _scan_columnar(path, log_format).select(pl.len()).collect().item()
+
+    if is_compressed_log(path): 
+        with COMPRESSED_LOG_SUFFIXES[path.suffix](path) as stream: 
+            row_size = _sample_row_size(stream.read(_ROW_SIZE_SAMPLE_BYTES))
+        return int(path.stat().st_size * _COMPRESSION_RATIO_ESTIMATE / row_size)
+
+    with path.open('rb') as file: 
+        return int(path.stat().st_size / _estimate_row_size(file))
+
 def _scan_csv(
     path: Path, 
     **kwargs
@@ -33,47 +195,315 @@ def _scan_csv(
     """
     Scan and validate a CSV file as a LazyFrame.
     Scans CSV with specified schema, applies lazy validation, and handles ragged lines.
+    Columnar logs are scanned instead, with the validation pushed down to the reader.
     """
+    log_format = columnar_log_format(path)
+    if log_format is not None: 
+        return _lazy_validation(_scan_columnar(path, log_format))
+
+    if is_compressed_log(path): 
+        # Compressed files can not be scanned lazily, they are decompressed in memory
+        with COMPRESSED_LOG_SUFFIXES[path.suffix](path) as stream: 
+            return _lazy_validation(pl.read_csv(stream, **_CSV_OPTIONS, **kwargs).lazy())
 
     return _lazy_validation(
         pl.scan_csv(
             path, 
-            has_header=False,
-            new_columns=['player_id', 'match_id', 'operator_id', 'nb_kills'],
-            schema_overrides=[pl.String, pl.String, pl.UInt8, pl.UInt8],
-            truncate_ragged_lines=True,
-            ignore_errors=True,
+            **_CSV_OPTIONS,
             **kwargs 
         )
     ) 
 
+def _read_csv_bytes(data: bytes, rejections: Counter = None) -> pl.LazyFrame: 
+    """
+    Parse and validate an in-memory block of CSV lines as a LazyFrame.
+    Uses the same schema and error handling as `_scan_csv`. 
+    If `rejections` is provided, it is updated with the rejection counts of the block.
+    """
+    with span('ingest_chunk', bytes_in=len(data)) as record: 
+        df = pl.read_csv(BytesIO(data), **_CSV_OPTIONS)
+        record['rows_in'] = df.height
+
+        if rejections is None: 
+            return _lazy_validation(df.lazy())
+        
+        valid_df = _counted_validation(df, rejections)
+        record['rows_out'] = valid_df.height
+        return valid_df.lazy()
+
+def _read_columnar_rows(
+    lazy_log: pl.LazyFrame, 
+    start: int, 
+    end: int, 
+    rejections: Counter = None
+) -> pl.LazyFrame: 
+    """
+    Validate the rows from `start` to `end` of a columnar log as a LazyFrame, see 
+    `_read_csv_bytes`. Only the row groups holding these rows are read, and typed 
+    columns are not parsed. Without `rejections`, rows are only read when the 
+    LazyFrame is collected, with the validation pushed down to the reader.
+    """
+    lazy_rows = lazy_log.slice(start, end - start)
+    if rejections is None: 
+        return _lazy_validation(lazy_rows)
+
+    with span('ingest_chunk', rows_range=(start, end)) as record: 
+        df = lazy_rows.collect()
+        record['rows_in'] = df.height
+        valid_df = _counted_validation(df, rejections)
+        record['rows_out'] = valid_df.height
+        return valid_df.lazy()
+
+def _estimate_row_size(file: IO[bytes]) -> float: 
+    """ Estimate the average number of bytes per row from the head of the file. """
+    file.seek(0)
+    sample = file.read(_ROW_SIZE_SAMPLE_BYTES)
+    file.seek(0)
+    return _sample_row_size(sample)
+
+def _sample_row_size(sample: bytes) -> float: 
+    nb_lines = sample.count(b'\n')
+    if nb_lines == 0: 
+        return max(len(sample), 1)
+
+    return len(sample[:sample.rfind(b'\n') + 1]) / nb_lines
+
+def _iter_byte_ranges(
+    file: IO[bytes], 
+    chunk_bytes: int | Callable[[], int],
+    range_ends: Dict[int, int] = None
+) -> Generator[tuple[int, int], None, None]: 
+    """
+    Split a file into contiguous, newline-aligned (start, end) byte ranges 
+    of roughly `chunk_bytes` bytes each, or `chunk_bytes()` bytes for the next
+    range. Ranges starting at an offset of `range_ends` end at the given offset.
+    """
+    file_size = file.seek(0, SEEK_END)
+    range_ends = range_ends or {}
+
+    start = 0
+    while start < file_size: 
+        if start in range_ends: 
+            yield start, range_ends[start]
+            start = range_ends[start]
+            continue
+        end = min(start + (chunk_bytes() if callable(chunk_bytes) else chunk_bytes), file_size)
+
+        # Extend the range up to the end of the line it falls in
+        file.seek(end)
+        while end < file_size: 
+            block = file.read(_ROW_SIZE_SAMPLE_BYTES)
+            newline_idx = block.find(b'\n')
+            if newline_idx != -1: 
+                end += newline_idx + 1
+                break
+            end += len(block)
+
+        yield start, end
+        start = end
+
 def _scan_matches_iter_chunks(
     path: Path, 
-    chunksize: int
+    chunksize: int,
+    rejections: Counter = None
 ) -> Generator[pl.LazyFrame, None, None] :
+    """ Generator of validated LazyFrame chunks, see `iter_matches_chunks`. """
+    for _, lazy_chunk in iter_matches_chunks(path, chunksize, rejections): 
+        yield lazy_chunk
+
+def iter_matches_chunks(
+    path: Path, 
+    chunksize: int | Callable[[], int],
+    rejections: Counter = None,
+    skip: Collection[tuple[int, int]] = ()
+) -> Generator[tuple[tuple[int, int], pl.LazyFrame], None, None] :
     """
-    Generator of validated LazyFrame chunks. 
-    For each chunk, Scan and validate a CSV file as a LazyFrame.
+    Generator of validated LazyFrame chunks with their (start, end) byte range, or 
+    row range for a columnar log (Parquet or Arrow IPC, see `columnar_log_format`). 
+
+    The file is read once, front to back: it is split at newline-aligned byte 
+    offsets sized to hold about `chunksize` rows, and each block is parsed and 
+    validated on its own. Per-chunk cost therefore does not depend on the 
+    position of the chunk in the file. 
+
+    Ranges only depend on the file and `chunksize`, they are offsets in the 
+    decompressed stream for compressed logs. Chunks whose range is in `skip` are 
+    not parsed (compressed logs are still decompressed up to the next chunk).
+
+    Columnar logs are split into ranges of `chunksize` rows, each one only reads 
+    the row groups holding its rows, decoded in parallel by the reader.
+
+    `chunksize` may be a callable, called for the number of rows of each next chunk, 
+    so that chunks are resized while the log is read. The ranges in `skip` are then 
+    followed as they are, so that the chunks of a resumed run start at the same offsets.
     """
-    if chunksize < 1:
+    chunk_rows = chunksize if callable(chunksize) else lambda: chunksize
+    if chunk_rows() < 1:
         raise ValueError("Chunk size must be a positive integer greater than zero.") 
+    # Start -> end of the chunks skipped
+    skip_ends = { start: end for start, end in skip }
+
+    log_format = columnar_log_format(path)
+    if log_format is not None: 
+        lazy_log = _scan_columnar(path, log_format)
+        nb_rows = lazy_log.select(pl.len()).collect().item()
+        start = 0
+        while start < nb_rows: 
+            end = skip_ends.get(start) or min(start + chunk_rows(), nb_rows)
+            if skip_ends.get(start) != end: 
+                yield (start, end), _read_columnar_rows(lazy_log, start, end, rejections)
+            start = end
+        return
+
+    if is_compressed_log(path): 
+        yield from _iter_compressed_matches_chunks(path, chunk_rows, rejections, skip_ends)
+        return
+
+    with path.open('rb') as file: 
+        row_size = _estimate_row_size(file)
+
+        for start, end in _iter_byte_ranges(file, lambda: max(1, int(chunk_rows() * row_size)), skip_ends): 
+            if skip_ends.get(start) == end: 
+                continue
+            file.seek(start)
+            yield (start, end), _read_csv_bytes(file.read(end - start), rejections)
+
+def _read_block(stream: IO[bytes], size: int) -> bytes: 
+    """ Read `size` bytes from a stream, or less at the end of the stream. """
+    parts = []
+    while size > 0: 
+        part = stream.read(size)
+        if not part: 
+            break
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+def _iter_stream_blocks(
+    stream: IO[bytes], 
+    chunk_rows: Callable[[], int],
+    block_ends: Dict[int, int] = None
+) -> Generator[bytes, None, None]: 
+    """
+    Split a non-seekable stream into newline-aligned blocks sized to hold about 
+    `chunk_rows()` rows, the row size being estimated from the head of the stream.
+    Blocks starting at an offset of `block_ends` end at the given offset.
+    """
+    block_ends = block_ends or {}
+    buffer = _read_block(stream, _ROW_SIZE_SAMPLE_BYTES)
+    row_size = _sample_row_size(buffer)
+    offset = 0
+
+    while True: 
+        chunk_bytes = block_ends.get(offset, offset + max(1, int(chunk_rows() * row_size))) - offset
+        if len(buffer) < chunk_bytes: 
+            buffer += _read_block(stream, chunk_bytes - len(buffer))
+        if not buffer: 
+            break
+
+        end = buffer.rfind(b'\n', 0, chunk_bytes) + 1
+        # Line longer than a block, or last line without an ending newline
+        while end == 0: 
+            newline_idx = buffer.find(b'\n', chunk_bytes)
+            if newline_idx != -1: 
+                end = newline_idx + 1
+                break
+            block = _read_block(stream, chunk_bytes)
+            if not block: 
+                end = len(buffer)
+                break
+            buffer += block
+
+        yield buffer[:end]
+        buffer = buffer[end:]
+        offset += end
+
+def _prefetch(iterator: Iterator, n: int) -> Generator: 
+    """
+    Run an iterator in a background thread, up to `n` items ahead of the consumer,
+    so that producing the next items (e.g. decompressing) overlaps with consuming them.
+    """
+    queue = Queue(maxsize=n)
+    stop = Event()
+    end = object()
+
+    def _put(item, error=None) -> bool: 
+        # Never blocks once the consumer stopped, so that it can join the producer
+        while not stop.is_set(): 
+            try: 
+                queue.put((item, error), timeout=0.1)
+                return True
+            except Full: 
+                pass
+        return False
+
+    def _produce(): 
+        try: 
+            for item in iterator: 
+                if not _put(item): 
+                    return
+            _put(end)
+        except BaseException as e: 
+            _put(end, e)
+
+    producer = Thread(target=_produce, daemon=True)
+    producer.start()
+    try: 
+        while True: 
+            item, error = queue.get()
+            if error is not None: 
+                raise error
+            if item is end: 
+                return
+            yield item
+    finally: 
+        stop.set()
+        producer.join()
+
+def _iter_compressed_matches_chunks(
+    path: Path, 
+    chunk_rows: Callable[[], int],
+    rejections: Counter = None,
+    skip_ends: Dict[int, int] = None
+) -> Generator[tuple[tuple[int, int], pl.LazyFrame], None, None] :
+    """
+    Chunks of a compressed log, see `COMPRESSED_LOG_SUFFIXES` and `iter_matches_chunks`.
 
-    do_continue = True
-    chunk_nb = 0
-    while do_continue: 
-        try:
-            yield _scan_csv(
-                path,
-                skip_rows=chunk_nb*chunksize,
-                n_rows=chunksize
-            )
-            chunk_nb += 1
-        except pl.exceptions.NoDataError: 
-            do_continue = False
+    The file is decompressed as a stream, never expanded to disk, in a background 
+    thread that reads the next blocks while the current one is parsed and validated.
+    """
+    skip_ends = skip_ends or {}
+    start = 0
+    with COMPRESSED_LOG_SUFFIXES[path.suffix](path) as stream: 
+        for block in _prefetch(_iter_stream_blocks(stream, chunk_rows, skip_ends), _PREFETCHED_BLOCKS): 
+            end = start + len(block)
+            if skip_ends.get(start) != end: 
+                yield (start, end), _read_csv_bytes(block, rejections)
+            start = end
+
+def resolve_log_paths(path: Path) -> List[Path]: 
+    """
+    Log files of a log path: the file itself, the files of a directory (hidden 
+    files excluded), or the files matching a glob pattern, e.g. `data/logs/20241027/*.log.gz`.
+    """
+    if path.is_dir(): 
+        log_paths = [ 
+            log_path for log_path in path.iterdir() 
+            if log_path.is_file() and not log_path.name.startswith('.') 
+        ]
+    elif path.exists() or not glob.has_magic(str(path)): 
+        return [ path ]
+    else: 
+        log_paths = [ Path(log_path) for log_path in glob.glob(str(path)) if Path(log_path).is_file() ]
+
+    if not log_paths: 
+        raise FileNotFoundError(f"No log file found for {path}")
+    return sorted(log_paths)
 
 def scan_matches(
     path: Path,
-    chunksize: int = None
+    chunksize: int = None,
+    rejections: Counter = None
 ) -> pl.LazyFrame | Generator[pl.LazyFrame, None, None]: 
     """
     Load matches data from CSV as LazyFrame or in chunks.
@@ -81,9 +511,13 @@ def scan_matches(
     Parameters:
     -----------
     path : Path
-        Path to the CSV file.
+        Path to the CSV file, optionally gzip ('.gz') or zstd ('.zst') compressed, or to 
+        a Parquet or Arrow IPC file with the same columns.
     chunksize : int, optional
         Number of rows per chunk. Returns generator if provided, else LazyFrame.
+    rejections : Counter, optional
+        Only used with `chunksize`. Updated with the number of rows read ('rows'), 
+        rejected ('rejected') and rejected by each validation rule, as chunks are read.
 
     Returns:
     --------
@@ -94,69 +528,143 @@ def scan_matches(
     if chunksize is None: 
         return _scan_csv(path)
     else: 
-        return _scan_matches_iter_chunks(path, chunksize)
+        return _scan_matches_iter_chunks(path, chunksize, rejections)
+    
+def read_matches_from(
+    path: Path, 
+    offset: int, 
+    max_bytes: int = None,
+    rejections: Counter = None
+) -> tuple[pl.LazyFrame | None, int]: 
+    """
+    Read and validate the complete lines appended to a log file after a byte offset.
+
+    A trailing line that is still being written (no ending newline) is left for the 
+    next call. Only the new bytes are read, so the cost does not depend on `offset`.
+
+    Parameters:
+    -----------
+    path : Path
+        Path to the CSV file.
+    offset : int
+        Byte offset to read from, the beginning of a line.
+    max_bytes : int, optional
+        Maximum number of bytes to read. Default reads up to the end of the file.
+    rejections : Counter, optional
+        Updated with the validation rejection counts, see `scan_matches`.
+
+    Returns:
+    --------
+    tuple[pl.LazyFrame | None, int]
+        Validated new rows, or None if there is no new complete line, and the byte 
+        offset to read from next time.
+    """
+    if is_compressed_log(path) or columnar_log_format(path) is not None: 
+        raise ValueError(f"Compressed and columnar logs can not be read from an offset: {path}")
+
+    with path.open('rb') as file: 
+        file.seek(offset)
+        data = file.read(max_bytes if max_bytes is not None else -1)
+
+    end = data.rfind(b'\n') + 1
+    if end == 0: 
+        return None, offset
+
+    return _read_csv_bytes(data[:end], rejections), offset + end
     
 def store_matches(
     path: Path, 
     df: pl.DataFrame
 ) -> None : 
+    """ Store matches as a headerless CSV file, or as a Parquet or Arrow IPC file after its suffix. """
     if not path.parent.exists():
         path.parent.mkdir(parents=True, exist_ok=True)
-    df.write_csv(file=path, include_header=False)
 
-def _generate_corrupted_rows(df: pl.DataFrame, corruption_ratio: float = 0.001) -> pl.DataFrame: 
+    match COLUMNAR_LOG_SUFFIXES.get(path.suffix): 
+        case 'parquet': 
+            df.write_parquet(path)
+        case 'ipc': 
+            df.write_ipc(path)
+        case _: 
+            df.write_csv(file=path, include_header=False)
+
+# Positions of the 32 hexadecimal digits in a canonical UUID string
+_UUID_HEX_POSITIONS = [ idx for idx in range(36) if idx not in (8, 13, 18, 23) ]
+
+# Number of matches generated by each shard of `generate_millions_matchs`
+_SHARD_NB_MATCHES = 10**5
+
+def _generate_uuids(rng: np.random.Generator, n: int) -> pl.Series: 
+    """ Generate `n` random UUID v4 strings at once, from random bytes. """
+    raw = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40  # Version 4
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+
+    hex_digits = np.frombuffer(raw.tobytes().hex().encode(), dtype='S1').reshape(n, 32)
+    chars = np.full((n, 36), b'-', dtype='S1')
+    chars[:, _UUID_HEX_POSITIONS] = hex_digits
+
+    return pl.Series(chars.view('S36').ravel()).cast(pl.String)
+
+def _generate_corrupted_rows(
+    df: pl.DataFrame, 
+    corruption_ratio: float = 0.001, 
+    rng: np.random.Generator = None
+) -> pl.DataFrame: 
     """
     Introduce data corruption into a DataFrame.
 
     Randomly modifies a proportion of rows to include invalid or None values 
     across columns like 'player_id', 'match_id', 'operator_id', and 'nb_kills'.
-
-    Note: 
-    -----
-    Currently does not scale very well
+    Corruptions are applied with masks over whole columns, 'nb_kills' is widened 
+    to Int16 to hold negative values.
     """
     if corruption_ratio == 0: 
         return df
     
+    rng = rng or np.random.default_rng()
     num_rows = df.shape[0]
     num_corrupted = int(num_rows * corruption_ratio)
     
-    corrupted_indices = np.random.choice(num_rows, num_corrupted, replace=False)
-    corruption_types = np.random.randint(1, 10, size=num_corrupted)
+    corruption_types = np.zeros(num_rows, dtype=np.uint8)
+    corruption_types[rng.choice(num_rows, num_corrupted, replace=False)] = rng.integers(1, 10, size=num_corrupted)
+
+    def _corrupt(col_name: str, corruptions: Dict[int, object]) -> pl.Expr: 
+        expr = pl.col(col_name)
+        for corruption_type, value in corruptions.items(): 
+            expr = (
+                pl.when(pl.col('corruption_type') == corruption_type)
+                .then(pl.lit(value))
+                .otherwise(expr)
+            )
+        return expr.alias(col_name)
 
-    corruped_df = df
-    
-    for corrupted_indice, corruption_type in list(zip(corrupted_indices, corruption_types)):
-        idx = int(corrupted_indice)
-        
-        match int(corruption_type): 
-            case 1:  
-                corruped_df[idx, 'player_id'] = "not-a-uuid"  
-            case 2:  
-                corruped_df[idx, 'match_id'] = "not-a-uuid"
-            case 3:  
-                corruped_df[idx, 'operator_id'] = 0
-            case 4:  
-                corruped_df[idx, 'nb_kills'] = -1  
-            case 5: 
-                corruped_df[idx, 'nb_kills'] = 200
-            case 6: 
-                corruped_df[idx, 'player_id'] = None
-            case 7: 
-                corruped_df[idx, 'match_id'] = None
-            case 8: 
-                corruped_df[idx, 'operator_id'] = None
-            case 9: 
-                corruped_df[idx, 'nb_kills'] = None
-            
-    return corruped_df
-
-def generate_matches(n_matches:int=1000, corruption_ratio: float = 0.001) -> pl.DataFrame: 
+    return (
+        df.with_columns(
+            pl.col('nb_kills').cast(pl.Int16),
+            corruption_type=pl.Series(corruption_types)
+        )
+        .with_columns(
+            _corrupt('player_id', { 1: 'not-a-uuid', 6: None }),
+            _corrupt('match_id', { 2: 'not-a-uuid', 7: None }),
+            _corrupt('operator_id', { 3: 0, 8: None }),
+            _corrupt('nb_kills', { 4: -1, 5: 200, 9: None }),
+        )
+        .drop('corruption_type')
+        .cast({ 'operator_id': pl.UInt8, 'nb_kills': pl.Int16 })
+    )
+
+def generate_matches(
+    n_matches:int=1000, 
+    corruption_ratio: float = 0.001, 
+    seed: int | np.random.SeedSequence = None
+) -> pl.DataFrame: 
     """
     Generate a DataFrame of simulated match data.
 
     Creates match records with UUIDs for players and matches, randomly assigned operator IDs, 
     and number of kills. Applies data corruption based on a specified ratio.
+    Every column is generated at once with array operations.
 
     Parameters:
     -----------
@@ -164,6 +672,8 @@ def generate_matches(n_matches:int=1000, corruption_ratio: float = 0.001) -> pl.
         Number of matches to simulate (default is 1000).
     corruption_ratio : float, optional
         Fraction of rows to corrupt in the dataset (default is 0.001).
+    seed : int | np.random.SeedSequence, optional
+        Seed of the random generator, for reproducible datasets. Default is a random seed.
 
     Returns:
     --------
@@ -172,92 +682,116 @@ def generate_matches(n_matches:int=1000, corruption_ratio: float = 0.001) -> pl.
 
     Notes:
     ------
-    Generating a very high number of matches (e.g., 1,000,000) may lead to high memory usage,
-    potentially causing your system to freeze, especially on machines with limited RAM (e.g., 8 GB). 
-    It is recommended to test with smaller values first and considere batch generation.
+    Memory usage grows with the number of matches (about 5.5M rows per 100k matches), 
+    use `generate_millions_matchs` to write larger datasets to disk by shards.
     """
 
     if n_matches <= 0: 
         return pl.DataFrame({'player_id': [], 'match_id': [], 'operator_id': [], 'nb_kills': []}) 
     
+    rng = np.random.default_rng(seed)
+
     nb_players_per_match = 10
     nb_players_ratio = 0.1  # 100/1000
     nb_players = max(nb_players_per_match, round(nb_players_ratio * n_matches))
 
-    players = [ str(uuid4()) for _ in range(nb_players) ] 
-    matches = [ str(uuid4()) for _ in range(n_matches) ] 
-
-    operators = np.array(OPERATORS)
+    players = _generate_uuids(rng, nb_players)
+    matches = _generate_uuids(rng, n_matches)
 
     match_nb_of_rows_all = np.clip(
-        np.random.normal(R6_MATCHES_STATS['AVG_NB_ROWS_PER_MATCH'], R6_MATCHES_STATS['STD_NB_ROWS_PER_MATCH'], size=n_matches), 
+        rng.normal(R6_MATCHES_STATS['AVG_NB_ROWS_PER_MATCH'], R6_MATCHES_STATS['STD_NB_ROWS_PER_MATCH'], size=n_matches), 
         R6_MATCHES_STATS['NB_ROWS_LOW_BOUNDARY'], 
         R6_MATCHES_STATS['NB_ROWS_HIGH_BOUNDARY']
     ).astype(int)
 
     total_rows = match_nb_of_rows_all.sum()
-    
-    match_ids = np.empty(total_rows, dtype='U36') # For UUID match_ids
-    player_ids = np.empty(total_rows, dtype='U36')  # For UUID player_ids
-    operator_ids = np.empty(total_rows, dtype=np.uint8)
-    nb_kills = np.empty(total_rows, dtype=np.uint8)
-
-    def _get_match_players(i): 
-        """Get a list of players for a specific match based on its index."""
-        start_idx = (i * 10) % nb_players
-        end_idx = start_idx + 10
-
-        # If the end index exceeds nb_players, wrap around to the beginning
-        if end_idx > nb_players:
-            match_players = players[start_idx:] + players[:end_idx % nb_players]
-        else:
-            match_players = players[start_idx:end_idx]
-
-        return match_players
-    
-
-    current_idx = 0
-    
-    for i, match_id in enumerate(matches): 
-        match_nb_of_rows = match_nb_of_rows_all[i]
-        match_players = _get_match_players(i)
-
-        sequence_players = np.random.choice(match_players, size=match_nb_of_rows, replace=True) 
-        
-        sequence_operators = np.random.choice(operators, size=match_nb_of_rows, replace=True)
-        sequence_nb_kills = np.random.randint(0, 5, size=match_nb_of_rows)
 
-        match_ids[current_idx:current_idx + match_nb_of_rows] = np.repeat(match_id, match_nb_of_rows)
-        player_ids[current_idx:current_idx + match_nb_of_rows] = sequence_players
-        operator_ids[current_idx:current_idx + match_nb_of_rows] = sequence_operators
-        nb_kills[current_idx:current_idx + match_nb_of_rows] = sequence_nb_kills
+    # Match i is played by the 10 players starting at (i * 10) % nb_players, wrapping around
+    match_idx = np.repeat(np.arange(n_matches), match_nb_of_rows_all)
+    player_idx = (match_idx * nb_players_per_match + rng.integers(0, nb_players_per_match, size=total_rows)) % nb_players
 
-        current_idx += match_nb_of_rows
+    # Rows are shuffled by generating them in a random order
+    row_order = rng.permutation(total_rows)
 
     matches_df = pl.DataFrame({
-        'player_id': player_ids,
-        'match_id': match_ids,
-        'operator_id': operator_ids,
-        'nb_kills': nb_kills
-    }).sample(fraction=1, shuffle=True)
+        'player_id': players.gather(player_idx[row_order]),
+        'match_id': matches.gather(match_idx[row_order]),
+        'operator_id': rng.choice(np.array(OPERATORS, dtype=np.uint8), size=total_rows),
+        'nb_kills': rng.integers(
+            R6_MATCHES_STATS['MIN_NB_KILLS'], R6_MATCHES_STATS['MAX_NB_KILLS'] + 1, size=total_rows, dtype=np.uint8
+        )
+    })
 
-    corruped_matches_df = _generate_corrupted_rows(matches_df, corruption_ratio)
+    corruped_matches_df = _generate_corrupted_rows(matches_df, corruption_ratio, rng)
 
     return corruped_matches_df
 
+def _generate_shard(
+    path: Path, 
+    n_matches: int, 
+    corruption_ratio: float, 
+    seed: np.random.SeedSequence
+) -> Path: 
+    """ Generate a shard of matches and store it as a headerless CSV file. """
+    store_matches(path, generate_matches(n_matches, corruption_ratio, seed))
+    return path
+
 def generate_millions_matchs(
     n_million: int, 
     path: Path,
-    corruption_ratio: float = 0.001
+    corruption_ratio: float = 0.001,
+    n_workers: int = None,
+    seed: int = None
 ) -> None : 
+    """
+    Generate millions of matches into a single headerless CSV file.
 
-    if not path.parent.exists():
-        path.parent.mkdir(parents=True, exist_ok=True)
+    Matches are generated by shards of 100k matches in worker processes, each with 
+    its own seed derived from `seed`, so the output only depends on `seed`. Shards 
+    are appended to the output in order as they complete, and at most twice 
+    `n_workers` shards are in flight, so memory and temporary disk usage stay flat.
+
+    Parameters:
+    -----------
+    n_million : int
+        Number of millions of matches to generate.
+    path : Path
+        Path of the output file.
+    corruption_ratio : float, optional
+        Fraction of rows to corrupt in the dataset (default is 0.001).
+    n_workers : int, optional
+        Number of worker processes. Default is the number of CPUs.
+    seed : int, optional
+        Seed of the random generators, for reproducible datasets. Default is a random seed.
+    """
 
-    with path.open('w') as file: 
-        generate_matches(10**5, corruption_ratio).write_csv(file=path, include_header=False)
+    if path.suffix in COLUMNAR_LOG_SUFFIXES: 
+        raise ValueError(f"Millions of matches are generated as CSV only, not {path.suffix}.")
 
-    with path.open('a') as file: 
-        for _ in range((n_million * 10) - 1): 
-            generate_matches(10**5, corruption_ratio).write_csv(file=file, include_header=False)
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
 
+    n_workers = n_workers or os.cpu_count() or 1
+    n_shards = n_million * (10**6 // _SHARD_NB_MATCHES)
+    shard_seeds = iter(enumerate(np.random.SeedSequence(seed).spawn(n_shards)))
+    in_flight = deque()
+
+    # Polars is not fork-safe, workers are started with spawn
+    with (
+        ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn')) as executor,
+        path.open('wb') as file
+    ): 
+        while True: 
+            for shard_nb, shard_seed in islice(shard_seeds, 2 * n_workers - len(in_flight)): 
+                shard_path = path.parent / f'.{path.name}.shard{shard_nb}'
+                in_flight.append(
+                    executor.submit(_generate_shard, shard_path, _SHARD_NB_MATCHES, corruption_ratio, shard_seed)
+                )
+
+            if not in_flight: 
+                break
+
+            shard_path = in_flight.popleft().result()
+            with shard_path.open('rb') as shard_file: 
+                copyfileobj(shard_file, file)
+            shard_path.unlink()
@@ -1,28 +1,145 @@
+import gzip
+import os
 import polars as pl
 from tempfile import NamedTemporaryFile
 from pathlib import Path
 
-def store_tempfile(df:pl.DataFrame) -> str: 
-    with NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as temp_file:
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd compression
+    zstandard = None
+
+from src.queries import decode_ids
+
+DEFAULT_SPILL_FORMAT = 'ipc'
+
+# Spill format name -> temporary file suffix
+SPILL_FORMATS = {
+    'ipc': '.arrow',
+    'parquet': '.parquet',
+    'csv': '.csv',
+}
+
+# Process umask, read once at import as it can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Output compression name -> file suffix
+OUTPUT_COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+def store_tempfile(df:pl.DataFrame, spill_format: str = DEFAULT_SPILL_FORMAT, temp_dir: Path = None) -> str: 
+    """
+    Store a DataFrame in a new temporary file and return its path. The file is created 
+    in `temp_dir`, or in the system temporary directory by default.
+
+    Columnar formats ('ipc', 'parquet') keep the column types and avoid 
+    formatting and re-parsing text, 'csv' is kept for debugging and inspection.
+    """
+    if spill_format not in SPILL_FORMATS: 
+        raise ValueError(f"Unknown spill format '{spill_format}', expected one of {list(SPILL_FORMATS)}.")
+
+    with NamedTemporaryFile(mode='w', suffix=SPILL_FORMATS[spill_format], dir=temp_dir, delete=False) as temp_file:
         temp_file_path = temp_file.name
-        df.write_csv(file=temp_file_path, include_header=True)
+
+    match spill_format: 
+        case 'ipc':
+            df.write_ipc(temp_file_path, compression='uncompressed')
+        case 'parquet':
+            df.write_parquet(temp_file_path, compression='lz4')
+        case 'csv':
+            # Binary columns are not supported by CSV, they are stored as hexadecimal strings
+            df.with_columns(
+                pl.col(pl.Binary).bin.encode('hex')
+            ).write_csv(file=temp_file_path, include_header=True)
     
     return temp_file_path
 
-def get_last_seven_files(dir_path: Path): 
-    files = list(dir_path.glob('*')) 
-    files.sort()
-    
-    last_seven_files = files[-7:]
-    
-    return last_seven_files
+def scan_tempfile(path: str, schema: dict[str, pl.DataType] = None) -> pl.LazyFrame: 
+    """
+    Lazily scan a temporary file written by `store_tempfile`. 
+    The format is inferred from the file suffix, Arrow IPC files are memory-mapped.
+    `schema` is only used for CSV files, to restore the column types, including 
+    binary columns stored as hexadecimal strings.
+    """
+    match Path(path).suffix: 
+        case '.arrow':
+            return pl.scan_ipc(path, memory_map=True)
+        case '.parquet':
+            return pl.scan_parquet(path)
+        case _:
+            binary_columns = [ name for name, dtype in (schema or {}).items() if dtype == pl.Binary ]
+            return pl.scan_csv(
+                path, 
+                schema_overrides={ **(schema or {}), **{ name: pl.String for name in binary_columns } }
+            ).with_columns(
+                pl.col(binary_columns).str.decode('hex')
+            )
+
+def _compress(data: bytes, compression: str = None) -> bytes: 
+    match compression: 
+        case None: 
+            return data
+        case 'gzip': 
+            return gzip.compress(data)
+        case 'zstd': 
+            if zstandard is None: 
+                raise ImportError("zstd compression requires the 'zstandard' package.")
+            return zstandard.ZstdCompressor().compress(data)
+        case _: 
+            raise ValueError(f"Unknown compression '{compression}', expected one of {list(OUTPUT_COMPRESSIONS)}.")
+
+def read_stored(path: Path) -> bytes: 
+    """ Read a file written by `store_atomic`, decompressed according to its suffix. """
+    data = path.read_bytes()
+    if path.suffix == OUTPUT_COMPRESSIONS['gzip']: 
+        return gzip.decompress(data)
+    if path.suffix == OUTPUT_COMPRESSIONS['zstd']: 
+        if zstandard is None: 
+            raise ImportError("zstd compression requires the 'zstandard' package.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def store_atomic(path: Path, data: bytes, compression: str = None) -> Path: 
+    """
+    Write a file in a single call to a temporary file next to it, then atomically
+    rename it into place, so readers only ever see a complete file. Compressed
+    files get the compression suffix, e.g. '.gz'. The file gets the permissions of
+    a file created with `open`, rather than the owner only ones of temporary files.
+    Returns the path written.
+    """
+    if compression is not None: 
+        path = path.with_name(path.name + OUTPUT_COMPRESSIONS.get(compression, ''))
+    data = _compress(data, compression)
+
+    if not path.parent.exists(): 
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    with NamedTemporaryFile(mode='wb', dir=path.parent, prefix=f'.{path.name}.', delete=False) as temp_file: 
+        try: 
+            temp_file.write(data)
+            os.fchmod(temp_file.fileno(), 0o666 & ~_UMASK)
+        except BaseException: 
+            os.unlink(temp_file.name)
+            raise
+    os.replace(temp_file.name, path)
+
+    return path
 
-def store_format_operator_top_100(path: Path, df: pl.DataFrame) -> None: 
+def _join_lines(df: pl.LazyFrame) -> bytes: 
+    """ Join the single 'line' column of a query into the file content, one line per row. """
+    lines = df.select(pl.col('line').str.join('\n')).collect().item()
+    return f'{lines}\n'.encode() if lines else b''
+
+def store_format_operator_top_100(path: Path, df: pl.DataFrame, compression: str = None) -> Path: 
     """
     Store formatted top 100 kills per operator in a file.
 
     Groups by operator and formats matches and kills as strings, saving
-    each operator's data on a new line.
+    each operator's data on a new line, as `operator_id|match_id:nb_kills,...`.
+    Lines are built with vectorized string expressions and the file is written atomically.
 
     Parameters:
     -----------
@@ -30,35 +147,28 @@ def store_format_operator_top_100(path: Path, df: pl.DataFrame) -> None:
         File path to save the formatted data.
     df : pl.DataFrame
         DataFrame containing 'operator_id', 'match_id', and 'nb_kills'.
+    compression : str, optional
+        Compression of the file, 'gzip' or 'zstd'. Default is no compression.
 
+    Returns:
+    --------
+    Path
+        Path of the file written, with the compression suffix if any.
     """
-    if not path.parent.exists(): 
-        path.parent.mkdir(parents=True, exist_ok=True)
-        
-    pre_format = df.group_by('operator_id').agg([
-        pl.col('match_id'), 
-        pl.col('nb_kills') 
-    ])
-
-    with path.open(mode='w') as file: 
-        for operator_id, match_id, nb_kills in pre_format[0].iter_rows():
-            match_kills_pairs = list(zip(match_id, nb_kills))
-            match_kills_strings = [ f'{match}:{kills}' for match, kills in match_kills_pairs ]
-
-            file.write(f'{operator_id}|{','.join(match_kills_strings)}\n')
-
-    with path.open(mode='a') as file: 
-        for operator_id, match_id, nb_kills in pre_format[1:].iter_rows():
-            match_kills_pairs = list(zip(match_id, nb_kills))
-            match_kills_strings = [ f'{match}:{kills}' for match, kills in match_kills_pairs ]
-
-            file.write(f'{operator_id}|{','.join(match_kills_strings)}\n')
-
-def store_format_match_top_10(path: Path, df: pl.DataFrame) -> None:
+    lines = (
+        decode_ids(df.lazy())
+        .group_by('operator_id', maintain_order=True)
+        .agg(pl.format('{}:{}', 'match_id', 'nb_kills').str.join(',').alias('match_kills'))
+        .select(pl.format('{}|{}', 'operator_id', 'match_kills').alias('line'))
+    )
+    return store_atomic(path, _join_lines(lines), compression)
+
+def store_format_match_top_10(path: Path, df: pl.DataFrame, compression: str = None) -> Path:
     """
     Store formatted top 10 kills per match in a file.
 
-    Writes each match and associated kills in a formated on separate lines.
+    Writes each match and associated kills on separate lines, as `match_id:nb_kills`.
+    Lines are built with vectorized string expressions and the file is written atomically.
 
     Parameters:
     -----------
@@ -66,19 +176,16 @@ def store_format_match_top_10(path: Path, df: pl.DataFrame) -> None:
         File path to save the formatted data.
     df : pl.DataFrame
         DataFrame containing 'match_id' and 'nb_kills'.
-    """
-
-    if not path.parent.exists(): 
-        path.parent.mkdir(parents=True, exist_ok=True)
+    compression : str, optional
+        Compression of the file, 'gzip' or 'zstd'. Default is no compression.
 
-    with path.open(mode='w') as file:
-        for match_id, nb_kills in df[0].iter_rows():
-            match_kills_string = f'{match_id}:{nb_kills}\n'
-
-        file.write(match_kills_string)
-
-    with path.open(mode='a') as file: 
-        for match_id, nb_kills in df[1:].iter_rows():
-            match_kills_string = f'{match_id}:{nb_kills}\n'
-
-            file.write(match_kills_string)
+    Returns:
+    --------
+    Path
+        Path of the file written, with the compression suffix if any.
+    """
+    lines = (
+        decode_ids(df.lazy())
+        .select(pl.format('{}:{}', 'match_id', 'nb_kills').alias('line'))
+    )
+    return store_atomic(path, _join_lines(lines), compression)
@@ -1,50 +1,150 @@
 import polars as pl 
 
-def operator_top_100(df: pl.LazyFrame) -> pl.LazyFrame: 
+ID_COLUMNS = ['player_id', 'match_id']
+# Partitioning of the match IDs, recorded with what is stored by partition: a match must
+# land in the same partition in every chunk, run and version of the dependencies
+PARTITION_SCHEME = 'match_id_leading_bytes'
+_PARTITION_BYTES = 4
+# Positions of the dashes of a canonical UUID text, in hexadecimal digits
+_UUID_DASHES = [8, 12, 16, 20]
+
+def encode_ids(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ 
+    Encode canonical UUID strings ID columns into their 16 bytes binary representation, 
+    other columns are left untouched. Expects validated UUIDs.
+    """
+    schema = df.collect_schema()
+
+    return df.with_columns(
+        pl.col(col_name)
+        .str.replace_all('-', '', literal=True)
+        .str.decode('hex')
+        for col_name in ID_COLUMNS if schema.get(col_name) == pl.String
+    )
+
+def decode_ids(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ Decode binary ID columns back to canonical UUID strings, other columns are left untouched. """
+    schema = df.collect_schema()
+
+    def _decode(col_name: str) -> pl.Expr: 
+        hex_id = pl.col(col_name).bin.encode('hex')
+        return pl.concat_str(
+            [
+                hex_id.str.slice(0, 8), 
+                hex_id.str.slice(8, 4), 
+                hex_id.str.slice(12, 4), 
+                hex_id.str.slice(16, 4), 
+                hex_id.str.slice(20, 12)
+            ], 
+            separator='-'
+        ).alias(col_name)
+
+    return df.with_columns(
+        _decode(col_name) 
+        for col_name in ID_COLUMNS if schema.get(col_name) == pl.Binary
+    )
+
+OPERATOR_TOP_K = 100
+MATCH_TOP_K = 10
+
+# Ranking of every top-k: most kills first, ties broken by the smallest match_id. 
+# Binary match_ids sort like their UUID string, so rankings do not depend on the encoding.
+_RANKING_BY = ['nb_kills', 'match_id']
+_RANKING_REVERSE = [False, True]
+
+def _top_k(df: pl.LazyFrame, k: int) -> pl.LazyFrame: 
+    """ Deterministic top-k rows by partial selection, without sorting every row. """
     return (
+        df.top_k(k, by=_RANKING_BY, reverse=_RANKING_REVERSE)
+        .sort(_RANKING_BY, descending=[True, False])
+    )
+
+def _top_k_per_operator(df: pl.LazyFrame, k: int) -> pl.LazyFrame: 
+    """ Deterministic top-k rows of each operator by partial selection, without sorting every row. """
+    return (
+        df.group_by('operator_id')
+        .agg(
+            pl.all()
+            .top_k_by(_RANKING_BY, k, reverse=_RANKING_REVERSE)
+        )
+        .explode(pl.exclude('operator_id'))
+        .sort(['operator_id', *_RANKING_BY], descending=[False, True, False])
+    )
+
+def operator_top_100(df: pl.LazyFrame) -> pl.LazyFrame: 
+    return _top_k_per_operator(
         df.group_by('match_id', 'operator_id')
         .agg(
             pl.col('nb_kills')
             .mean()
-        )
-        .sort(
-            'nb_kills', 
-            descending=True
-        )
-        .group_by('operator_id')
-        .head(100)
+        ),
+        OPERATOR_TOP_K
     )
 
-def merge_results_operator_top_100(df_list: list[pl.LazyFrame]) -> pl.LazyFrame: 
+def merge_results_operator_top_100(df_list: list[pl.LazyFrame], k: int = OPERATOR_TOP_K) -> pl.LazyFrame: 
+    return _top_k_per_operator(
+        pl.concat(
+            df_list,
+            how='vertical'
+        ),
+        k
+    )
+
+def prune_operator_top_100(df: pl.LazyFrame, reference: pl.LazyFrame) -> pl.LazyFrame: 
+    """ 
+    Drop the rows of `df` that cannot enter the top 100 of their operator once merged 
+    with `reference`, i.e. rows below the 100th best kills of a full reference operator.
+    """
+    thresholds = (
+        reference.group_by('operator_id')
+        .agg(
+            pl.col('nb_kills').min().alias('threshold'),
+            pl.len().alias('nb_rows')
+        )
+        .filter(pl.col('nb_rows') >= OPERATOR_TOP_K)
+        .select('operator_id', 'threshold')
+    )
     return (
-            pl.concat(
-                df_list,
-                how='vertical'
-            )
-            .sort(
-                'nb_kills', 
-                descending=True
-            )
-            .group_by('operator_id')
-            .head(100)
+        df.join(thresholds, on='operator_id', how='left')
+        .filter(
+            pl.col('threshold').is_null() | 
+            (pl.col('nb_kills') >= pl.col('threshold'))
         )
+        .drop('threshold')
+    )
+
+def _match_id_digits(schema: pl.Schema, offset: int) -> pl.Expr: 
+    """ 
+    Hexadecimal digits of the 4 bytes at `offset` of the match IDs. They are sliced from 
+    the canonical UUID text, without encoding it first, unless they span one of its dashes.
+    """
+    start, end = 2 * offset, 2 * (offset + _PARTITION_BYTES)
+    if schema['match_id'] != pl.String: 
+        return pl.col('match_id').bin.encode('hex').str.slice(start, end - start)
+    if any(start < dash < end for dash in _UUID_DASHES): 
+        return pl.col('match_id').str.replace_all('-', '', literal=True).str.slice(start, end - start)
+    return pl.col('match_id').str.slice(start + sum(start >= dash for dash in _UUID_DASHES), end - start)
 
-def partition_by_match_prefix(df: pl.LazyFrame) -> pl.LazyFrame: 
+def partition_by_match_hash(df: pl.LazyFrame, n_partitions: int, offset: int = 0) -> pl.LazyFrame: 
+    """
+    Encode the IDs and add the 'partition' of each row, out of `n_partitions`, from the 
+    4 bytes of its match ID at `offset`, read as a big-endian integer: every row of a match 
+    lands in the same partition, and as match IDs are random UUID v4, partitions get about 
+    the same number of matches. Unlike `pl.Expr.hash`, which may change across polars 
+    versions, the partition of a match is stable, see `PARTITION_SCHEME`. A partition can 
+    be split again with the bytes at another `offset`.
+    """
     return (
         df.with_columns(
-            pl.col('match_id')
-            .str.slice(0,3)
-            .alias('match_prefix')
+            (_match_id_digits(df.collect_schema(), offset).str.to_integer(base=16) % n_partitions)
+            .cast(pl.UInt32)
+            .alias('partition')
         )
-        .group_by('match_prefix')
-        .agg([
-            pl.col(col_name) 
-            for col_name in ['player_id', 'match_id', 'operator_id', 'nb_kills']
-        ])
+        .pipe(encode_ids)
     )
 
 def match_top_10(df: pl.LazyFrame) -> pl.LazyFrame : 
-    return (
+    return _top_k(
         df.group_by('match_id', 'player_id')
         .agg(
             pl.col('nb_kills')
@@ -53,22 +153,100 @@ def match_top_10(df: pl.LazyFrame) -> pl.LazyFrame :
         .agg(
             pl.col('nb_kills')
             .max()
-        )
-        .sort(
-            'nb_kills', 
-            descending=True
-        ).head(10)
+        ),
+        MATCH_TOP_K
     )
 
 def merge_results_match_top_10(df_list: list[pl.LazyFrame]) -> pl.LazyFrame:
+    return _top_k(
+        pl.concat(
+            df_list,
+            how='vertical'
+        ),
+        MATCH_TOP_K
+    )
+
+def prune_match_top_10(df: pl.LazyFrame, reference: pl.LazyFrame) -> pl.LazyFrame: 
+    """ 
+    Drop the rows of `df` that cannot enter the top 10 once merged with `reference`, 
+    i.e. rows below the 10th best kills of a full reference.
+    """
+    threshold = reference.select(
+        pl.when(pl.len() >= MATCH_TOP_K)
+        .then(pl.col('nb_kills').min())
+        .alias('threshold')
+    )
+    return (
+        df.join(threshold, how='cross')
+        .filter(
+            pl.col('threshold').is_null() | 
+            (pl.col('nb_kills') >= pl.col('threshold'))
+        )
+        .drop('threshold')
+    )
+
+def operator_kills_partials(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ Sum and count of kills per (match_id, operator_id), which can be merged exactly, unlike means. """
+    return (
+        df.group_by('match_id', 'operator_id')
+        .agg(
+            pl.col('nb_kills').sum().alias('nb_kills_sum'),
+            pl.len().alias('nb_rows')
+        )
+    )
+
+def merge_operator_kills_partials(df_list: list[pl.LazyFrame]) -> pl.LazyFrame: 
+    return (
+        pl.concat(
+            df_list,
+            how='vertical'
+        )
+        .group_by('match_id', 'operator_id')
+        .agg(
+            pl.col('nb_kills_sum').sum(),
+            pl.col('nb_rows').sum()
+        )
+    )
+
+def operator_top_100_from_partials(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ Same result as `operator_top_100`, computed from `operator_kills_partials`. """
+    return _top_k_per_operator(
+        df.select(
+            'operator_id', 
+            'match_id', 
+            (pl.col('nb_kills_sum') / pl.col('nb_rows')).alias('nb_kills')
+        ),
+        OPERATOR_TOP_K
+    )
+
+def player_kills_partials(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ Sum of kills per (match_id, player_id). """
+    return (
+        df.group_by('match_id', 'player_id')
+        .agg(
+            pl.col('nb_kills').sum()
+        )
+    )
+
+def merge_player_kills_partials(df_list: list[pl.LazyFrame]) -> pl.LazyFrame: 
     return (
         pl.concat(
             df_list,
             how='vertical'
         )
-        .sort(
-            'nb_kills', 
-            descending=True
+        .group_by('match_id', 'player_id')
+        .agg(
+            pl.col('nb_kills').sum()
         )
-        .head(10)
-    )
\ No newline at end of file
+    )
+
+def match_top_10_from_partials(df: pl.LazyFrame) -> pl.LazyFrame: 
+    """ Same result as `match_top_10`, computed from `player_kills_partials`. """
+    return _top_k(
+        df.group_by('match_id')
+        .agg(
+            pl.col('nb_kills')
+            .max()
+        ),
+        MATCH_TOP_K
+    )
@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+import re
+import threading
+import polars as pl
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from src.misc import read_stored
+from src.instrumentation import span
+
+DEFAULT_QUERY_HOST = '127.0.0.1'
+DEFAULT_QUERY_PORT = 8765
+DEFAULT_RELOAD_SECONDS = 1.0
+# Number of encoded responses kept, cleared at every reload
+DEFAULT_RESPONSE_CACHE_SIZE = 10_000
+SCOPES = ('rolling', 'daily')
+
+# Rolling result files written by `store_format_operator_top_100` and `store_format_match_top_10`
+_ROLLING_FILE_PATTERN = re.compile(r'^(operator_top100|match_top10)_(\d{8})\.txt(\.gz|\.zst)?$')
+_ROLLING_KINDS = { 'operator_top100': 'operators', 'match_top10': 'matches' }
+_DAILY_FILE_PATTERN = re.compile(r'^(\d{8})\.csv$')
+_DATE_PATTERN = re.compile(r'^\d{8}$')
+
+class QueryError(Exception):
+    """ Invalid query, answered with its HTTP status. """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def open_query_index(
+    rolling_dir: Path,
+    daily_dirs: Dict[str, Path],
+    response_cache_size: int = DEFAULT_RESPONSE_CACHE_SIZE
+) -> Dict:
+    """
+    Open an in-memory index of the rolling results in `rolling_dir` and of the daily
+    results in `daily_dirs` ('operator_top_100' and 'match_top_10' directories), keyed
+    by date, operator ID and match ID, and load it. See `reload_query_index`.
+    """
+    service = {
+        'rolling_dir': rolling_dir,
+        'daily_dirs': daily_dirs,
+        'files': {},
+        'index': _build_index([]),
+        'generation': 0,
+        'responses': OrderedDict(),
+        'response_cache_size': response_cache_size,
+        'lock': threading.Lock(),
+    }
+    reload_query_index(service)
+    return service
+
+def _list_result_files(service: Dict) -> Dict[Path, tuple]:
+    """ Result files with their (scope, kind, date) and (modification time, size), hidden files excluded. """
+    def _scan(directory: Path):
+        if not directory.exists():
+            return []
+        return [ entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith('.') ]
+
+    files = {}
+    for entry in _scan(service['rolling_dir']):
+        match = _ROLLING_FILE_PATTERN.match(entry.name)
+        if match:
+            stat = entry.stat()
+            files[Path(entry.path)] = (('rolling', _ROLLING_KINDS[match.group(1)], match.group(2)), (stat.st_mtime_ns, stat.st_size))
+    for name, kind in (('operator_top_100', 'operators'), ('match_top_10', 'matches')):
+        for entry in _scan(service['daily_dirs'][name]):
+            match = _DAILY_FILE_PATTERN.match(entry.name)
+            if match:
+                stat = entry.stat()
+                files[Path(entry.path)] = (('daily', kind, match.group(1)), (stat.st_mtime_ns, stat.st_size))
+    return files
+
+def _parse_rolling_file(path: Path, kind: str) -> Dict[int, List[tuple]] | List[tuple]:
+    """ Ranking of a rolling result file, `operator_id|match_id:nb_kills,...` or `match_id:nb_kills` lines. """
+    lines = read_stored(path).decode().splitlines()
+    if kind == 'matches':
+        return [ (match_id, float(nb_kills)) for match_id, nb_kills in (line.rsplit(':', 1) for line in lines if line) ]
+
+    ranking = {}
+    for line in lines:
+        if not line:
+            continue
+        operator_id, match_kills = line.split('|', 1)
+        ranking[int(operator_id)] = [
+            (match_id, float(nb_kills)) for match_id, nb_kills in (item.rsplit(':', 1) for item in match_kills.split(','))
+        ]
+    return ranking
+
+def _parse_daily_file(path: Path, kind: str) -> Dict[int, List[tuple]] | List[tuple]:
+    """ Ranking of a daily result CSV, rows being in ranking order. """
+    df = pl.read_csv(path)
+    if kind == 'matches':
+        return [ (match_id, float(nb_kills)) for match_id, nb_kills in df.select('match_id', 'nb_kills').iter_rows() ]
+
+    ranking = {}
+    for operator_id, match_id, nb_kills in df.select('operator_id', 'match_id', 'nb_kills').iter_rows():
+        ranking.setdefault(operator_id, []).append((match_id, float(nb_kills)))
+    return ranking
+
+def _build_index(rankings: List[tuple]) -> Dict:
+    """
+    Index of the rankings, each one a ((scope, kind, date), ranking) pair: operator
+    rankings and match rankings by scope and date, every appearance of a match by
+    scope, match ID and date, and the dates available in each scope.
+    """
+    index = {
+        'operators': { scope: {} for scope in SCOPES },
+        'matches': { scope: {} for scope in SCOPES },
+        'by_match': { scope: {} for scope in SCOPES },
+        'dates': { scope: [] for scope in SCOPES },
+    }
+    for (scope, kind, str_date), ranking in rankings:
+        index[kind][scope][str_date] = ranking
+        by_match = index['by_match'][scope]
+        if kind == 'matches':
+            for rank, (match_id, nb_kills) in enumerate(ranking, start=1):
+                appearance = by_match.setdefault(match_id, {}).setdefault(str_date, { 'top_10': None, 'operators': [] })
+                appearance['top_10'] = { 'rank': rank, 'nb_kills': nb_kills }
+        else:
+            for operator_id, operator_ranking in ranking.items():
+                for rank, (match_id, nb_kills) in enumerate(operator_ranking, start=1):
+                    appearance = by_match.setdefault(match_id, {}).setdefault(str_date, { 'top_10': None, 'operators': [] })
+                    appearance['operators'].append({ 'operator_id': operator_id, 'rank': rank, 'nb_kills': nb_kills })
+
+    for scope in SCOPES:
+        index['dates'][scope] = sorted(set(index['operators'][scope]) | set(index['matches'][scope]))
+    return index
+
+def reload_query_index(service: Dict) -> bool:
+    """
+    Reload the index if result files were written, added or removed since the last
+    load, e.g. by `store_format_operator_top_100`. Only the changed files are parsed,
+    then the new index replaces the old one at once and the response cache is cleared,
+    so that queries never wait for a reload nor see a partial one.
+
+    Returns:
+    --------
+    bool
+        True if the index was reloaded.
+    """
+    files = _list_result_files(service)
+    if { path: version for path, (_, version) in files.items() } == { path: loaded['version'] for path, loaded in service['files'].items() }:
+        return False
+
+    with span('query_reload', rows_in=len(files)) as record:
+        loaded_files = {}
+        for path, (key, version) in files.items():
+            loaded = service['files'].get(path)
+            if loaded is None or loaded['version'] != version:
+                scope, kind, _ = key
+                try:
+                    ranking = (_parse_rolling_file if scope == 'rolling' else _parse_daily_file)(path, kind)
+                except FileNotFoundError:
+                    # Replaced or removed since listed, picked up at the next reload
+                    continue
+                loaded = { 'key': key, 'version': version, 'ranking': ranking }
+            loaded_files[path] = loaded
+
+        index = _build_index([ (loaded['key'], loaded['ranking']) for loaded in loaded_files.values() ])
+        with service['lock']:
+            service['files'] = loaded_files
+            service['index'] = index
+            service['generation'] += 1
+            service['responses'].clear()
+        record['rows_out'] = len(loaded_files)
+
+    logging.info("Query index reloaded: %s result files", len(loaded_files))
+    return True
+
+def _positive_int(params: Dict[str, str], name: str, default: int = None) -> int:
+    value = params.get(name)
+    if value is None:
+        return default
+    if not value.isdigit() or int(value) < 1:
+        raise QueryError(400, f"'{name}' must be a positive integer, got '{value}'.")
+    return int(value)
+
+def _select_dates(index: Dict, scope: str, params: Dict[str, str]) -> List[str]:
+    """ Dates of a query: the range `from`-`to`, the single `date`, or the latest date by default. """
+    for name in ('date', 'from', 'to'):
+        if name in params and not _DATE_PATTERN.match(params[name]):
+            raise QueryError(400, f"'{name}' must be a date as YYYYMMDD, got '{params[name]}'.")
+
+    dates = index['dates'][scope]
+    if 'from' in params or 'to' in params:
+        return [ str_date for str_date in dates if params.get('from', str_date) <= str_date <= params.get('to', str_date) ]
+    if 'date' in params:
+        if params['date'] not in dates:
+            raise QueryError(404, f"No {scope} results for {params['date']}.")
+        return [ params['date'] ]
+    if not dates:
+        raise QueryError(404, f"No {scope} results.")
+    return [ dates[-1] ]
+
+def _answer(index: Dict, path: str, params: Dict[str, str]) -> Dict:
+    """ Answer a query from the index, see `query` for the routes. """
+    scope = params.get('scope', 'rolling')
+    if scope not in SCOPES:
+        raise QueryError(400, f"'scope' must be one of {list(SCOPES)}, got '{scope}'.")
+    parts = [ part for part in path.split('/') if part ]
+
+    match parts:
+        case ['dates']:
+            return index['dates']
+
+        case ['operators', operator_id]:
+            if not operator_id.lstrip('-').isdigit():
+                raise QueryError(400, f"Operator ID must be an integer, got '{operator_id}'.")
+            k = _positive_int(params, 'k')
+            rankings = {}
+            for str_date in _select_dates(index, scope, params):
+                ranking = index['operators'][scope].get(str_date, {}).get(int(operator_id))
+                if ranking is not None:
+                    rankings[str_date] = [ { 'match_id': match_id, 'nb_kills': nb_kills } for match_id, nb_kills in ranking[:k] ]
+            return { 'operator_id': int(operator_id), 'scope': scope, 'dates': rankings }
+
+        case ['matches', 'top']:
+            k = _positive_int(params, 'k')
+            return {
+                'scope': scope,
+                'dates': {
+                    str_date: [ { 'match_id': match_id, 'nb_kills': nb_kills } for match_id, nb_kills in index['matches'][scope].get(str_date, [])[:k] ]
+                    for str_date in _select_dates(index, scope, params)
+                }
+            }
+
+        case ['matches', match_id]:
+            appearances = index['by_match'][scope].get(match_id, {})
+            if 'from' in params or 'to' in params or 'date' in params:
+                selected_dates = set(_select_dates(index, scope, params))
+                appearances = { str_date: appearance for str_date, appearance in appearances.items() if str_date in selected_dates }
+            return { 'match_id': match_id, 'scope': scope, 'dates': dict(sorted(appearances.items())) }
+
+    raise QueryError(404, f"Unknown query '{path}'.")
+
+def query(service: Dict, path: str, params: Dict[str, str]) -> Tuple[int, bytes]:
+    """
+    Answer a query with its HTTP status and JSON body, from the in-memory index only.
+    Responses are cached until the next reload.
+
+    Queries, every one taking `scope` ('rolling', default, or 'daily'):
+    - `/dates`: the dates available in each scope.
+    - `/operators/{operator_id}`: the ranking of the matches of an operator, its `k` best
+      only if given, on the latest date, a single `date` or a range of dates `from`-`to`.
+    - `/matches/top`: the ranking of the matches, with the same parameters.
+    - `/matches/{match_id}`: the rank and kills of a match in the match ranking and in the
+      operator rankings, on every date or the selected ones.
+    """
+    cache_key = (path, tuple(sorted(params.items())))
+    with service['lock']:
+        response = service['responses'].get(cache_key)
+        if response is not None:
+            service['responses'].move_to_end(cache_key)
+            return response
+        index, generation = service['index'], service['generation']
+
+    try:
+        response = (200, json.dumps(_answer(index, path, params)).encode())
+    except QueryError as e:
+        response = (e.status, json.dumps({ 'error': str(e) }).encode())
+
+    with service['lock']:
+        # Not cached if the index was reloaded meanwhile
+        if generation == service['generation']:
+            service['responses'][cache_key] = response
+            if len(service['responses']) > service['response_cache_size']:
+                service['responses'].popitem(last=False)
+    return response
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, so that a client does not reconnect for every lookup
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without TCP_NODELAY the body waits for the client acknowledgement
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, body = query(self.server.service, url.path, dict(parse_qsl(url.query)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug("Query %s: %s", self.address_string(), format % args)
+
+class _UnixQueryHandler(_QueryHandler):
+    # Not a TCP socket
+    disable_nagle_algorithm = False
+
+class _ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def _reload_loop(service: Dict, reload_seconds: float, stop: threading.Event) -> None:
+    while not stop.wait(reload_seconds):
+        try:
+            reload_query_index(service)
+        except Exception as e:
+            logging.error("Error reloading the query index: %s", e)
+
+def serve_queries(
+    service: Dict,
+    host: str = DEFAULT_QUERY_HOST,
+    port: int = DEFAULT_QUERY_PORT,
+    socket_path: Path = None,
+    reload_seconds: float = DEFAULT_RELOAD_SECONDS
+) -> None:
+    """
+    Serve the queries of an index over HTTP, on `host`:`port` or on the Unix socket
+    `socket_path`, until interrupted, see `query`. The index is reloaded every
+    `reload_seconds` if result files changed, see `reload_query_index`.
+    """
+    if socket_path is not None:
+        if socket_path.exists():
+            socket_path.unlink()
+        server = _ThreadingUnixHTTPServer(str(socket_path), _UnixQueryHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _QueryHandler)
+    server.service = service
+
+    stop = threading.Event()
+    reloader = threading.Thread(target=_reload_loop, args=(service, reload_seconds, stop), name='query-reload', daemon=True)
+    reloader.start()
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+        if socket_path is not None and socket_path.exists():
+            socket_path.unlink()
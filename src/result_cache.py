@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import polars as pl
+from pathlib import Path
+from typing import Dict, List
+
+DEFAULT_CACHE_DIR = Path('data/cache/')
+DEFAULT_CACHE_MAX_MB = 1024
+# Bump when a change of the pipeline changes its results, so that older cache entries are not used
+PIPELINE_VERSION = 1
+
+_ENTRY_FILE = 'entry.json'
+# Size of each of the blocks hashed by a sampled fingerprint: head, middle and tail of the file
+_SAMPLE_BYTES = 1 << 20
+
+def fingerprint_file(path: Path, full_hash: bool = False) -> Dict:
+    """
+    Fingerprint of a file: its size, modification time and a hash of its content,
+    either the full content or, by default, a sample of its head, middle and tail.
+    Files smaller than the sample are always fully hashed.
+    """
+    stat = path.stat()
+    digest = hashlib.blake2b(digest_size=16)
+
+    with path.open('rb') as file:
+        if full_hash or stat.st_size <= 3 * _SAMPLE_BYTES:
+            for block in iter(lambda: file.read(_SAMPLE_BYTES), b''):
+                digest.update(block)
+        else:
+            for offset in (0, stat.st_size // 2, stat.st_size - _SAMPLE_BYTES):
+                file.seek(offset)
+                digest.update(file.read(_SAMPLE_BYTES))
+
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'hash': digest.hexdigest(),
+        'sampled': not full_hash and stat.st_size > 3 * _SAMPLE_BYTES,
+    }
+
+def cache_key(kind: str, inputs) -> str:
+    """ Key of a cache entry, from its kind, the pipeline version and its JSON serializable inputs. """
+    serialized = json.dumps([ PIPELINE_VERSION, kind, inputs ], sort_keys=True, default=str)
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+def daily_results_key(log_paths: List[Path], metric_names: List[str], full_hash: bool = False) -> str:
+    """ Key of the daily results of a log, from the fingerprints of its files, whatever their names. """
+    return cache_key('daily', {
+        'metrics': sorted(metric_names),
+        'logs': sorted(
+            (fingerprint_file(log_path, full_hash) for log_path in log_paths),
+            key=lambda fingerprint: fingerprint['hash']
+        ),
+    })
+
+def window_results_key(daily_paths: Dict[str, List[Path]], window_days: int, end_date: str) -> str:
+    """ Key of the rolling window results, from the fully hashed daily results of each metric within the window. """
+    return cache_key('window', {
+        'window_days': window_days,
+        'end_date': end_date,
+        'days': {
+            name: [ [ path.name, fingerprint_file(path, full_hash=True)['hash'] ] for path in paths ]
+            for name, paths in daily_paths.items()
+        },
+    })
+
+def _entry_size(entry_dir: Path) -> int:
+    return sum(path.stat().st_size for path in entry_dir.iterdir())
+
+def cache_get(cache_dir: Path, key: str) -> tuple[Dict[str, pl.DataFrame], Dict] | None:
+    """
+    Results and metadata of a cache entry, or None if it is not cached. Reading an
+    entry marks it as the most recently used.
+    """
+    entry_dir = cache_dir / key
+    try:
+        metadata = json.loads((entry_dir / _ENTRY_FILE).read_text())
+        results = { name: pl.read_parquet(entry_dir / f'{name}.parquet') for name in metadata['results'] }
+        os.utime(entry_dir / _ENTRY_FILE)
+    except FileNotFoundError:
+        # Not cached, or evicted while it was read
+        return None
+    return results, metadata['metadata']
+
+def cache_put(
+    cache_dir: Path,
+    key: str,
+    results: Dict[str, pl.DataFrame],
+    metadata: Dict = None,
+    max_mb: float = DEFAULT_CACHE_MAX_MB
+) -> None:
+    """
+    Store results in the cache, then evict the least recently used entries until the
+    cache fits in `max_mb`. The entry is written to a temporary directory renamed
+    into place, so concurrent runs only ever read complete entries.
+    """
+    entry_dir = cache_dir / key
+    temp_dir = cache_dir / f'.{key}.{os.getpid()}.tmp'
+    temp_dir.mkdir(parents=True, exist_ok=True)
+
+    for name, result in results.items():
+        result.write_parquet(temp_dir / f'{name}.parquet')
+    (temp_dir / _ENTRY_FILE).write_text(json.dumps({
+        'created_at': time.time(),
+        'results': list(results),
+        'metadata': metadata or {},
+    }, default=str))
+
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Already stored by a concurrent run
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    evict_cache(cache_dir, max_mb)
+
+def evict_cache(cache_dir: Path, max_mb: float = DEFAULT_CACHE_MAX_MB) -> None:
+    """ Remove the least recently used entries until the cache fits in `max_mb`. """
+    entries = []
+    for entry_dir in cache_dir.iterdir():
+        if entry_dir.name.startswith('.'):
+            # Entry being written
+            continue
+        try:
+            entries.append(((entry_dir / _ENTRY_FILE).stat().st_mtime, _entry_size(entry_dir), entry_dir))
+        except FileNotFoundError:
+            # Entry evicted by a concurrent run
+            continue
+
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries, key=lambda entry: entry[0]):
+        if cache_size <= max_mb * 1024 * 1024:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        cache_size -= size
+        logging.info("Evicted cache entry %s", entry_dir.name)
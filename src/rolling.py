@@ -0,0 +1,174 @@
+import json
+import logging
+import polars as pl
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from src.queries import encode_ids
+
+DATE_FORMAT = '%Y%m%d'
+DEFAULT_WINDOW_DAYS = 7
+# Number of days of partial results kept in the ring, i.e. the longest supported window
+MAX_WINDOW_DAYS = 30
+
+def parse_date(str_date: str) -> date:
+    return datetime.strptime(str_date, DATE_FORMAT).date()
+
+def format_date(day: date) -> str:
+    return day.strftime(DATE_FORMAT)
+
+def _day_path(state_dir: Path, day: date) -> Path:
+    return state_dir / 'days' / f'{format_date(day)}.parquet'
+
+def _window_paths(state_dir: Path, window_days: int) -> tuple[Path, Path]:
+    return (
+        state_dir / f'window_{window_days}.parquet',
+        state_dir / f'window_{window_days}.json'
+    )
+
+def _sync_day(state_dir: Path, daily_dir: Path, day: date) -> bool:
+    """
+    Copy the daily result of a day into the ring, as a compact Parquet partial with
+    binary IDs and a 'date' column, if the ring has no partial for it or an outdated one.
+
+    Returns:
+    --------
+    bool
+        True if the partial of the day was (re)written.
+    """
+    daily_path = daily_dir / f'{format_date(day)}.csv'
+    day_path = _day_path(state_dir, day)
+
+    if not daily_path.exists():
+        return False
+    if day_path.exists() and day_path.stat().st_mtime >= daily_path.stat().st_mtime:
+        return False
+
+    if not day_path.parent.exists():
+        day_path.parent.mkdir(parents=True, exist_ok=True)
+
+    (
+        pl.scan_csv(daily_path)
+        .pipe(encode_ids)
+        .with_columns(date=pl.lit(day))
+        .sink_parquet(day_path)
+    )
+    return True
+
+def _evict_days(state_dir: Path, oldest_day: date) -> None:
+    """ Remove the ring partials older than `oldest_day`. """
+    for day_path in (state_dir / 'days').glob('*.parquet'):
+        if parse_date(day_path.stem) < oldest_day:
+            day_path.unlink()
+
+def _merge(df_list: List[pl.LazyFrame], merge_function: Callable) -> pl.DataFrame:
+    columns = df_list[0].collect_schema().names()
+    return merge_function([ df.select(columns) for df in df_list ]).collect()
+
+def update_rolling_window(
+    state_dir: Path,
+    daily_dir: Path,
+    end_date: str,
+    merge_function: Callable,
+    window_days: int = DEFAULT_WINDOW_DAYS
+) -> pl.DataFrame:
+    """
+    Update and return the rolling window of a metric ending on `end_date`.
+
+    The state directory keeps a ring of compact per-day partial results, synced
+    from the daily results directory, and the merged result of the last window
+    computed, where each row keeps the date it comes from. Days are keyed by their
+    actual date: missing days are left out of the window and a day processed again
+    replaces its previous result.
+
+    The stored window is updated incrementally by merging it with the days that
+    entered the window. It is only rebuilt from the ring partials when a day that
+    left the window, or that was processed again, contributed rows to it. Since
+    partials are top-k results, this costs a few thousand rows at most.
+
+    Parameters:
+    -----------
+    state_dir : Path
+        Directory holding the rolling window state of the metric.
+    daily_dir : Path
+        Directory holding the daily results of the metric, as `YYYYMMDD.csv` files.
+    end_date : str
+        Last day of the window, as `YYYYMMDD`.
+    merge_function : Callable
+        Query merging a list of results, e.g. `merge_results_operator_top_100`.
+    window_days : int, optional
+        Number of days in the window, at most `MAX_WINDOW_DAYS`. Default is 7.
+
+    Returns:
+    --------
+    pl.DataFrame
+        Merged result of the daily results within the window.
+    """
+    if not 1 <= window_days <= MAX_WINDOW_DAYS:
+        raise ValueError(f"Window length must be between 1 and {MAX_WINDOW_DAYS} days.")
+
+    end_day = parse_date(end_date)
+    window = [ end_day - timedelta(days=offset) for offset in range(window_days) ]
+
+    changed_days = { day for day in window if _sync_day(state_dir, daily_dir, day) }
+    available_days = { day for day in window if _day_path(state_dir, day).exists() }
+
+    missing_days = sorted(set(window) - available_days)
+    if missing_days:
+        logging.warning(
+            "Rolling window ending %s: no daily result in %s for %s",
+            end_date, daily_dir, [ format_date(day) for day in missing_days ]
+        )
+    if not available_days:
+        raise FileNotFoundError(f"No daily result in {daily_dir} for the window ending {end_date}.")
+
+    window_path, window_meta_path = _window_paths(state_dir, window_days)
+    previous_days = set()
+    if window_path.exists() and window_meta_path.exists():
+        previous_days = { parse_date(day) for day in json.loads(window_meta_path.read_text())['days'] }
+
+    if previous_days:
+        previous_window = pl.read_parquet(window_path)
+        contributing_days = set(previous_window['date'].unique().to_list())
+        removed_days = (previous_days - available_days) | (previous_days & changed_days)
+        is_incremental = not (removed_days & contributing_days)
+    else:
+        is_incremental = False
+
+    if is_incremental:
+        added_days = available_days - (previous_days - changed_days)
+        merged_window = _merge(
+            [ previous_window.lazy().filter(pl.col('date').is_in(list(available_days))) ] +
+            [ pl.scan_parquet(_day_path(state_dir, day)) for day in sorted(added_days) ],
+            merge_function
+        )
+    else:
+        merged_window = _merge(
+            [ pl.scan_parquet(_day_path(state_dir, day)) for day in sorted(available_days) ],
+            merge_function
+        )
+
+    merged_window.write_parquet(window_path)
+    window_meta_path.write_text(json.dumps({
+        'end_date': end_date,
+        'days': [ format_date(day) for day in sorted(available_days) ]
+    }))
+    _evict_days(state_dir, end_day - timedelta(days=MAX_WINDOW_DAYS - 1))
+
+    return merged_window.drop('date')
+
+def update_rolling_windows(
+    state_dir: Path,
+    daily_dirs: Dict[str, Path],
+    end_date: str,
+    merge_functions: Dict[str, Callable],
+    window_days: int = DEFAULT_WINDOW_DAYS
+) -> Dict[str, pl.DataFrame]:
+    """ Update the rolling window of several metrics, each with its own state directory. """
+    return {
+        name: update_rolling_window(
+            state_dir / name, daily_dirs[name], end_date, merge_functions[name], window_days
+        )
+        for name in daily_dirs.keys()
+    }
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import polars as pl
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+MANIFEST_FILE = 'manifest.json'
+SPILL_DIR = 'spill'
+AGGREGATES_DIR = 'aggregates'
+PARTIALS_DIR = 'partials'
+
+# Minimum interval between two writes of the manifest by `record_aggregate`, in seconds
+_MIN_STORE_SECONDS = 1.0
+
+_lock = threading.RLock()
+
+def _log_identity(log_paths: List[Path]) -> List[dict]:
+    """ Path, size and modification time of each log, a modified log is not resumed. """
+    return [
+        { 'path': str(log_path), 'size': log_path.stat().st_size, 'mtime_ns': log_path.stat().st_mtime_ns }
+        for log_path in log_paths
+    ]
+
+def _referenced_files(manifest: Dict) -> set:
+    referenced_files = set()
+    for chunks in manifest['chunks'].values():
+        for chunk in chunks:
+            referenced_files.update(chunk['files'].values())
+    for merged_files in manifest['partitions'].values():
+        referenced_files.update(merged_files.values())
+    for aggregate_files in manifest['aggregates'].values():
+        referenced_files.update(aggregate_files.values())
+    return referenced_files
+
+def _remove_unreferenced_files(manifest: Dict) -> None:
+    """ Remove the files written after the last update of the manifest, by an interrupted run. """
+    referenced_files = _referenced_files(manifest)
+    for path in spill_dir(manifest).iterdir():
+        if path.name not in referenced_files:
+            path.unlink()
+    for path in (Path(manifest['run_dir']) / AGGREGATES_DIR).iterdir():
+        if f'{AGGREGATES_DIR}/{path.name}' not in referenced_files:
+            path.unlink()
+
+def _remove_run(run_dir: Path) -> None:
+    """ Remove a run directory and the spill directory of its manifest. """
+    manifest_path = run_dir / MANIFEST_FILE
+    if manifest_path.exists():
+        old_spill_dir = json.loads(manifest_path.read_text()).get('spill_dir')
+        if old_spill_dir is not None:
+            shutil.rmtree(old_spill_dir, ignore_errors=True)
+    if run_dir.exists():
+        shutil.rmtree(run_dir)
+
+def open_run(run_dir: Path, log_paths: List[Path], resume: bool = False, run_spill_dir: Path = None) -> Dict:
+    """
+    Open the manifest of a processing run over `log_paths`, kept in `run_dir` with
+    the run partial aggregates. The run spill files are kept in a sub directory of 
+    `run_spill_dir` named after the run, or of the run directory by default.
+
+    The manifest records the ingested byte ranges of each log with their spill files
+    and rejection counts, the merged partitions and the aggregated partitions, as
+    they complete. With `resume`, the manifest left by an interrupted run over the
+    same unchanged logs is reused, so that finished work is skipped, and the files
+    written after its last update are removed. Otherwise, or if there is no such
+    manifest, the run directory is cleared and a new manifest is started. A resumed
+    run keeps the spill directory of the interrupted run.
+    """
+    manifest_path = run_dir / MANIFEST_FILE
+    log_identity = _log_identity(log_paths)
+
+    if resume and manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest['logs'] == log_identity:
+            manifest['run_dir'] = str(run_dir)
+            _remove_unreferenced_files(manifest)
+            logging.info(
+                "Resuming run in %s: %s chunks, %s partitions and %s aggregates done", run_dir,
+                sum(len(chunks) for chunks in manifest['chunks'].values()),
+                len(manifest['partitions']), len(manifest['aggregates'])
+            )
+            return manifest
+        logging.warning("Manifest in %s is for other or modified logs, starting over", run_dir)
+
+    _remove_run(run_dir)
+    run_spill_dir = run_spill_dir / run_dir.name if run_spill_dir is not None else run_dir / SPILL_DIR
+    if run_spill_dir.exists():
+        shutil.rmtree(run_spill_dir)
+    run_spill_dir.mkdir(parents=True)
+    (run_dir / AGGREGATES_DIR).mkdir(parents=True, exist_ok=True)
+    (run_dir / PARTIALS_DIR).mkdir(parents=True, exist_ok=True)
+
+    manifest = {
+        'run_dir': str(run_dir),
+        'spill_dir': str(run_spill_dir),
+        'logs': log_identity,
+        'settings': None,
+        'chunks': {},
+        'partitions': {},
+        'aggregates': {},
+        'stored_at': 0,
+    }
+    store_manifest(manifest)
+    return manifest
+
+def store_manifest(manifest: Dict) -> None:
+    """ Atomically replace the manifest file, so that a crash leaves the previous version. """
+    with _lock:
+        run_dir = Path(manifest['run_dir'])
+        manifest['stored_at'] = time.time()
+        temp_manifest_path = run_dir / f'{MANIFEST_FILE}.tmp'
+        temp_manifest_path.write_text(json.dumps(manifest))
+        os.replace(temp_manifest_path, run_dir / MANIFEST_FILE)
+
+def close_run(manifest: Dict) -> None:
+    """ Remove the run directory and the run spill directory once the run completed. """
+    _remove_run(Path(manifest['run_dir']))
+
+def run_path(manifest: Dict, file_name: str) -> str:
+    """ Path of a file referenced by the manifest, relative to the run directory. """
+    return str(Path(manifest['run_dir']) / file_name)
+
+def spill_dir(manifest: Dict) -> Path:
+    return Path(manifest['spill_dir'])
+
+def run_partials_dir(manifest: Dict) -> Path:
+    """ Directory of the partials of the run partitions, kept until they are committed, see `daily_partials`. """
+    return Path(manifest['run_dir']) / PARTIALS_DIR
+
+def _spill_path(manifest: Dict, file_name: str) -> str:
+    return str(spill_dir(manifest) / file_name)
+
+def finished_chunks(manifest: Dict, log_path: Path) -> Dict[tuple, dict]:
+    """ Ingested chunks of a log, by (start, end) byte range. """
+    with _lock:
+        return { tuple(chunk['range']): chunk for chunk in manifest['chunks'].get(str(log_path), []) }
+
+def record_chunk(
+    manifest: Dict,
+    log_path: Path,
+    byte_range: tuple[int, int],
+    partition_paths: Dict[int, str],
+    rejections: Counter
+) -> None:
+    """ Record an ingested chunk, with the spill file of each of its partitions and its rejection counts. """
+    with _lock:
+        manifest['chunks'].setdefault(str(log_path), []).append({
+            'range': list(byte_range),
+            'files': { str(partition): Path(path).name for partition, path in partition_paths.items() },
+            'rejections': dict(rejections),
+        })
+        store_manifest(manifest)
+
+def forget_chunks(manifest: Dict, log_path: Path) -> List[str]:
+    """ Forget the ingested chunks of a log, e.g. of a shard left out of the run, and return their spill files. """
+    with _lock:
+        chunks = manifest['chunks'].pop(str(log_path), [])
+        store_manifest(manifest)
+    return [ path for chunk in chunks for path in chunk_partition_paths(manifest, chunk).values() ]
+
+def chunk_partition_paths(manifest: Dict, chunk: dict) -> Dict[int, str]:
+    return { int(partition): _spill_path(manifest, file_name) for partition, file_name in chunk['files'].items() }
+
+def finished_partitions(manifest: Dict) -> Dict[int, Dict[int, str]]:
+    """ Merged partitions, each ingested partition being merged into one or more (split) partitions. """
+    with _lock:
+        return {
+            int(partition): { int(key): _spill_path(manifest, file_name) for key, file_name in merged_files.items() }
+            for partition, merged_files in manifest['partitions'].items()
+        }
+
+def record_partition(manifest: Dict, partition: int, merged_paths: Dict[int, str]) -> None:
+    with _lock:
+        manifest['partitions'][str(partition)] = {
+            str(key): Path(path).name for key, path in merged_paths.items()
+        }
+        store_manifest(manifest)
+
+def finished_aggregates(manifest: Dict, metric_names: List[str]) -> Dict[int, List[pl.DataFrame]]:
+    """ Results of the aggregated partitions, for each metric in `metric_names` order. """
+    with _lock:
+        aggregates = dict(manifest['aggregates'])
+    return {
+        int(key): [ pl.read_parquet(run_path(manifest, aggregate_files[name])) for name in metric_names ]
+        for key, aggregate_files in aggregates.items()
+    }
+
+def record_aggregate(manifest: Dict, key: int, results: Dict[str, pl.DataFrame]) -> None:
+    """
+    Store and record the results of an aggregated partition. The manifest is written
+    at most every second, results recorded in between are computed again on resume.
+    """
+    aggregates_dir = Path(manifest['run_dir']) / AGGREGATES_DIR
+    aggregate_files = {}
+    for name, result in results.items():
+        file_name = f'{AGGREGATES_DIR}/{key}_{name}.parquet'
+        result.write_parquet(aggregates_dir / f'{key}_{name}.parquet')
+        aggregate_files[name] = file_name
+
+    with _lock:
+        manifest['aggregates'][str(key)] = aggregate_files
+        if time.time() - manifest['stored_at'] >= _MIN_STORE_SECONDS:
+            store_manifest(manifest)
@@ -0,0 +1,112 @@
+import errno
+import os
+import threading
+import polars as pl
+from collections import Counter
+from pathlib import Path
+from tempfile import gettempdir
+from typing import Dict, Iterable
+
+from src.misc import store_tempfile, DEFAULT_SPILL_FORMAT
+
+_lock = threading.Lock()
+
+def open_spill(spill_dir: Path = None, max_spill_mb: float = None) -> Dict:
+    """
+    Open the spill of a run: the temporary files of the run, written in `spill_dir`
+    (e.g. a fast local disk or a tmpfs), or in the system temporary directory by default.
+
+    Each file holds a number of references, one per stage still reading it, and is
+    deleted when the last one is released. The bytes currently spilled are kept
+    below `max_spill_mb`, and the bytes written are counted per stage.
+    """
+    spill_dir = Path(spill_dir) if spill_dir is not None else Path(gettempdir())
+    if not spill_dir.exists():
+        spill_dir.mkdir(parents=True, exist_ok=True)
+
+    return {
+        'spill_dir': spill_dir,
+        'max_bytes': max_spill_mb * 1024 * 1024 if max_spill_mb else None,
+        'files': {},
+        'bytes': 0,
+        'peak_bytes': 0,
+        'stage_bytes': Counter(),
+    }
+
+def _track(spill: Dict, path: str, refs: int, stage: str = None) -> None:
+    size = os.path.getsize(path)
+    with _lock:
+        if spill['max_bytes'] is not None and spill['bytes'] + size > spill['max_bytes']:
+            os.unlink(path)
+            raise OSError(
+                errno.ENOSPC,
+                f"Spill of {(spill['bytes'] + size) / (1024 * 1024):.1f} MB exceeds the cap of "
+                f"{spill['max_bytes'] / (1024 * 1024):.1f} MB in {spill['spill_dir']}"
+            )
+        spill['files'][path] = { 'size': size, 'refs': refs }
+        spill['bytes'] += size
+        spill['peak_bytes'] = max(spill['peak_bytes'], spill['bytes'])
+        if stage is not None:
+            spill['stage_bytes'][stage] += size
+
+def spill_frame(
+    spill: Dict,
+    df: pl.DataFrame,
+    stage: str,
+    spill_format: str = DEFAULT_SPILL_FORMAT,
+    refs: int = 1
+) -> str:
+    """
+    Store a DataFrame in a new spill file held by `refs` references and return its path.
+    Raises an `OSError` (ENOSPC) and removes the file if it would exceed the spill cap.
+    """
+    path = store_tempfile(df, spill_format, spill['spill_dir'])
+    _track(spill, path, refs, stage)
+    return path
+
+def adopt_file(spill: Dict, path: str, refs: int = 1) -> None:
+    """ Track a spill file written by an earlier run, e.g. a resumed one, if it still exists. """
+    with _lock:
+        if path in spill['files'] or not os.path.exists(path):
+            return
+    _track(spill, path, refs)
+
+def release(spill: Dict, paths: Iterable[str]) -> None:
+    """
+    Release a reference to each spill file, files without references are deleted.
+    Files that are not tracked, e.g. left by an earlier run, are deleted.
+    """
+    for path in paths:
+        with _lock:
+            spill_file = spill['files'].get(path)
+            if spill_file is not None:
+                spill_file['refs'] -= 1
+                if spill_file['refs'] > 0:
+                    continue
+                del spill['files'][path]
+                spill['bytes'] -= spill_file['size']
+        if os.path.exists(path):
+            os.unlink(path)
+
+def spill_report(spill: Dict) -> Dict:
+    """ Bytes written per stage, peak and current bytes spilled, and number of files still spilled. """
+    with _lock:
+        return {
+            'stage_bytes': dict(spill['stage_bytes']),
+            'peak_bytes': spill['peak_bytes'],
+            'bytes': spill['bytes'],
+            'files': len(spill['files']),
+        }
+
+def close_spill(spill: Dict) -> Dict:
+    """ Delete the spill files still referenced, at the end of the run, and return the spill report. """
+    with _lock:
+        paths = list(spill['files'])
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+    report = spill_report(spill)
+    with _lock:
+        spill['files'].clear()
+        spill['bytes'] = 0
+    return report
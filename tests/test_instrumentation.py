@@ -0,0 +1,35 @@
+import time
+
+import numpy as np
+
+from src import instrumentation
+from src.instrumentation import track_peak_rss, peak_rss_mb
+
+_ALLOCATED_MB = 200
+
+def _allocate():
+    # Touched, so that it is resident
+    data = np.ones(_ALLOCATED_MB * 1024 * 1024 // 8)
+    time.sleep(0.05)
+    del data
+
+def _stage_peaks():
+    with track_peak_rss() as outer:
+        with track_peak_rss() as large:
+            _allocate()
+        with track_peak_rss() as small:
+            time.sleep(0.05)
+    return outer['peak_rss_mb'], large['peak_rss_mb'], small['peak_rss_mb']
+
+def test_peak_rss_of_each_stage():
+    outer, large, small = _stage_peaks()
+    assert large > small + _ALLOCATED_MB / 2
+    # A stage includes the peaks of the stages nested in it
+    assert outer >= large
+    assert peak_rss_mb() >= large
+
+def test_peak_rss_sampled_where_it_can_not_be_reset(monkeypatch):
+    monkeypatch.setattr(instrumentation, '_RESETTABLE', False)
+    outer, large, small = _stage_peaks()
+    assert large > small + _ALLOCATED_MB / 2
+    assert outer >= large
@@ -0,0 +1,35 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from src.job_spool import open_spool, run_spool, INCOMING_DIR, STATUS_DIR
+
+def _run_job(job):
+    if job['action'] == 'large':
+        # Touched, so that it is resident
+        data = np.ones(200 * 1024 * 1024 // 8)
+        del data
+    return {}
+
+def test_peak_rss_of_each_job(tmp_path):
+    spool = open_spool(tmp_path)
+    for job_id, action in (('1_large', 'large'), ('2_small', 'small')):
+        (tmp_path / INCOMING_DIR / f'{job_id}.json').write_text(json.dumps({ 'action': action }))
+
+    stop = threading.Event()
+    daemon = threading.Thread(target=run_spool, args=(spool, _run_job), kwargs={ 'poll_seconds': 0.01, 'stop': stop })
+    daemon.start()
+    status_paths = [ tmp_path / STATUS_DIR / f'{job_id}.json' for job_id in ('1_large', '2_small') ]
+    deadline = time.time() + 10
+    while time.time() < deadline and not all(
+        path.exists() and json.loads(path.read_text())['status'] == 'done' for path in status_paths
+    ):
+        time.sleep(0.01)
+    stop.set()
+    daemon.join()
+
+    large, small = (json.loads(path.read_text())['peak_rss_mb'] for path in status_paths)
+    # The daemon's peak is the large job's, not the peak of the small job after it
+    assert large > small + 100
@@ -0,0 +1,43 @@
+import gzip
+import threading
+import time
+from pathlib import Path
+
+from src.matches import _prefetch, _iter_compressed_matches_chunks, generate_matches, store_matches
+
+def test_prefetch_yields_all_items(): 
+    assert list(_prefetch(iter(range(10)), 2)) == list(range(10))
+
+def test_prefetch_consumer_early_exit(): 
+    generator = _prefetch(iter([1, 2, 3]), 2)
+    assert next(generator) == 1
+    # Let the producer fill the queue and block on the end marker
+    time.sleep(0.3)
+    closer = threading.Thread(target=generator.close, daemon=True)
+    closer.start()
+    closer.join(timeout=5)
+    assert not closer.is_alive()
+
+def test_prefetch_raises_producer_error(): 
+    def _failing(): 
+        yield 1
+        raise ValueError('broken')
+
+    generator = _prefetch(_failing(), 1)
+    assert next(generator) == 1
+    try: 
+        next(generator)
+    except ValueError as e: 
+        assert str(e) == 'broken'
+    else: 
+        raise AssertionError('the producer error was not raised')
+
+def test_compressed_chunks_without_skipped_ranges(tmp_path): 
+    log_path = tmp_path / 'matches.log'
+    store_matches(log_path, generate_matches(20, 0, seed=1))
+    gz_path = Path(f'{log_path}.gz')
+    gz_path.write_bytes(gzip.compress(log_path.read_bytes()))
+
+    chunks = list(_iter_compressed_matches_chunks(gz_path, lambda: 100))
+    assert len(chunks) > 1
+    assert sum(chunk.collect().height for _, chunk in chunks) == len(log_path.read_bytes().splitlines())
@@ -0,0 +1,34 @@
+import uuid
+
+import polars as pl
+
+from src.queries import partition_by_match_hash, encode_ids
+
+def _partitions(match_ids, n_partitions, offset=0):
+    df = pl.LazyFrame({ 'player_id': match_ids, 'match_id': match_ids })
+    return partition_by_match_hash(df, n_partitions, offset).collect()['partition'].to_list()
+
+def test_partition_from_leading_bytes():
+    match_ids = [ str(uuid.UUID(int=i << 96 | 0x4000 << 64 | 0x8000 << 48, version=4)) for i in (0, 1, 36, 0xffffffff) ]
+    # Stored partials rely on this mapping, it must not change across versions
+    assert _partitions(match_ids, 37) == [ 0, 1, 36, 0xffffffff % 37 ]
+
+def test_split_from_other_bytes():
+    match_id = str(uuid.UUID('0000002a-0000-4000-8000-00000000000b'))
+    assert _partitions([ match_id ], 7) == [ 42 % 7 ]
+    assert _partitions([ match_id ], 7, offset=12) == [ 11 % 7 ]
+
+def test_partitions_are_balanced():
+    match_ids = [ str(uuid.uuid4()) for _ in range(20_000) ]
+    counts = pl.Series(_partitions(match_ids, 8)).value_counts()['count']
+    assert counts.min() > 0.8 * len(match_ids) / 8
+
+def test_partition_of_text_and_binary_ids():
+    match_ids = [ str(uuid.uuid4()) for _ in range(1_000) ]
+    encoded_ids = pl.LazyFrame({ 'player_id': match_ids, 'match_id': match_ids }).pipe(encode_ids)
+    # Offsets within and across the dashes of the UUID text
+    for offset in (0, 2, 6, 12):
+        from_text = _partitions(match_ids, 13, offset)
+        from_bytes = partition_by_match_hash(encoded_ids, 13, offset).collect()['partition'].to_list()
+        assert from_text == from_bytes
+        assert from_bytes == [ int.from_bytes(uuid.UUID(match_id).bytes[offset:offset + 4], 'big') % 13 for match_id in match_ids ]